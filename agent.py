@@ -24,6 +24,7 @@ os.umask(022)
 # project
 from checks.check_status import CollectorStatus
 from checks.collector import Collector
+from checks.scheduler import CheckScheduler
 from config import (
     get_config,
     get_parsed_args,
@@ -172,6 +173,12 @@ class Agent(Daemon):
         profiled = False
         collector_profiled_runs = 0
 
+        # The checks.d checks run on their own intervals, the collector
+        # sends what they collected every `check_frequency` seconds
+        scheduler = CheckScheduler(self.collector.check_runner, self.check_frequency)
+        schedule_checks = True
+        next_collection = time.time()
+
         # Run the main loop.
         while self.run_forever:
             log.debug("Found {num_checks} checks".format(num_checks=len(self._checksd['initialized_checks'])))
@@ -187,12 +194,17 @@ class Agent(Daemon):
 
             if self.reload_configs_flag:
                 self.reload_configs()
+                schedule_checks = True
+            if schedule_checks:
+                scheduler.schedule(self._checksd['initialized_checks'])
+                schedule_checks = False
 
             # Do the work. Pass `configs_reloaded` to let the collector know if it needs to
             # look for the AgentMetrics check and pop it out.
             self.collector.run(checksd=self._checksd,
                                start_event=self.start_event,
-                               configs_reloaded=self.reload_configs_flag)
+                               configs_reloaded=self.reload_configs_flag,
+                               check_jobs=scheduler.ready_jobs())
 
             self.reload_configs_flag = False
 
@@ -234,10 +246,12 @@ class Agent(Daemon):
                     watchdog.reset()
                 if profiled:
                     collector_profiled_runs += 1
-                log.debug("Sleeping for {0} seconds".format(self.check_frequency))
-                time.sleep(self.check_frequency)
+                next_collection = self._next_collection(next_collection)
+                log.debug("Next collection in {0:.2f} seconds".format(next_collection - time.time()))
+                self._run_checks_until(scheduler, next_collection)
 
         # Now clean-up.
+        self.collector.flush_emitters()
         try:
             CollectorStatus.remove_latest_status()
         except Exception:
@@ -247,6 +261,31 @@ class Agent(Daemon):
         log.info("Exiting. Bye bye.")
         sys.exit(0)
 
+    def _next_collection(self, last_collection):
+        """
+        Next collection time, `check_frequency` seconds after the previous
+        one was due however long it took: collections missed while it was
+        running are skipped.
+        """
+        next_collection = last_collection + self.check_frequency
+        now = time.time()
+        if next_collection <= now:
+            missed = int((now - next_collection) // self.check_frequency) + 1
+            log.warning("Collection took {0:.2f} seconds, skipping {1} collection(s)".format(
+                now - last_collection, missed))
+            next_collection += missed * self.check_frequency
+        return next_collection
+
+    def _run_checks_until(self, scheduler, deadline):
+        """ Sleep until `deadline`, submitting the checks that are due in the meantime. """
+        while self.run_forever:
+            now = time.time()
+            if now >= deadline:
+                return
+            next_check = scheduler.run_due(now)
+            wake_up = deadline if next_check is None else min(deadline, next_check)
+            time.sleep(max(wake_up - time.time(), 0))
+
     def _get_emitters(self):
         return [http_emitter]
 
@@ -280,6 +319,7 @@ class Agent(Daemon):
         log.info("Running an auto-restart.")
         if self.collector:
             self.collector.stop()
+            self.collector.flush_emitters()
         sys.exit(AgentSupervisor.RESTART_EXIT_STATUS)
 
 
@@ -4,6 +4,7 @@
 
 # stdlib
 import logging
+import math
 from time import time
 
 # project
@@ -23,6 +24,13 @@ log = logging.getLogger(__name__)
 # MetricsBucketAggregator constructor.
 RECENT_POINT_THRESHOLD_DEFAULT = 3600
 
+# Number of distinct metric names and tag strings the dogstatsd parser keeps
+# around, its caches are reset once they grow past it.
+PARSER_CACHE_SIZE = 100000
+
+# Number of series whose context MetricsBucketAggregator keeps resolved
+CONTEXT_CACHE_SIZE = 100000
+
 
 class Infinity(Exception):
     pass
@@ -32,11 +40,69 @@ class UnknownValue(Exception):
     pass
 
 
+class ContextCache(object):
+    """
+    A bounded mapping approximating a LRU with two generations of entries.
+    New entries go to the young generation, which becomes the old one once
+    it's full. Old entries move back to the young generation when they're
+    used again, the others are evicted when the old generation is replaced.
+    """
+
+    def __init__(self, size=CONTEXT_CACHE_SIZE):
+        self.generation_size = max(1, size // 2)
+        self.young = {}
+        self.old = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.young) + len(self.old)
+
+    def get(self, key):
+        entry = self.young.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        return self.get_old(key)
+
+    def get_old(self, key):
+        """ Lookup in the old generation only, for callers who checked `young` themselves """
+        entry = self.old.pop(key, None)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.set(key, entry)
+        return entry
+
+    def set(self, key, entry):
+        if len(self.young) >= self.generation_size:
+            self.evictions += len(self.old)
+            self.old = self.young
+            self.young = {}
+        self.young[key] = entry
+
+    def clear(self):
+        self.young = {}
+        self.old = {}
+
+    def pop_stats(self):
+        """ Hits, misses and evictions since the last call """
+        stats = self.hits, self.misses, self.evictions
+        self.hits = self.misses = self.evictions = 0
+        return stats
+
+
 class Metric(object):
     """
     A base metric class that accepts points, slices them into time intervals
     and performs roll-ups within those intervals.
     """
+    # Slots instead of a __dict__ per instance: aggregators keep one object
+    # per context and bucket. The context attributes are references to the
+    # name and tags shared with the aggregator's context keys.
+    __slots__ = ('formatter', 'name', 'tags', 'hostname', 'device_name', 'last_sample_time')
 
     def sample(self, value, sample_rate, timestamp=None):
         """ Add a point to the given metric. """
@@ -46,9 +112,14 @@ class Metric(object):
         """ Flush all metrics up to the given timestamp. """
         raise NotImplementedError()
 
+    def merge(self, other):
+        """ Fold the state of another instance of the same context into this one. """
+        raise NotImplementedError()
+
 
 class Gauge(Metric):
     """ A metric that tracks a value at particular points in time. """
+    __slots__ = ('value', 'timestamp')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -65,6 +136,13 @@ class Gauge(Metric):
         self.last_sample_time = time()
         self.timestamp = timestamp
 
+    def merge(self, other):
+        # Last write wins, like it does for samples within a single aggregator
+        if other.value is not None and \
+                (self.value is None or other.last_sample_time >= self.last_sample_time):
+            self.value = other.value
+            self.timestamp = other.timestamp
+            self.last_sample_time = other.last_sample_time
 
     def flush(self, timestamp, interval):
         if self.value is not None:
@@ -90,6 +168,7 @@ class BucketGauge(Gauge):
     opposed to the time that the sample was collected.
 
     """
+    __slots__ = ()
 
     def flush(self, timestamp, interval):
         if self.value is not None:
@@ -111,6 +190,7 @@ class BucketGauge(Gauge):
 
 class Count(Metric):
     """ A metric that tracks a count. """
+    __slots__ = ('value',)
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -125,6 +205,11 @@ class Count(Metric):
         self.value = (self.value or 0) + value
         self.last_sample_time = time()
 
+    def merge(self, other):
+        if other.value is not None:
+            self.value = (self.value or 0) + other.value
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, timestamp, interval):
         if self.value is None:
             return []
@@ -143,6 +228,7 @@ class Count(Metric):
             self.value = None
 
 class MonotonicCount(Metric):
+    __slots__ = ('prev_counter', 'curr_counter', 'count')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -191,6 +277,7 @@ class MonotonicCount(Metric):
 
 class Counter(Metric):
     """ A metric that tracks a counter value. """
+    __slots__ = ('value',)
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -205,6 +292,10 @@ class Counter(Metric):
         self.value += value * int(1 / sample_rate)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.value += other.value
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, timestamp, interval):
         try:
             value = self.value / interval
@@ -224,8 +315,16 @@ class Counter(Metric):
 DEFAULT_HISTOGRAM_AGGREGATES = ['max', 'median', 'avg', 'count']
 DEFAULT_HISTOGRAM_PERCENTILES = [0.95]
 
+# Used by SketchHistogram, when `histogram_backend` is `sketch`
+DEFAULT_SKETCH_RELATIVE_ACCURACY = 0.01
+# With the default accuracy, enough to cover values from 1e-9 to 1e9
+SKETCH_MAX_BINS = 2048
+# Smaller values are counted as zeros
+SKETCH_MIN_VALUE = 1e-9
+
 class Histogram(Metric):
     """ A metric to track the distribution of a set of values. """
+    __slots__ = ('count', 'samples', 'aggregates', 'percentiles')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -248,17 +347,31 @@ class Histogram(Metric):
         self.samples.append(value)
         self.last_sample_time = time()
 
-    def flush(self, ts, interval):
-        if not self.count:
-            return []
+    def merge(self, other):
+        self.count += other.count
+        self.samples.extend(other.samples)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
 
+    def _summarize(self):
+        """
+        Returns the min, max and average of the samples, their number, and a
+        function returning the sample at a given rank of the sorted samples.
+        """
         self.samples.sort()
         length = len(self.samples)
+        return (self.samples[0], self.samples[-1], sum(self.samples) / float(length),
+                length, self.samples.__getitem__)
 
-        min_ = self.samples[0]
-        max_ = self.samples[-1]
-        med = self.samples[int(round(length/2 - 1))]
-        avg = sum(self.samples) / float(length)
+    def _reset(self):
+        self.samples = []
+        self.count = 0
+
+    def flush(self, ts, interval):
+        if not self.count:
+            return []
+
+        min_, max_, avg, length, value_at_rank = self._summarize()
+        med = value_at_rank(int(round(length/2 - 1)))
 
         aggregators = [
             ('min', min_, MetricTypes.GAUGE),
@@ -286,7 +399,7 @@ class Histogram(Metric):
         ]
 
         for p in self.percentiles:
-            val = self.samples[int(round(p * length - 1))]
+            val = value_at_rank(int(round(p * length - 1)))
             name = '%s.%spercentile' % (self.name, int(p * 100))
             metrics.append(self.formatter(
                 hostname=self.hostname,
@@ -299,14 +412,150 @@ class Histogram(Metric):
             ))
 
         # Reset our state.
-        self.samples = []
-        self.count = 0
+        self._reset()
 
         return metrics
 
 
+class QuantileSketch(object):
+    """
+    A mergeable quantile sketch (DDSketch, https://arxiv.org/abs/1908.10693).
+    Values are counted in bins whose bounds grow geometrically, so that the
+    value returned for any rank is within `relative_accuracy` of the actual
+    sample of that rank. Bins of the smallest magnitudes are collapsed past
+    `max_bins`, which only degrades the accuracy of the lowest quantiles.
+    """
+    __slots__ = ('relative_accuracy', 'gamma', 'multiplier', 'max_bins',
+                 'positive_bins', 'negative_bins', 'zero_count', 'count')
+
+    def __init__(self, relative_accuracy=DEFAULT_SKETCH_RELATIVE_ACCURACY, max_bins=SKETCH_MAX_BINS):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.multiplier = 1 / math.log(self.gamma)
+        self.max_bins = max_bins
+        self.positive_bins = {}
+        self.negative_bins = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value > SKETCH_MIN_VALUE:
+            bins = self.positive_bins
+            key = int(math.ceil(math.log(value) * self.multiplier))
+        elif value < -SKETCH_MIN_VALUE:
+            bins = self.negative_bins
+            key = int(math.ceil(math.log(-value) * self.multiplier))
+        else:
+            self.zero_count += 1
+            return
+
+        bins[key] = bins.get(key, 0) + 1
+        if len(bins) > self.max_bins:
+            self._collapse(bins)
+
+    def merge(self, other):
+        for bins, other_bins in ((self.positive_bins, other.positive_bins),
+                                 (self.negative_bins, other.negative_bins)):
+            for key, count in other_bins.iteritems():
+                bins[key] = bins.get(key, 0) + count
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def _collapse(self, bins):
+        keys = sorted(bins)
+        excess = len(keys) - self.max_bins
+        lowest_kept = keys[excess]
+        for key in keys[:excess]:
+            bins[lowest_kept] += bins.pop(key)
+
+    def _bin_value(self, key):
+        # Value at the same relative distance of both bounds of the bin
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def value_at_rank(self, rank):
+        """ Estimate of the sample of the given rank, like `sorted(samples)[rank]` """
+        if rank < 0:
+            rank += self.count
+
+        seen = 0
+        for key in sorted(self.negative_bins, reverse=True):
+            seen += self.negative_bins[key]
+            if seen > rank:
+                return -self._bin_value(key)
+
+        seen += self.zero_count
+        if seen > rank:
+            return 0
+
+        for key in sorted(self.positive_bins):
+            seen += self.positive_bins[key]
+            if seen > rank:
+                return self._bin_value(key)
+
+        raise IndexError('rank %s out of a sketch of %s values' % (rank, self.count))
+
+
+class SketchHistogram(Histogram):
+    """
+    A Histogram that summarizes its samples with a QuantileSketch instead of
+    keeping them: memory use doesn't grow with the number of samples.
+    min, max, avg and count are exact, median and percentiles are within
+    the configured relative accuracy.
+    """
+    __slots__ = ('relative_accuracy', 'sketch', 'min', 'max', 'sum')
+
+    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
+        Histogram.__init__(self, formatter, name, tags, hostname, device_name, extra_config)
+        self.relative_accuracy = extra_config['relative_accuracy'] if\
+            extra_config is not None and extra_config.get('relative_accuracy') is not None\
+            else DEFAULT_SKETCH_RELATIVE_ACCURACY
+        self.samples = None
+        self._reset()
+
+    def sample(self, value, sample_rate, timestamp=None):
+        self.count += int(1 / sample_rate)
+        self.sketch.add(value)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.sum += value
+        self.last_sample_time = time()
+
+    def merge(self, other):
+        self.count += other.count
+        self.sketch.merge(other.sketch)
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        self.sum += other.sum
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    def _summarize(self):
+        length = self.sketch.count
+        min_, max_ = self.min, self.max
+
+        def value_at_rank(rank):
+            # The exact bounds are better estimates for the extreme ranks
+            return min(max(self.sketch.value_at_rank(rank), min_), max_)
+
+        return min_, max_, self.sum / float(length), length, value_at_rank
+
+    def _reset(self):
+        self.sketch = QuantileSketch(self.relative_accuracy)
+        self.min = None
+        self.max = None
+        self.sum = 0
+        self.count = 0
+
+
 class Set(Metric):
     """ A metric to track the number of unique elements in a set. """
+    __slots__ = ('values',)
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -321,6 +570,10 @@ class Set(Metric):
         self.values.add(value)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.values.update(other.values)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, timestamp, interval):
         if not self.values:
             return []
@@ -341,6 +594,7 @@ class Set(Metric):
 
 class Rate(Metric):
     """ Track the rate of metrics over each flush interval """
+    __slots__ = ('samples',)
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -401,11 +655,14 @@ class Aggregator(object):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, histogram_backend=None,
+            histogram_relative_accuracy=None):
         self.events = []
         self.service_checks = []
         self.total_count = 0
         self.count = 0
+        # Datagrams the dogstatsd server couldn't parse, reset at each flush
+        self.error_count = 0
         self.event_count = 0
         self.service_check_count = 0
         self.hostname = hostname
@@ -417,16 +674,26 @@ class Aggregator(object):
         self.recent_point_threshold = int(recent_point_threshold)
         self.num_discarded_old_points = 0
 
+        # Class used for `h` and `ms` metrics
+        self.histogram_class = SketchHistogram if histogram_backend == 'sketch' else Histogram
+
         # Additional config passed when instantiating metric configs
+        histogram_config = {
+            'aggregates': histogram_aggregates,
+            'percentiles': histogram_percentiles,
+            'relative_accuracy': histogram_relative_accuracy,
+        }
         self.metric_config = {
-            Histogram: {
-                'aggregates': histogram_aggregates,
-                'percentiles': histogram_percentiles
-            }
+            Histogram: histogram_config,
+            SketchHistogram: histogram_config,
         }
 
         self.utf8_decoding = utf8_decoding
 
+        # Metric names and tag tuples already seen by parse_metric_packet
+        self._parsed_names = {}
+        self._parsed_tags = {}
+
     def packets_per_second(self, interval):
         if interval == 0:
             return 0
@@ -437,27 +704,41 @@ class Aggregator(object):
         Schema of a dogstatsd packet:
         <name>:<value>|<metric_type>|@<sample_rate>|#<tag1_name>:<tag1_value>,<tag2_name>:<tag2_value>:<value>|<metric_type>...
         """
-        parsed_packets = []
-        name_and_metadata = packet.split(':', 1)
-
-        if len(name_and_metadata) != 2:
+        name, separator, values_and_metadata = packet.partition(':')
+        if not separator:
             raise Exception('Unparseable metric packet: %s' % packet)
 
-        name = name_and_metadata[0]
-        broken_split = name_and_metadata[1].split(':')
-        data = []
-        partial_datum = None
-        for token in broken_split:
-            # We need to fix the tag groups that got broken by the : split
-            if partial_datum is None:
-                partial_datum = token
-            elif "|" not in token:
-                partial_datum += ":" + token
-            else:
-                data.append(partial_datum)
-                partial_datum = token
-        data.append(partial_datum)
+        # Reuse the same string for every packet of a series
+        names = self._parsed_names
+        interned_name = names.get(name)
+        if interned_name is None:
+            if len(names) >= PARSER_CACHE_SIZE:
+                names.clear()
+            names[name] = name
+        else:
+            name = interned_name
 
+        # Several values are only packed in a packet when a `|` follows a `:`,
+        # colons that aren't followed by a `|` come from the tags.
+        colon = values_and_metadata.find(':')
+        if colon == -1 or values_and_metadata.find('|', colon) == -1:
+            data = (values_and_metadata,)
+        else:
+            data = []
+            partial_datum = None
+            for token in values_and_metadata.split(':'):
+                # We need to fix the tag groups that got broken by the : split
+                if partial_datum is None:
+                    partial_datum = token
+                elif "|" not in token:
+                    partial_datum += ":" + token
+                else:
+                    data.append(partial_datum)
+                    partial_datum = token
+            data.append(partial_datum)
+
+        tags_by_raw_tags = self._parsed_tags
+        parsed_packets = []
         for datum in data:
             value_and_metadata = datum.split('|')
 
@@ -482,7 +763,6 @@ class Aggregator(object):
                         # Otherwise, raise an error saying it must be a number
                         raise Exception('Metric value must be a number: %s, %s' % (name, raw_value))
 
-
             # Parse the optional values - sample rate & tags.
             sample_rate = 1
             tags = None
@@ -492,9 +772,15 @@ class Aggregator(object):
                     sample_rate = float(m[1:])
                     assert 0 <= sample_rate <= 1
                 elif m[0] == '#':
-                    tags = tuple(sorted(m[1:].split(',')))
+                    # Share the sorted tuple between the packets sending the same tags
+                    raw_tags = m[1:]
+                    tags = tags_by_raw_tags.get(raw_tags)
+                    if tags is None:
+                        if len(tags_by_raw_tags) >= PARSER_CACHE_SIZE:
+                            tags_by_raw_tags.clear()
+                        tags = tags_by_raw_tags[raw_tags] = tuple(sorted(raw_tags.split(',')))
 
-            parsed_packets.append((name, value, metric_type, tags,sample_rate))
+            parsed_packets.append((name, value, metric_type, tags, sample_rate))
 
         return parsed_packets
 
@@ -607,10 +893,13 @@ class Aggregator(object):
                 self.count += 1
                 parsed_packets = self.parse_metric_packet(packet)
                 for name, value, mtype, tags, sample_rate in parsed_packets:
-                    hostname, device_name, tags = self._extract_magic_tags(tags)
-                    self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
-                        device_name=device_name, sample_rate=sample_rate)
+                    self.submit_packet_metric(name, value, mtype, tags, sample_rate)
 
+    def submit_packet_metric(self, name, value, mtype, tags, sample_rate):
+        """ Add a metric parsed from a dogstatsd packet, whose tags may hold magic tags """
+        hostname, device_name, tags = self._extract_magic_tags(tags)
+        self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
+            device_name=device_name, sample_rate=sample_rate)
 
     def _extract_magic_tags(self, tags):
         """Magic tags (host, device) override metric hostname and device_name attributes"""
@@ -713,6 +1002,9 @@ class Aggregator(object):
     def send_packet_count(self, metric_name):
         self.submit_metric(metric_name, self.count, 'g')
 
+    def send_error_count(self, metric_name):
+        self.submit_metric(metric_name, self.error_count, 'g')
+
 class MetricsBucketAggregator(Aggregator):
     """
     A metric aggregator class.
@@ -721,7 +1013,8 @@ class MetricsBucketAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, context_cache_size=None, histogram_backend=None,
+            histogram_relative_accuracy=None):
         super(MetricsBucketAggregator, self).__init__(
             hostname,
             interval,
@@ -730,24 +1023,95 @@ class MetricsBucketAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            histogram_backend,
+            histogram_relative_accuracy
         )
         self.metric_by_bucket = {}
+        # Last sample time of the live Counter contexts, which report zeros
+        # when they aren't sampled until they expire
         self.last_sample_time_by_context = {}
+        # Same contexts, indexed by `last sample time // interval` to expire
+        # them without going through all of them
+        self.counter_contexts_by_slot = {}
         self.current_bucket = None
         self.current_mbc = {}
+        # Bumped every time current_mbc is replaced, to invalidate the metric
+        # objects remembered by the context cache
+        self.current_mbc_generation = 0
         self.last_flush_cutoff_time = 0
+        # Packet name and tags -> [context, tags, hostname, device_name, generation, metric]
+        self.context_cache = ContextCache(context_cache_size or CONTEXT_CACHE_SIZE)
         self.metric_type_to_class = {
             'g': BucketGauge,
             'c': Counter,
-            'h': Histogram,
-            'ms': Histogram,
+            'h': self.histogram_class,
+            'ms': self.histogram_class,
             's': Set,
         }
 
     def calculate_bucket_start(self, timestamp):
         return timestamp - (timestamp % self.interval)
 
+    def _switch_bucket(self, bucket_start_timestamp):
+        if bucket_start_timestamp not in self.metric_by_bucket:
+            self.metric_by_bucket[bucket_start_timestamp] = {}
+        self.current_bucket = bucket_start_timestamp
+        self.current_mbc = self.metric_by_bucket[bucket_start_timestamp]
+        self.current_mbc_generation += 1
+        return self.current_mbc
+
+    def submit_packet_metric(self, name, value, mtype, tags, sample_rate):
+        # Same as Aggregator.submit_packet_metric followed by submit_metric,
+        # but series seen recently skip the magic tags and context resolution
+        key = (name, tags)
+        context_cache = self.context_cache
+        entry = context_cache.young.get(key)
+        if entry is None:
+            entry = context_cache.get_old(key)
+            if entry is None:
+                hostname, device_name, tags = self._extract_magic_tags(tags)
+                # Keep hostname with empty string to unset it
+                hostname = hostname if hostname is not None else self.hostname
+                if tags is None:
+                    context = (name, tuple(), hostname, device_name)
+                else:
+                    context_tags = tuple(sorted(set(tags)))
+                    # Parsed tags are usually sorted already, share the tuple
+                    # of the parser cache instead of keeping a copy per context
+                    if context_tags == tags:
+                        context_tags = tags
+                    context = (name, context_tags, hostname, device_name)
+                entry = [context, tags, hostname, device_name, None, None]
+                context_cache.set(key, entry)
+        else:
+            context_cache.hits += 1
+
+        timestamp = time()
+        bucket_start_timestamp = timestamp - (timestamp % self.interval)
+        if bucket_start_timestamp == self.current_bucket:
+            metric_by_context = self.current_mbc
+        else:
+            metric_by_context = self._switch_bucket(bucket_start_timestamp)
+
+        if entry[4] == self.current_mbc_generation:
+            metric = entry[5]
+        else:
+            context = entry[0]
+            metric = metric_by_context.get(context)
+            if metric is None:
+                metric_class = self.metric_type_to_class[mtype]
+                metric = metric_by_context[context] = metric_class(self.formatter, name, entry[1],
+                    entry[2], entry[3], self.metric_config.get(metric_class))
+            entry[4] = self.current_mbc_generation
+            entry[5] = metric
+
+        metric.sample(value, sample_rate, timestamp)
+
+    def context_cache_stats(self):
+        """ Hits, misses and evictions of the context cache since the last call """
+        return self.context_cache.pop_stats()
+
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
                       device_name=None, timestamp=None, sample_rate=1):
         # Avoid calling extra functions to dedupe tags if there are none
@@ -775,11 +1139,7 @@ class MetricsBucketAggregator(Aggregator):
             if bucket_start_timestamp == self.current_bucket:
                 metric_by_context = self.current_mbc
             else:
-                if bucket_start_timestamp not in self.metric_by_bucket:
-                    self.metric_by_bucket[bucket_start_timestamp] = {}
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
-                self.current_bucket = bucket_start_timestamp
-                self.current_mbc = metric_by_context
+                metric_by_context = self._switch_bucket(bucket_start_timestamp)
 
             if context not in metric_by_context:
                 metric_class = self.metric_type_to_class[mtype]
@@ -788,18 +1148,125 @@ class MetricsBucketAggregator(Aggregator):
 
             metric_by_context[context].sample(value, sample_rate, timestamp)
 
-    def create_empty_metrics(self, sample_time_by_context, expiry_timestamp, flush_timestamp, metrics):
+    def _sample_slot(self, last_sample_time):
+        return int(last_sample_time // self.interval)
+
+    def _discard_from_slot(self, context, slot):
+        contexts = self.counter_contexts_by_slot[slot]
+        contexts.discard(context)
+        if not contexts:
+            del self.counter_contexts_by_slot[slot]
+
+    def _forget_counter(self, context):
+        last_sample_time = self.last_sample_time_by_context.pop(context, None)
+        if last_sample_time is not None:
+            self._discard_from_slot(context, self._sample_slot(last_sample_time))
+
+    def _expire_counters(self, expiry_timestamp):
+        """
+        Forget the Counter contexts not sampled since expiry_timestamp. Slots
+        older than the expiry are dropped whole, only the one it falls in is
+        checked context by context.
+        """
+        expiry_slot = self._sample_slot(expiry_timestamp)
+        for slot in [s for s in self.counter_contexts_by_slot if s <= expiry_slot]:
+            contexts = self.counter_contexts_by_slot[slot]
+            if slot < expiry_slot:
+                expired = contexts
+            else:
+                expired = [c for c in contexts
+                           if self.last_sample_time_by_context[c] < expiry_timestamp]
+            for context in expired:
+                log.debug("%s hasn't been submitted in %ss. Expiring.", context, self.expiry_seconds)
+                del self.last_sample_time_by_context[context]
+            if expired is contexts:
+                del self.counter_contexts_by_slot[slot]
+            else:
+                contexts.difference_update(expired)
+                if not contexts:
+                    del self.counter_contexts_by_slot[slot]
+
+    def create_empty_metrics(self, sampled_contexts, expiry_timestamp, flush_timestamp, metrics):
         # Even if no data is submitted, Counters keep reporting "0" for expiry_seconds.  The other Metrics
         #  (Set, Gauge, Histogram) do not report if no data is submitted
-        for context, last_sample_time in sample_time_by_context.items():
-            if last_sample_time < expiry_timestamp:
-                log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                self.last_sample_time_by_context.pop(context, None)
-            else:
-                # The expiration currently only applies to Counters
+        self._expire_counters(expiry_timestamp)
+
+        # Same output as flushing an empty Counter, without creating one
+        formatter = self.formatter
+        interval = self.interval
+        value = 0 / interval
+        append = metrics.append
+        for contexts in self.counter_contexts_by_slot.itervalues():
+            for context in contexts:
+                if context in sampled_contexts:
+                    continue
                 # This counts on the ordering of the context created in submit_metric not changing
-                metric = Counter(self.formatter, context[0], context[1], context[2], context[3])
-                metrics += metric.flush(flush_timestamp, self.interval)
+                append(formatter(
+                    metric=context[0],
+                    value=value,
+                    timestamp=flush_timestamp,
+                    tags=context[1],
+                    hostname=context[2],
+                    device_name=context[3],
+                    metric_type=MetricTypes.RATE,
+                    interval=interval,
+                ))
+
+    def drain_shard(self):
+        """
+        Hand over everything aggregated since the last drain and start afresh.
+        Used by dogstatsd servers, whose state is merged into the reporting
+        aggregator with `merge_shard` before each flush.
+        """
+        state = {
+            'context_cache_stats': self.context_cache.pop_stats(),
+            'metric_by_bucket': self.metric_by_bucket,
+            'events': self.events,
+            'service_checks': self.service_checks,
+            'count': self.count,
+            'error_count': self.error_count,
+            'event_count': self.event_count,
+            'service_check_count': self.service_check_count,
+            'num_discarded_old_points': self.num_discarded_old_points,
+        }
+        self.metric_by_bucket = {}
+        self.current_bucket = None
+        self.current_mbc = {}
+        self.current_mbc_generation += 1
+        self.events = []
+        self.service_checks = []
+        self.count = 0
+        self.error_count = 0
+        self.event_count = 0
+        self.service_check_count = 0
+        self.num_discarded_old_points = 0
+        return state
+
+    def merge_shard(self, state):
+        """ Fold a state returned by `drain_shard` into this aggregator. """
+        for bucket_start_timestamp, shard_mbc in state['metric_by_bucket'].iteritems():
+            if bucket_start_timestamp not in self.metric_by_bucket:
+                self.metric_by_bucket[bucket_start_timestamp] = {}
+            metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
+            for context, metric in shard_mbc.iteritems():
+                if context in metric_by_context:
+                    metric_by_context[context].merge(metric)
+                else:
+                    metric.formatter = self.formatter
+                    metric_by_context[context] = metric
+
+        hits, misses, evictions = state['context_cache_stats']
+        self.context_cache.hits += hits
+        self.context_cache.misses += misses
+        self.context_cache.evictions += evictions
+
+        self.events.extend(state['events'])
+        self.service_checks.extend(state['service_checks'])
+        self.count += state['count']
+        self.error_count += state['error_count']
+        self.event_count += state['event_count']
+        self.service_check_count += state['service_check_count']
+        self.num_discarded_old_points += state['num_discarded_old_points']
 
     def flush(self):
         cur_time = time()
@@ -807,36 +1274,49 @@ class MetricsBucketAggregator(Aggregator):
         expiry_timestamp = cur_time - self.expiry_seconds
 
         metrics = []
+        extend = metrics.extend
+        interval = self.interval
+        last_sample_time_by_context = self.last_sample_time_by_context
+        counter_contexts_by_slot = self.counter_contexts_by_slot
 
-        if self.metric_by_bucket:
+        flushed_buckets = [ts for ts in self.metric_by_bucket if ts < flush_cutoff_time]
+        if flushed_buckets:
             # We want to process these in order so that we can check for and expired metrics and
             #  re-create non-expired metrics.  We also mutate self.metric_by_bucket.
-            for bucket_start_timestamp in sorted(self.metric_by_bucket.keys()):
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
-                if bucket_start_timestamp < flush_cutoff_time:
-                    not_sampled_in_this_bucket = self.last_sample_time_by_context.copy()
-                    # We mutate this dictionary while iterating so don't use an iterator.
-                    for context, metric in metric_by_context.items():
-                        if metric.last_sample_time < expiry_timestamp:
-                            # This should never happen
-                            log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                            not_sampled_in_this_bucket.pop(context, None)
-                            self.last_sample_time_by_context.pop(context, None)
-                        else:
-                            metrics += metric.flush(bucket_start_timestamp, self.interval)
-                            if isinstance(metric, Counter):
-                                self.last_sample_time_by_context[context] = metric.last_sample_time
-                                not_sampled_in_this_bucket.pop(context, None)
-                    # We need to account for Metrics that have not expired and were not flushed for this bucket
-                    self.create_empty_metrics(not_sampled_in_this_bucket, expiry_timestamp, bucket_start_timestamp, metrics)
-
-                    del self.metric_by_bucket[bucket_start_timestamp]
-        else:
+            flushed_buckets.sort()
+            for bucket_start_timestamp in flushed_buckets:
+                metric_by_context = self.metric_by_bucket.pop(bucket_start_timestamp)
+                # Counters of this bucket, the other live ones report zeros
+                sampled_contexts = set()
+                for context, metric in metric_by_context.iteritems():
+                    if metric.last_sample_time < expiry_timestamp:
+                        # This should never happen
+                        log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
+                        self._forget_counter(context)
+                    else:
+                        extend(metric.flush(bucket_start_timestamp, interval))
+                        if isinstance(metric, Counter):
+                            sampled_contexts.add(context)
+                            last_sample_time = metric.last_sample_time
+                            slot = int(last_sample_time // interval)
+                            previous = last_sample_time_by_context.get(context)
+                            last_sample_time_by_context[context] = last_sample_time
+                            if previous is not None:
+                                previous_slot = int(previous // interval)
+                                if previous_slot == slot:
+                                    continue
+                                self._discard_from_slot(context, previous_slot)
+                            contexts = counter_contexts_by_slot.get(slot)
+                            if contexts is None:
+                                contexts = counter_contexts_by_slot[slot] = set()
+                            contexts.add(context)
+                # We need to account for Metrics that have not expired and were not flushed for this bucket
+                self.create_empty_metrics(sampled_contexts, expiry_timestamp, bucket_start_timestamp, metrics)
+        elif not self.metric_by_bucket:
             # Even if there are no metrics in this flush, there may be some non-expired counters
             #  We should only create these non-expired metrics if we've passed an interval since the last flush
-            if flush_cutoff_time >= self.last_flush_cutoff_time + self.interval:
-                self.create_empty_metrics(self.last_sample_time_by_context.copy(), expiry_timestamp,
-                                          flush_cutoff_time-self.interval, metrics)
+            if flush_cutoff_time >= self.last_flush_cutoff_time + interval:
+                self.create_empty_metrics((), expiry_timestamp, flush_cutoff_time-interval, metrics)
 
         # Log a warning regarding metrics with old timestamps being submitted
         if self.num_discarded_old_points > 0:
@@ -847,8 +1327,10 @@ class MetricsBucketAggregator(Aggregator):
         log.debug("received %s payloads since last flush" % self.count)
         self.total_count += self.count
         self.count = 0
+        self.error_count = 0
         self.current_bucket = None
         self.current_mbc = {}
+        self.current_mbc_generation += 1
         self.last_flush_cutoff_time = flush_cutoff_time
         return metrics
 
@@ -861,7 +1343,8 @@ class MetricsAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, histogram_backend=None,
+            histogram_relative_accuracy=None):
         super(MetricsAggregator, self).__init__(
             hostname,
             interval,
@@ -870,7 +1353,9 @@ class MetricsAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            histogram_backend,
+            histogram_relative_accuracy
         )
         self.metrics = {}
         self.metric_type_to_class = {
@@ -878,8 +1363,8 @@ class MetricsAggregator(Aggregator):
             'ct': Count,
             'ct-c': MonotonicCount,
             'c': Counter,
-            'h': Histogram,
-            'ms': Histogram,
+            'h': self.histogram_class,
+            'ms': self.histogram_class,
             's': Set,
             '_dd-r': Rate,
         }
@@ -955,6 +1440,7 @@ class MetricsAggregator(Aggregator):
         log.debug("received %s payloads since last flush" % self.count)
         self.total_count += self.count
         self.count = 0
+        self.error_count = 0
         return metrics
 
 def get_formatter(config):
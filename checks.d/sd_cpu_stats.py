@@ -10,11 +10,11 @@ except ImportError:
 # project
 import logging
 import platform
-import string
 import subprocess
 import sys
 import time
 from checks import AgentCheck
+from utils.procfs import CpuSampler
 from utils.subprocess_output import get_subprocess_output
 
 pythonVersion = platform.python_version_tuple()
@@ -24,6 +24,9 @@ python24 = platform.python_version().startswith('2.4')
 class ServerDensityCPUChecks(AgentCheck):
     """ Collects metrics about the machine's disks. """
 
+    def __init__(self, name, init_config, agentConfig, instances=None):
+        AgentCheck.__init__(self, name, init_config, agentConfig, instances)
+        self._cpu_sampler = CpuSampler()
 
     def check(self, instance):
         #self.log.debug('hello')
@@ -54,64 +57,17 @@ class ServerDensityCPUChecks(AgentCheck):
         if sys.platform == 'linux2':
             self.log.debug('getCPUStats: linux2')
 
-            headerRegexp = re.compile(r'.*?([%][a-zA-Z0-9]+)[\s+]?')
-            itemRegexp = re.compile(r'.*?\s+(\d+)[\s+]?')
-            valueRegexp = re.compile(r'\d+\.\d+')
-            proc = None
             try:
-                proc = subprocess.Popen(['mpstat', '-P', 'ALL', '1', '1'], stdout=subprocess.PIPE, close_fds=True)
-                stats = proc.communicate()[0]
-
-                if int(pythonVersion[1]) >= 6:
-                    try:
-                        proc.kill()
-                    except Exception:
-                        self.log.debug('Process already terminated')
-
-                stats = stats.split('\n')
-                header = stats[2]
-                headerNames = re.findall(headerRegexp, header)
-                device = None
-
-                for statsIndex in range(3, len(stats)):
-                    row = stats[statsIndex]
-
-                    if not row:  # skip the averages
-                        break
-
-                    deviceMatch = re.match(itemRegexp, row)
-
-                    if string.find(row, 'all') is not -1:
-                        device = 'ALL'
-                    elif deviceMatch is not None:
-                        device = 'CPU%s' % deviceMatch.groups()[0]
-
-                    values = re.findall(valueRegexp, row.replace(',', '.'))
-
-                    cpu_stats[device] = {}
-                    for headerIndex in range(0, len(headerNames)):
-                        headerName = headerNames[headerIndex]
-                        cpu_stats[device][headerName] = values[headerIndex]
-                        key = headerName.replace('%', '')
-                        self.gauge('serverdensity.cpu.{0}'.format(key), float(values[headerIndex]), device_name=device)
-
-            except OSError:
-                # we dont have it installed return nothing
-                return False
+                # Since the previous run, from the counters of /proc/stat
+                for cpu, percentages in self._cpu_sampler.sample().iteritems():
+                    device = 'ALL' if cpu == 'all' else 'CPU%s' % cpu
+                    cpu_stats[device] = percentages
+                    for key, value in percentages.iteritems():
+                        self.gauge('serverdensity.cpu.{0}'.format(key), value, device_name=device)
 
             except Exception:
                 import traceback
                 self.log.error("getCPUStats: exception = %s", traceback.format_exc())
-
-                if int(pythonVersion[1]) >= 6:
-                    try:
-                        if proc is not None:
-                            proc.kill()
-                    except UnboundLocalError:
-                        self.log.debug('Process already terminated')
-                    except Exception:
-                        self.log.debug('Process already terminated')
-
                 return False
 
         elif sys.platform == 'darwin':
@@ -42,6 +42,10 @@ DEFAULT_PSUTIL_METHODS = ['memory_info', 'io_counters']
 
 AGENT_METRICS_CHECK_NAME = 'agent_metrics'
 
+# Seconds by which an instance may run earlier than its min_collection_interval:
+# a run that started a bit late mustn't push the next one back by a whole interval
+MIN_COLLECTION_INTERVAL_TOLERANCE = 0.5
+
 
 # Konstants
 class CheckException(Exception):
@@ -334,7 +338,9 @@ class AgentCheck(object):
             formatter=agent_formatter,
             recent_point_threshold=agentConfig.get('recent_point_threshold', None),
             histogram_aggregates=agentConfig.get('histogram_aggregates'),
-            histogram_percentiles=agentConfig.get('histogram_percentiles')
+            histogram_percentiles=agentConfig.get('histogram_percentiles'),
+            histogram_backend=agentConfig.get('histogram_backend'),
+            histogram_relative_accuracy=agentConfig.get('histogram_relative_accuracy')
         )
 
         self.events = []
@@ -741,7 +747,7 @@ class AgentCheck(object):
                     )
                 )
                 now = time.time()
-                if now - self.last_collection_time[i] < min_collection_interval:
+                if now - self.last_collection_time[i] < min_collection_interval - MIN_COLLECTION_INTERVAL_TOLERANCE:
                     self.log.debug("Not running instance #{0} of check {1} as it ran less than {2}s ago".format(i, self.name, min_collection_interval))
                     continue
 
@@ -299,7 +299,7 @@ class CheckStatus(object):
                  event_count=None, service_check_count=None, service_metadata=[],
                  init_failed_error=None, init_failed_traceback=None,
                  library_versions=None, source_type_name=None,
-                 check_stats=None):
+                 check_stats=None, queue_time=None, run_time=None):
         self.name = check_name
         self.source_type_name = source_type_name
         self.instance_statuses = instance_statuses
@@ -311,6 +311,9 @@ class CheckStatus(object):
         self.library_versions = library_versions
         self.check_stats = check_stats
         self.service_metadata = service_metadata
+        # Seconds the check waited for a worker, and ran
+        self.queue_time = queue_time
+        self.run_time = run_time
 
     @property
     def status(self):
@@ -327,11 +330,13 @@ class CheckStatus(object):
 
 class EmitterStatus(object):
 
-    def __init__(self, name, error=None):
+    def __init__(self, name, error=None, stats=None):
         self.name = name
         self.error = None
         if error:
             self.error = repr(error)
+        # Payloads waiting to be sent, and dropped, for emitters sending in the background
+        self.stats = stats
 
     @property
     def status(self):
@@ -415,6 +420,11 @@ class CollectorStatus(AgentStatus):
                     cs.service_check_count, plural(cs.service_check_count)),
             ]
 
+            if cs.run_time is not None:
+                check_lines += [
+                    "    - Waited %.2fs for a worker, ran for %.2fs" % (cs.queue_time or 0, cs.run_time),
+                ]
+
             if cs.check_stats is not None:
                 check_lines += [
                     "    - Stats: %s" % pretty_statistics(cs.check_stats)
@@ -560,6 +570,11 @@ class CollectorStatus(AgentStatus):
                             cs.service_check_count, plural(cs.service_check_count)),
                     ]
 
+                    if cs.run_time is not None:
+                        check_lines += [
+                            "    - Waited %.2fs for a worker, ran for %.2fs" % (cs.queue_time or 0, cs.run_time),
+                        ]
+
                     if cs.check_stats is not None:
                         check_lines += [
                             "    - Stats: %s" % pretty_statistics(cs.check_stats)
@@ -628,6 +643,8 @@ class CollectorStatus(AgentStatus):
                 line = "  - %s [%s]" % (es.name, style(es.status, c))
                 if es.status != STATUS_OK:
                     line += ": %s" % es.error
+                if es.stats is not None:
+                    line += " (%s queued, %s dropped)" % (es.stats['queue_depth'], es.stats['dropped'])
                 lines.append(line)
 
         return lines
@@ -675,6 +692,8 @@ class CollectorStatus(AgentStatus):
                 status_info['checks'][cs.name]['metric_count'] = cs.metric_count
                 status_info['checks'][cs.name]['event_count'] = cs.event_count
                 status_info['checks'][cs.name]['service_check_count'] = cs.service_check_count
+                status_info['checks'][cs.name]['queue_time'] = cs.queue_time
+                status_info['checks'][cs.name]['run_time'] = cs.run_time
 
         # Emitter status
         status_info['emitter'] = []
@@ -686,6 +705,8 @@ class CollectorStatus(AgentStatus):
             }
             if es.has_error():
                 check_status['error'] = es.error
+            if es.stats is not None:
+                check_status.update(es.stats)
             status_info['emitter'].append(check_status)
 
         osname = config.get_os()
@@ -720,7 +741,9 @@ class DogstatsdStatus(AgentStatus):
     NAME = 'Dogstatsd'
 
     def __init__(self, flush_count=0, packet_count=0, packets_per_second=0,
-                 metric_count=0, event_count=0, service_check_count=0):
+                 metric_count=0, event_count=0, service_check_count=0,
+                 context_cache_hits=0, context_cache_misses=0, context_cache_evictions=0,
+                 post_latencies=None):
         AgentStatus.__init__(self)
         self.flush_count = flush_count
         self.packet_count = packet_count
@@ -728,6 +751,19 @@ class DogstatsdStatus(AgentStatus):
         self.metric_count = metric_count
         self.event_count = event_count
         self.service_check_count = service_check_count
+        # Over the last flush interval
+        self.context_cache_hits = context_cache_hits
+        self.context_cache_misses = context_cache_misses
+        self.context_cache_evictions = context_cache_evictions
+        # Endpoint -> summary of the post durations of the last flush, in ms
+        self.post_latencies = post_latencies or {}
+
+    @property
+    def context_cache_hit_rate(self):
+        lookups = self.context_cache_hits + self.context_cache_misses
+        if not lookups:
+            return 0
+        return round(100.0 * self.context_cache_hits / lookups, 2)
 
     def has_error(self):
         return self.flush_count == 0 and self.packet_count == 0 and self.metric_count == 0
@@ -740,7 +776,14 @@ class DogstatsdStatus(AgentStatus):
             "Metric count: %s" % self.metric_count,
             "Event count: %s" % self.event_count,
             "Service check count: %s" % self.service_check_count,
+            "Context cache: %s hits, %s misses, %s evictions (%s%% hit rate)" % (
+                self.context_cache_hits, self.context_cache_misses,
+                self.context_cache_evictions, self.context_cache_hit_rate),
         ]
+        for endpoint, latency in sorted(self.post_latencies.items()):
+            lines.append("POST %s: %s requests, avg %sms, median %sms, 95th percentile %sms, max %sms" % (
+                endpoint, latency['count'], latency['avg'], latency['median'],
+                latency['95percentile'], latency['max']))
         return lines
 
     def to_dict(self):
@@ -752,6 +795,11 @@ class DogstatsdStatus(AgentStatus):
             'metric_count': self.metric_count,
             'event_count': self.event_count,
             'service_check_count': self.service_check_count,
+            'context_cache_hits': self.context_cache_hits,
+            'context_cache_misses': self.context_cache_misses,
+            'context_cache_evictions': self.context_cache_evictions,
+            'context_cache_hit_rate': self.context_cache_hit_rate,
+            'post_latencies': self.post_latencies,
         })
         return status_info
 
@@ -761,7 +809,9 @@ class ForwarderStatus(AgentStatus):
     NAME = 'Forwarder'
 
     def __init__(self, queue_length=0, queue_size=0, flush_count=0, transactions_received=0,
-                 transactions_flushed=0, too_big_count=0):
+                 transactions_flushed=0, too_big_count=0, spool_size=None, spool_dropped=None,
+                 drain_rate=None,
+                 time_to_empty=None, sources=None, connections=None, emitters=None, graphite=None):
         AgentStatus.__init__(self)
         self.queue_length = queue_length
         self.queue_size = queue_size
@@ -771,6 +821,21 @@ class ForwarderStatus(AgentStatus):
         self.hidden_username = None
         self.hidden_password = None
         self.too_big_count = too_big_count
+        # None when the forwarder doesn't spool its transactions to disk
+        self.spool_size = spool_size
+        # Spooled records lost when the spool grew over its maximum size
+        self.spool_dropped = spool_dropped
+        # Transactions commited per second, and seconds to send the backlog at that rate
+        self.drain_rate = drain_rate
+        self.time_to_empty = time_to_empty
+        # Payloads received and flushed, by source
+        self.sources = sources or {}
+        # Connections opened to the endpoints, and reused for later requests
+        self.connections = connections
+        # Queue depth, payloads handled and dropped, and latency, by custom emitter
+        self.emitters = emitters or {}
+        # Graphite points received, invalid and dropped, None without the listener
+        self.graphite = graphite
 
     def body_lines(self):
         lines = [
@@ -780,8 +845,31 @@ class ForwarderStatus(AgentStatus):
             "Transactions received: %s" % self.transactions_received,
             "Transactions flushed: %s" % self.transactions_flushed,
             "Transactions rejected: %s" % self.too_big_count,
-            ""
         ]
+        if self.spool_size is not None:
+            lines.append("Spool Size: %s bytes" % self.spool_size)
+        if self.spool_dropped is not None:
+            lines.append("Spool dropped: %s transactions" % self.spool_dropped)
+        if self.drain_rate is not None:
+            lines.append("Drain rate: %.2f transactions/s" % self.drain_rate)
+        if self.time_to_empty is not None:
+            lines.append("Time to empty: %ss" % self.time_to_empty)
+        if self.connections is not None:
+            lines.append("Connections: %s opened, %s reused" % (
+                self.connections['connections_opened'], self.connections['connections_reused']))
+        for name, stats in sorted(self.emitters.iteritems()):
+            latency = "%.3fs avg, %.3fs max" % (stats['latency_avg'], stats['latency_max']) \
+                if stats['latency_avg'] is not None else "none yet"
+            lines.append("Emitter %s: %s queued, %s handled, %s dropped, latency %s" % (
+                name, stats['queue_depth'], stats['handled'], stats['dropped'], latency))
+        if self.graphite is not None:
+            lines.append("Graphite points: %s received, %s invalid, %s dropped" % (
+                self.graphite['received'], self.graphite['invalid'], self.graphite['dropped']))
+        if self.sources:
+            lines.append("Payloads by source:")
+            for source, counts in sorted(self.sources.iteritems()):
+                lines.append("  %s: %s received, %s flushed" % (source, counts['received'], counts['flushed']))
+        lines.append("")
 
         return lines
 
@@ -796,7 +884,15 @@ class ForwarderStatus(AgentStatus):
             'queue_size': self.queue_size,
             'too_big_count': self.too_big_count,
             'transactions_received': self.transactions_received,
-            'transactions_flushed': self.transactions_flushed
+            'transactions_flushed': self.transactions_flushed,
+            'spool_size': self.spool_size,
+            'spool_dropped': self.spool_dropped,
+            'drain_rate': self.drain_rate,
+            'time_to_empty': self.time_to_empty,
+            'sources': self.sources,
+            'connections': self.connections,
+            'emitters': self.emitters,
+            'graphite': self.graphite,
         })
         return status_info
 
@@ -19,12 +19,12 @@ from checks.check_status import (
     CheckStatus,
     CollectorStatus,
     EmitterStatus,
-    STATUS_ERROR,
-    STATUS_OK,
 )
 from checks.ganglia import Ganglia
+from checks.scheduler import CheckRunner
 from checks.server_density import plugins, yoshi
 from config import get_system_stats, get_version
+from emitter import flush as flush_http_emitter
 import checks.system.unix as u
 import checks.system.win32 as w32
 import modules
@@ -46,6 +46,8 @@ log = logging.getLogger(__name__)
 FLUSH_LOGGING_PERIOD = 10
 FLUSH_LOGGING_INITIAL = 5
 DD_CHECK_TAG = 'dd_check:{0}'
+# Time to send the payloads still held by the emitters when exiting
+EMITTER_FLUSH_TIMEOUT = 5
 
 # Description of the format of the `processes` resource check, identical to the legacy check.
 # Sent on the first run of the collector, on subsequent runs the resources payload is sent w/o this desc.
@@ -62,6 +64,18 @@ PROCESSES_FORMAT_DESCRIPTION = [
 ]
 
 
+def _emitter_stats(emitter):
+    """ Queue depth and drops of the emitters sending in the background, None for the others """
+    stats = getattr(emitter, 'stats', None)
+    if stats is None:
+        return None
+    try:
+        return stats()
+    except Exception:
+        log.exception("Unable to get the stats of emitter %s" % emitter.__name__)
+        return None
+
+
 class AgentPayload(collections.MutableMapping):
     """
     AgentPayload offers a single payload interface but manages two payloads:
@@ -145,14 +159,14 @@ class AgentPayload(collections.MutableMapping):
                 if not continue_running:
                     return statuses
                 name = emitter.__name__
-                emitter_status = EmitterStatus(name)
+                error = None
                 try:
                     emitter(payload, log, config, endpoint)
                 except Exception, e:
                     log.exception("Error running emitter: %s"
                                   % emitter.__name__)
-                    emitter_status = EmitterStatus(name, e)
-                statuses.append(emitter_status)
+                    error = e
+                statuses.append(EmitterStatus(name, error, _emitter_stats(emitter)))
             return statuses
 
         if merge_payloads:
@@ -204,6 +218,9 @@ class Collector(object):
         self.hostname_metadata_cache = None
         self.initialized_checks_d = []
         self.init_failed_checks_d = {}
+        self.check_runner = CheckRunner(hostname, agentConfig.get('check_workers'),
+                                        agentConfig.get('check_timeout'))
+        self._check_statuses = {}
 
         # Unix System Checks
         self._unix_system_checks = {
@@ -263,15 +280,27 @@ class Collector(object):
         self.continue_running = False
         for check in self.initialized_checks_d:
             check.stop()
+        self.check_runner.stop()
+
+    def flush_emitters(self, timeout=EMITTER_FLUSH_TIMEOUT):
+        """
+        Wait at most `timeout` seconds for the payloads the emitters still
+        hold to be sent, before the process exits. The last ones are handed
+        over to the forwarder if the intake doesn't take them right away.
+        """
+        if not flush_http_emitter(timeout):
+            log.warning("Some payloads couldn't be sent in %ss, exiting anyway" % timeout)
 
     @staticmethod
     def _stats_for_display(raw_stats):
         return pprint.pformat(raw_stats, indent=4)
 
     @log_exceptions(log)
-    def run(self, checksd=None, start_event=True, configs_reloaded=False):
+    def run(self, checksd=None, start_event=True, configs_reloaded=False, check_jobs=None):
         """
         Collect data from each check and submit their data.
+        The checks.d checks are all run, unless `check_jobs` are given: the
+        checks that ran on their own schedule since the last run.
         """
         log.debug("Found {num_checks} checks".format(num_checks=len(checksd['initialized_checks'])))
         timer = Timer()
@@ -298,6 +327,10 @@ class Collector(object):
         # Initialize payload
         self._build_payload(payload)
 
+        # The checks.d checks run on the workers along with the system checks
+        if check_jobs is None:
+            check_jobs = self.check_runner.submit(self.initialized_checks_d)
+
         metrics = payload['metrics']
         events = payload['events']
         service_checks = payload['service_checks']
@@ -422,81 +455,44 @@ class Collector(object):
             if res:
                 metrics.extend(res)
 
-        # checks.d checks
-        check_statuses = []
-        for check in self.initialized_checks_d:
-            if not self.continue_running:
-                return
-            log.info("Running check %s" % check.name)
-            instance_statuses = []
-            metric_count = 0
-            event_count = 0
-            service_check_count = 0
-            check_start_time = time.time()
-            check_stats = None
-
-            try:
-                # Run the check.
-                instance_statuses = check.run()
-
-                # Collect the metrics and events.
-                current_check_metrics = check.get_metrics()
-                current_check_events = check.get_events()
-                check_stats = check._get_internal_profiling_stats()
-
-                # Collect metadata
-                current_check_metadata = check.get_service_metadata()
-
-                # Save metrics & events for the payload.
-                metrics.extend(current_check_metrics)
-                if current_check_events:
-                    if check.name not in events:
-                        events[check.name] = current_check_events
-                    else:
-                        events[check.name] += current_check_events
-
-                # Save the status of the check.
-                metric_count = len(current_check_metrics)
-                event_count = len(current_check_events)
+        # checks.d checks, run by the workers in the meantime
+        jobs = self.check_runner.collect(check_jobs, lambda: self.continue_running)
+        if jobs is None:
+            return
+        for job in jobs:
+            if not job.collected:
+                check_status, service_check = job.timeout_results()
+                self._check_statuses[job.check] = check_status
+                service_checks.append(service_check)
+                continue
 
-            except Exception:
-                log.exception("Error running check %s" % check.name)
-
-            check_status = CheckStatus(
-                check.name, instance_statuses, metric_count,
-                event_count, service_check_count, service_metadata=current_check_metadata,
-                library_versions=check.get_library_info(),
-                source_type_name=check.SOURCE_TYPE_NAME or check.name,
-                check_stats=check_stats
-            )
-
-            # Service check for Agent checks failures
-            service_check_tags = ["check:%s" % check.name]
-            if check_status.status == STATUS_OK:
-                status = AgentCheck.OK
-            elif check_status.status == STATUS_ERROR:
-                status = AgentCheck.CRITICAL
-            check.service_check('sd.agent.check_status', status, tags=service_check_tags)
-
-            # Collect the service checks and save them in the payload
-            current_check_service_checks = check.get_service_checks()
-            if current_check_service_checks:
-                service_checks.extend(current_check_service_checks)
-            service_check_count = len(current_check_service_checks)
-
-            # Update the check status with the correct service_check_count
-            check_status.service_check_count = service_check_count
-            check_statuses.append(check_status)
+            # Save metrics & events for the payload.
+            check = job.check
+            metrics.extend(job.metrics)
+            if job.events:
+                if check.name not in events:
+                    events[check.name] = job.events
+                else:
+                    events[check.name] += job.events
+            service_checks.extend(job.service_checks)
 
-            check_run_time = time.time() - check_start_time
-            log.debug("Check %s ran in %.2f s" % (check.name, check_run_time))
+            check_status = job.check_status
+            check_status.queue_time = job.queue_time
+            check_status.run_time = job.run_time
+            self._check_statuses[check] = check_status
+            log.debug("Check %s waited %.2f s and ran in %.2f s" % (check.name, job.queue_time, job.run_time))
 
             # Intrument check run timings if enabled.
             if self.check_timings:
                 metric = 'sd.agent.check_run_time'
                 meta = {'tags': ["check:%s" % check.name]}
-                metrics.append((metric, time.time(), check_run_time, meta))
+                metrics.append((metric, time.time(), job.run_time, meta))
 
+        # Latest status of every check, even the ones that didn't run this time
+        self._check_statuses = dict((check, self._check_statuses[check]) for check in self.initialized_checks_d
+                                    if check in self._check_statuses)
+        check_statuses = [self._check_statuses[check] for check in self.initialized_checks_d
+                          if check in self._check_statuses]
         for check_name, info in self.init_failed_checks_d.iteritems():
             if not self.continue_running:
                 return
@@ -614,13 +610,13 @@ class Collector(object):
             if not self.continue_running:
                 return statuses
             name = emitter.__name__
-            emitter_status = EmitterStatus(name)
+            error = None
             try:
                 emitter(payload, log, self.agentConfig)
             except Exception, e:
                 log.exception("Error running emitter: %s" % emitter.__name__)
-                emitter_status = EmitterStatus(name, e)
-            statuses.append(emitter_status)
+                error = e
+            statuses.append(EmitterStatus(name, error, _emitter_stats(emitter)))
         return statuses
 
     def _is_first_run(self):
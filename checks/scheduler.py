@@ -0,0 +1,319 @@
+# (C) Datadog, Inc. 2010-2016
+# All rights reserved
+# Licensed under Simplified BSD License (see LICENSE)
+
+# stdlib
+import heapq
+import logging
+from Queue import Queue
+import random
+import threading
+import time
+
+# project
+from checks import AGENT_METRICS_CHECK_NAME, AgentCheck, create_service_check
+from checks.check_status import (
+    CheckStatus,
+    InstanceStatus,
+    STATUS_ERROR,
+    STATUS_OK,
+)
+
+log = logging.getLogger(__name__)
+
+# Checks running at once at most
+CHECK_WORKERS = 4
+# Seconds the collector waits for a check once it started
+CHECK_TIMEOUT = 60
+# Seconds between two looks at `continue_running` while waiting for checks
+POLL_INTERVAL = 1
+
+
+class CheckJob(object):
+    """
+    A run of a checks.d check on a worker, and what it collected: everything
+    is read from the check on the worker, the collector never touches a
+    check that may still be running.
+    """
+
+    def __init__(self, check, hostname, timeout):
+        self.check = check
+        self.hostname = hostname
+        self.timeout = timeout
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.timed_out = False
+        # Whether it was done when the collector last looked at it
+        self.collected = False
+
+        self.metrics = []
+        self.events = []
+        self.service_checks = []
+        self.check_status = None
+
+    @property
+    def queue_time(self):
+        if self.started_at is None:
+            return None
+        return self.started_at - self.queued_at
+
+    @property
+    def run_time(self):
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def run(self):
+        check = self.check
+        log.info("Running check %s" % check.name)
+        instance_statuses = []
+        current_check_metadata = []
+        check_stats = None
+
+        try:
+            instance_statuses = check.run()
+            self.metrics = check.get_metrics()
+            self.events = check.get_events()
+            check_stats = check._get_internal_profiling_stats()
+            current_check_metadata = check.get_service_metadata()
+        except Exception:
+            log.exception("Error running check %s" % check.name)
+
+        check_status = CheckStatus(
+            check.name, instance_statuses, len(self.metrics),
+            len(self.events), service_metadata=current_check_metadata,
+            library_versions=check.get_library_info(),
+            source_type_name=check.SOURCE_TYPE_NAME or check.name,
+            check_stats=check_stats
+        )
+
+        # Service check for Agent checks failures
+        service_check_tags = ["check:%s" % check.name]
+        if check_status.status == STATUS_OK:
+            status = AgentCheck.OK
+        elif check_status.status == STATUS_ERROR:
+            status = AgentCheck.CRITICAL
+        check.service_check('sd.agent.check_status', status, tags=service_check_tags)
+
+        self.service_checks = check.get_service_checks()
+        check_status.service_check_count = len(self.service_checks)
+        self.check_status = check_status
+
+    def timeout_results(self):
+        """ Status and service check of a check that didn't finish in time """
+        error = "Check didn't finish within %ss, its results will be sent with the next run" % self.timeout
+        check_status = CheckStatus(
+            self.check.name, [InstanceStatus(0, STATUS_ERROR, error=error)],
+            service_metadata=[{}], source_type_name=self.check.SOURCE_TYPE_NAME or self.check.name,
+            queue_time=self.queue_time, run_time=time.time() - self.started_at
+        )
+        service_check = create_service_check('sd.agent.check_status', AgentCheck.CRITICAL,
+                                             tags=["check:%s" % self.check.name],
+                                             hostname=self.hostname, message=error)
+        return check_status, service_check
+
+
+class CheckRunner(object):
+    """
+    Runs checks.d checks concurrently, on at most `max_workers` threads.
+
+    The collector waits at most `timeout` seconds for a check once it
+    started, or the `check_timeout` of its init_config. A check that
+    doesn't finish in time keeps its thread, which is replaced in the pool,
+    and isn't run again before it's done: what it collected is returned by
+    the next run instead.
+    """
+
+    def __init__(self, hostname, max_workers=None, timeout=None):
+        self.hostname = hostname
+        self.max_workers = max_workers or CHECK_WORKERS
+        self.timeout = timeout or CHECK_TIMEOUT
+        self._queue = Queue()
+        self._condition = threading.Condition()
+        # Jobs of the checks that didn't finish in time, by check
+        self._late = {}
+        self._workers = 0
+
+    def _start_worker(self):
+        self._workers += 1
+        worker = threading.Thread(target=self._work, name="check-worker-%s" % self._workers)
+        worker.daemon = True
+        worker.start()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            with self._condition:
+                job.started_at = time.time()
+                # Its timeout starts now
+                self._condition.notify_all()
+            try:
+                job.run()
+            except Exception:
+                log.exception("Error running check %s" % job.check.name)
+            with self._condition:
+                job.finished_at = time.time()
+                self._condition.notify_all()
+                if job.timed_out:
+                    # Already replaced in the pool
+                    return
+
+    def submit(self, checks):
+        """ Queue a run of `checks`, return the jobs to `collect` """
+        with self._condition:
+            while self._workers < self.max_workers:
+                self._start_worker()
+            jobs = []
+            for check in checks:
+                late = self._late.get(check)
+                if late is not None:
+                    jobs.append(late)
+                    continue
+                timeout = self.timeout
+                if isinstance(check.init_config, dict) and check.init_config.get('check_timeout'):
+                    timeout = float(check.init_config['check_timeout'])
+                job = CheckJob(check, self.hostname, timeout)
+                self._queue.put(job)
+                jobs.append(job)
+            return jobs
+
+    def _expire(self, jobs, now):
+        """
+        Give up on the jobs running for too long, return the number of
+        seconds until the next one would expire
+        """
+        next_expiry = POLL_INTERVAL
+        for job in jobs:
+            if job.finished_at is not None or job.started_at is None or job.timed_out:
+                continue
+            remaining = job.started_at + job.timeout - now
+            if remaining > 0:
+                next_expiry = min(next_expiry, remaining)
+                continue
+            log.warning("Check %s is still running after %ss, not waiting for it" % (job.check.name, job.timeout))
+            job.timed_out = True
+            self._late[job.check] = job
+            # Its worker leaves the pool once the check is done
+            self._workers -= 1
+            self._start_worker()
+        return next_expiry
+
+    def collect(self, jobs, continue_running=None):
+        """
+        Wait for `jobs` to finish or time out, return them in the same order,
+        or None if `continue_running` returned False in the meantime.
+        Jobs are `collected` if they were done, their results are returned
+        only once.
+        """
+        with self._condition:
+            while True:
+                if continue_running is not None and not continue_running():
+                    return None
+                next_expiry = self._expire(jobs, time.time())
+                if all(job.finished_at is not None or job.timed_out for job in jobs):
+                    break
+                self._condition.wait(next_expiry)
+
+            for job in jobs:
+                job.collected = job.finished_at is not None
+                if job.collected:
+                    self._late.pop(job.check, None)
+            return jobs
+
+    def ready(self, jobs):
+        """
+        Split `jobs` into the ones done or timed out, and the ones still
+        waiting for a worker or running
+        """
+        with self._condition:
+            self._expire(jobs, time.time())
+            ready = [job for job in jobs if job.finished_at is not None or job.timed_out]
+            pending = [job for job in jobs if job.finished_at is None and not job.timed_out]
+        return ready, pending
+
+    def stop(self):
+        with self._condition:
+            for _ in xrange(self._workers):
+                self._queue.put(None)
+            self._workers = 0
+
+
+class CheckScheduler(object):
+    """
+    Runs each checks.d check on its own interval: the shortest
+    `min_collection_interval` of its instances, or `default_interval`.
+
+    Checks are kept in a heap by the time their next run is due. The first
+    run of a check happens at a random time within its interval, or within
+    `default_interval` if that's shorter, so that they don't all wake up at
+    once. The next runs are due one interval after the previous one was due,
+    however long it took. A check that is still running when it's due again
+    skips that run, and runs missed while the agent was busy aren't caught up.
+    """
+
+    def __init__(self, runner, default_interval):
+        self.runner = runner
+        self.default_interval = default_interval
+        # [due time, position of the check, interval, check]
+        self._heap = []
+        # Position of the checks, to return their results in order
+        self._positions = {}
+        # Jobs submitted and not returned by `ready_jobs` yet
+        self._jobs = []
+
+    def interval(self, check):
+        intervals = []
+        for instance in check.instances or [{}]:
+            if not isinstance(instance, dict):
+                instance = {}
+            intervals.append(instance.get('min_collection_interval', (check.init_config or {}).get(
+                'min_collection_interval', check.DEFAULT_MIN_COLLECTION_INTERVAL)))
+        return float(min(intervals)) or self.default_interval
+
+    def schedule(self, checks, now=None):
+        """ Replace the checks to run """
+        now = now or time.time()
+        self._heap = []
+        self._positions = {}
+        for position, check in enumerate(checks):
+            if check.name == AGENT_METRICS_CHECK_NAME:
+                continue
+            interval = self.interval(check)
+            self._positions[check] = position
+            first_run = now + random.uniform(0, min(interval, self.default_interval))
+            self._heap.append([first_run, position, interval, check])
+            log.debug("Running check %s every %ss" % (check.name, interval))
+        heapq.heapify(self._heap)
+
+    def run_due(self, now=None):
+        """ Submit the checks that are due, return when the next one will be """
+        now = now or time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            scheduled, _, interval, check = entry
+            missed = int((now - scheduled) // interval)
+            if missed:
+                log.warning("Check %s is %.2fs late, skipping %s of its runs" % (check.name, now - scheduled, missed))
+            entry[0] = scheduled + (missed + 1) * interval
+            heapq.heappush(self._heap, entry)
+
+            if any(job.check is check and job.finished_at is None and not job.timed_out for job in self._jobs):
+                log.warning("Check %s is still running, skipping this run" % check.name)
+                continue
+            due.append(check)
+
+        for job in self.runner.submit(due):
+            # A check that timed out comes back as the same job until it's done
+            if job not in self._jobs:
+                self._jobs.append(job)
+        return self._heap[0][0] if self._heap else None
+
+    def ready_jobs(self):
+        """ Jobs done or timed out since the last call, in the order of the checks """
+        ready, self._jobs = self.runner.ready(self._jobs)
+        ready.sort(key=lambda job: self._positions.get(job.check, len(self._positions)))
+        return ready
@@ -23,9 +23,15 @@ except ImportError:
 from checks import Check
 from util import get_hostname
 from utils.platform import Platform
+from utils.procfs import CpuSampler, DiskSampler, ProcessTable
 from utils.subprocess_output import get_subprocess_output
 
 
+# Runs between two full process tables in delta mode
+PROCESSES_FULL_RUNS = 10
+# Processes sent by CPU and by memory usage in top mode
+PROCESSES_TOP = 50
+
 # locale-resilient float converter
 to_float = lambda s: float(s.replace(",", "."))
 
@@ -37,6 +43,7 @@ class IO(Check):
         self.header_re = re.compile(r'([%\\/\-_a-zA-Z0-9]+)[\s+]?')
         self.item_re = re.compile(r'^([\-a-zA-Z0-9\/]+)')
         self.value_re = re.compile(r'\d+\.\d+')
+        self._disk_sampler = DiskSampler()
 
     def _parse_linux2(self, output):
         recentStats = output.split('Device:')[2].split('\n')
@@ -119,24 +126,9 @@ class IO(Check):
         io = {}
         try:
             if Platform.is_linux():
-                stdout, _, _ = get_subprocess_output(['iostat', '-d', '1', '2', '-x', '-k'], self.logger)
-
-                #                 Linux 2.6.32-343-ec2 (ip-10-35-95-10)   12/11/2012      _x86_64_        (2 CPU)
-                #
-                # Device:         rrqm/s   wrqm/s     r/s     w/s    rkB/s    wkB/s avgrq-sz avgqu-sz   await  svctm  %util
-                # sda1              0.00    17.61    0.26   32.63     4.23   201.04    12.48     0.16    4.81   0.53   1.73
-                # sdb               0.00     2.68    0.19    3.84     5.79    26.07    15.82     0.02    4.93   0.22   0.09
-                # sdg               0.00     0.13    2.29    3.84   100.53    30.61    42.78     0.05    8.41   0.88   0.54
-                # sdf               0.00     0.13    2.30    3.84   100.54    30.61    42.78     0.06    9.12   0.90   0.55
-                # md0               0.00     0.00    0.05    3.37     1.41    30.01    18.35     0.00    0.00   0.00   0.00
-                #
-                # Device:         rrqm/s   wrqm/s     r/s     w/s    rkB/s    wkB/s avgrq-sz avgqu-sz   await  svctm  %util
-                # sda1              0.00     0.00    0.00   10.89     0.00    43.56     8.00     0.03    2.73   2.73   2.97
-                # sdb               0.00     0.00    0.00    2.97     0.00    11.88     8.00     0.00    0.00   0.00   0.00
-                # sdg               0.00     0.00    0.00    0.00     0.00     0.00     0.00     0.00    0.00   0.00   0.00
-                # sdf               0.00     0.00    0.00    0.00     0.00     0.00     0.00     0.00    0.00   0.00   0.00
-                # md0               0.00     0.00    0.00    0.00     0.00     0.00     0.00     0.00    0.00   0.00   0.00
-                io.update(self._parse_linux2(stdout))
+                # Since the previous run, from the counters of /proc/diskstats,
+                # in the format of `iostat -d -x -k`
+                io.update(self._disk_sampler.sample())
 
             elif sys.platform == "sunos5":
                 output, _, _ = get_subprocess_output(["iostat", "-x", "-d", "1", "2"], self.logger)
@@ -537,20 +529,34 @@ class Memory(Check):
 
 
 class Processes(Check):
+    """
+    The process table, in the columns of `ps aux`.
+
+    `processes_mode` sets what is sent:
+    - full: every process, every run
+    - delta: the processes that started or changed since the previous run,
+      and the pids of the ones that exited. Every process is sent again
+      every `PROCESSES_FULL_RUNS` runs.
+    - top: the `processes_top` processes using the most CPU, and the ones
+      using the most memory
+    """
 
-    def check(self, agentConfig):
+    def __init__(self, logger):
+        Check.__init__(self, logger)
+        self._process_table = ProcessTable()
+        # Rows sent by pid, and runs since every process was sent, in delta mode
+        self._sent = None
+        self._delta_runs = 0
+
+    def _ps(self, agentConfig):
         process_exclude_args = agentConfig.get('exclude_process_args', False)
         if process_exclude_args:
             ps_arg = 'aux'
         else:
             ps_arg = 'auxww'
         # Get output from ps
-        try:
-            output, _, _ = get_subprocess_output(['ps', ps_arg], self.logger)
-            processLines = output.splitlines()  # Also removes a trailing empty line
-        except StandardError:
-            self.logger.exception('getProcesses')
-            return False
+        output, _, _ = get_subprocess_output(['ps', ps_arg], self.logger)
+        processLines = output.splitlines()  # Also removes a trailing empty line
 
         del processLines[0]  # Removes the headers
 
@@ -559,14 +565,58 @@ class Processes(Check):
         for line in processLines:
             line = line.split(None, 10)
             processes.append(map(lambda s: s.strip(), line))
+        return processes
+
+    def _delta(self, processes, result):
+        rows = dict((row[1], row) for row in processes)
+        self._delta_runs += 1
+        if self._sent is None or self._delta_runs >= PROCESSES_FULL_RUNS:
+            self._sent = rows
+            self._delta_runs = 0
+            return result
+
+        result['processes'] = [row for row in processes if self._sent.get(row[1]) != row]
+        result['exitedPids'] = [pid for pid in self._sent if pid not in rows]
+        result['delta'] = True
+        self._sent = rows
+        return result
+
+    def _top(self, processes, count, result):
+        top_cpu = sorted(processes, key=lambda row: float(row[2]), reverse=True)[:count]
+        top_mem = sorted(processes, key=lambda row: int(row[5]), reverse=True)[:count]
+        top = dict((row[1], row) for row in top_cpu + top_mem)
+        result['processes'] = sorted(top.itervalues(), key=lambda row: int(row[1]))
+        result['processCount'] = len(processes)
+        return result
 
-        return {'processes':   processes,
-                'agentKey':    agentConfig['agent_key'],
-                'host':        get_hostname(agentConfig)}
+    def check(self, agentConfig):
+        try:
+            if Platform.is_linux():
+                processes = self._process_table.read(agentConfig.get('exclude_process_args', False))
+            else:
+                processes = self._ps(agentConfig)
+        except StandardError:
+            self.logger.exception('getProcesses')
+            return False
+
+        result = {'processes':   processes,
+                  'agentKey':    agentConfig['agent_key'],
+                  'host':        get_hostname(agentConfig)}
+
+        mode = agentConfig.get('processes_mode') or 'full'
+        if mode == 'delta':
+            return self._delta(processes, result)
+        elif mode == 'top':
+            return self._top(processes, agentConfig.get('processes_top') or PROCESSES_TOP, result)
+        return result
 
 
 class Cpu(Check):
 
+    def __init__(self, logger):
+        Check.__init__(self, logger)
+        self._cpu_sampler = CpuSampler()
+
     def check(self, agentConfig):
         """Return an aggregate of CPU stats across all CPUs
         When figures are not available, False is sent back.
@@ -590,63 +640,14 @@ class Cpu(Check):
                 return 0.0
         try:
             if Platform.is_linux():
-                output, _, _ = get_subprocess_output(['mpstat', '1', '3'], self.logger)
-                mpstat = output.splitlines()
-                # topdog@ip:~$ mpstat 1 3
-                # Linux 2.6.32-341-ec2 (ip)   01/19/2012  _x86_64_  (2 CPU)
-                #
-                # 04:22:41 PM  CPU    %usr   %nice    %sys %iowait    %irq   %soft  %steal  %guest   %idle
-                # 04:22:42 PM  all    0.00    0.00    0.00    0.00    0.00    0.00    0.00    0.00  100.00
-                # 04:22:43 PM  all    0.00    0.00    0.00    0.00    0.00    0.00    0.00    0.00  100.00
-                # 04:22:44 PM  all    0.00    0.00    0.00    0.00    0.00    0.00    0.00    0.00  100.00
-                # Average:     all    0.00    0.00    0.00    0.00    0.00    0.00    0.00    0.00  100.00
-                #
-                # OR
-                #
-                # Thanks to Mart Visser to spotting this one.
-                # blah:/etc/sd-agent# mpstat
-                # Linux 2.6.26-2-xen-amd64 (atira)  02/17/2012  _x86_64_
-                #
-                # 05:27:03 PM  CPU    %user   %nice   %sys %iowait    %irq   %soft  %steal  %idle   intr/s
-                # 05:27:03 PM  all    3.59    0.00    0.68    0.69    0.00   0.00    0.01   95.03    43.65
-                #
-                legend = [l for l in mpstat if "%usr" in l or "%user" in l]
-                avg = [l for l in mpstat if "Average" in l]
-                if len(legend) == 1 and len(avg) == 1:
-                    headers = [h for h in legend[0].split() if h not in ("AM", "PM")]
-                    data = avg[0].split()
-
-                    # Userland
-                    # Debian lenny says %user so we look for both
-                    # One of them will be 0
-                    cpu_metrics = {
-                        "%usr": None, "%user": None, "%nice": None,
-                        "%iowait": None, "%idle": None, "%sys": None,
-                        "%irq": None, "%soft": None, "%steal": None,
-                        "%guest": None
-                    }
-
-                    for cpu_m in cpu_metrics:
-                        cpu_metrics[cpu_m] = get_value(headers, data, cpu_m, filter_value=110)
-
-                    if any([v is None for v in cpu_metrics.values()]):
-                        self.logger.warning("Invalid mpstat data: %s" % data)
-
-                    cpu_user = cpu_metrics["%usr"] + cpu_metrics["%user"] + cpu_metrics["%nice"]
-                    cpu_system = cpu_metrics["%sys"] + cpu_metrics["%irq"] + cpu_metrics["%soft"]
-                    cpu_wait = cpu_metrics["%iowait"]
-                    cpu_idle = cpu_metrics["%idle"]
-                    cpu_stolen = cpu_metrics["%steal"]
-                    cpu_guest = cpu_metrics["%guest"]
-
-                    return format_results(cpu_user,
-                                          cpu_system,
-                                          cpu_wait,
-                                          cpu_idle,
-                                          cpu_stolen,
-                                          cpu_guest)
-                else:
-                    return False
+                # Since the previous run, from the counters of /proc/stat
+                cpu = self._cpu_sampler.sample()['all']
+                return format_results(cpu['usr'] + cpu['nice'],
+                                      cpu['sys'] + cpu['irq'] + cpu['soft'],
+                                      cpu['iowait'],
+                                      cpu['idle'],
+                                      cpu['steal'],
+                                      cpu['guest'])
 
             elif sys.platform == 'darwin':
                 # generate 3 seconds of data
@@ -306,6 +306,36 @@ def get_histogram_percentiles(configstr=None):
     return result
 
 
+def get_histogram_backend(configstr=None):
+    if configstr is None:
+        return None
+
+    val = configstr.strip().lower()
+    valid_values = ['exact', 'sketch']
+    if val not in valid_values:
+        log.warning("Ignored histogram backend {0}, must be one of {1}"
+                    .format(val, ', '.join(valid_values)))
+        return None
+
+    return val
+
+
+def get_histogram_relative_accuracy(configstr=None):
+    if configstr is None:
+        return None
+
+    try:
+        val = float(configstr)
+        if val <= 0 or val >= 1:
+            raise ValueError
+    except ValueError:
+        log.warning("Bad histogram relative accuracy {0}, must be float in ]0;1[, skipping"
+                    .format(configstr))
+        return None
+
+    return val
+
+
 def get_config(parse_args=True, cfg_path=None, options=None):
     if parse_args:
         options, _ = get_parsed_args()
@@ -426,6 +456,14 @@ def get_config(parse_args=True, cfg_path=None, options=None):
             except Exception:
                 pass
 
+        # Checks run at once at most, and seconds the collector waits for each of them
+        agentConfig['check_workers'] = None
+        if config.has_option('Main', 'check_workers'):
+            agentConfig['check_workers'] = int(config.get('Main', 'check_workers'))
+        agentConfig['check_timeout'] = None
+        if config.has_option('Main', 'check_timeout'):
+            agentConfig['check_timeout'] = float(config.get('Main', 'check_timeout'))
+
         # Custom histogram aggregate/percentile metrics
         if config.has_option('Main', 'histogram_aggregates'):
             agentConfig['histogram_aggregates'] = get_histogram_aggregates(config.get('Main', 'histogram_aggregates'))
@@ -433,6 +471,13 @@ def get_config(parse_args=True, cfg_path=None, options=None):
         if config.has_option('Main', 'histogram_percentiles'):
             agentConfig['histogram_percentiles'] = get_histogram_percentiles(config.get('Main', 'histogram_percentiles'))
 
+        if config.has_option('Main', 'histogram_backend'):
+            agentConfig['histogram_backend'] = get_histogram_backend(config.get('Main', 'histogram_backend'))
+
+        if config.has_option('Main', 'histogram_relative_accuracy'):
+            agentConfig['histogram_relative_accuracy'] = get_histogram_relative_accuracy(
+                config.get('Main', 'histogram_relative_accuracy'))
+
         # Disable Watchdog (optionally)
         if config.has_option('Main', 'watchdog'):
             if config.get('Main', 'watchdog').lower() in ('no', 'false'):
@@ -444,6 +489,10 @@ def get_config(parse_args=True, cfg_path=None, options=None):
                 int(config.get('Main', 'graphite_listen_port'))
         else:
             agentConfig['graphite_listen_port'] = None
+        # Points held between two flushes of the graphite listener
+        agentConfig['graphite_max_points'] = None
+        if config.has_option('Main', 'graphite_max_points'):
+            agentConfig['graphite_max_points'] = int(config.get('Main', 'graphite_max_points'))
 
         # Dogstatsd config
         dogstatsd_defaults = {
@@ -466,6 +515,61 @@ def get_config(parse_args=True, cfg_path=None, options=None):
             if config.has_option('Main', 'statsd_forward_port'):
                 agentConfig['statsd_forward_port'] = int(config.get('Main', 'statsd_forward_port'))
 
+        # Receive dogstatsd packets on several processes sharing the port (SO_REUSEPORT)
+        agentConfig['dogstatsd_workers'] = 1
+        if config.has_option('Main', 'dogstatsd_workers'):
+            agentConfig['dogstatsd_workers'] = int(config.get('Main', 'dogstatsd_workers'))
+
+        # Datagrams read per wake-up of the dogstatsd server, and size of its socket buffer
+        agentConfig['dogstatsd_recv_batch_size'] = None
+        if config.has_option('Main', 'dogstatsd_recv_batch_size'):
+            agentConfig['dogstatsd_recv_batch_size'] = int(config.get('Main', 'dogstatsd_recv_batch_size'))
+        agentConfig['dogstatsd_so_rcvbuf'] = None
+        if config.has_option('Main', 'dogstatsd_so_rcvbuf'):
+            agentConfig['dogstatsd_so_rcvbuf'] = int(config.get('Main', 'dogstatsd_so_rcvbuf'))
+
+        # Number of series whose context dogstatsd keeps resolved
+        agentConfig['dogstatsd_context_cache_size'] = None
+        if config.has_option('Main', 'dogstatsd_context_cache_size'):
+            agentConfig['dogstatsd_context_cache_size'] = int(config.get('Main', 'dogstatsd_context_cache_size'))
+
+        # Maximum number of series posted by dogstatsd in a single payload
+        agentConfig['dogstatsd_series_chunk_size'] = None
+        if config.has_option('Main', 'dogstatsd_series_chunk_size'):
+            agentConfig['dogstatsd_series_chunk_size'] = int(config.get('Main', 'dogstatsd_series_chunk_size'))
+
+        # Connections dogstatsd keeps open to post its payloads concurrently
+        agentConfig['dogstatsd_http_pool_size'] = None
+        if config.has_option('Main', 'dogstatsd_http_pool_size'):
+            agentConfig['dogstatsd_http_pool_size'] = int(config.get('Main', 'dogstatsd_http_pool_size'))
+
+        # Keep the forwarder transactions on disk until they are sent
+        agentConfig['forwarder_spool_dir'] = None
+        if config.has_option('Main', 'forwarder_spool_dir'):
+            agentConfig['forwarder_spool_dir'] = config.get('Main', 'forwarder_spool_dir') or None
+        agentConfig['forwarder_spool_max_size'] = None
+        if config.has_option('Main', 'forwarder_spool_max_size'):
+            agentConfig['forwarder_spool_max_size'] = int(config.get('Main', 'forwarder_spool_max_size')) * 1024 * 1024
+        agentConfig['forwarder_spool_fsync'] = None
+        if config.has_option('Main', 'forwarder_spool_fsync'):
+            agentConfig['forwarder_spool_fsync'] = config.get('Main', 'forwarder_spool_fsync').strip().lower()
+
+        # Requests the forwarder sends at the same time, and connections it keeps alive
+        agentConfig['forwarder_max_connections'] = None
+        if config.has_option('Main', 'forwarder_max_connections'):
+            agentConfig['forwarder_max_connections'] = int(config.get('Main', 'forwarder_max_connections'))
+        agentConfig['forwarder_connection_idle_timeout'] = None
+        if config.has_option('Main', 'forwarder_connection_idle_timeout'):
+            agentConfig['forwarder_connection_idle_timeout'] = int(config.get('Main', 'forwarder_connection_idle_timeout'))
+
+        # Merge the payloads posted to the forwarder within that many milliseconds
+        agentConfig['forwarder_coalesce_window'] = None
+        if config.has_option('Main', 'forwarder_coalesce_window'):
+            agentConfig['forwarder_coalesce_window'] = int(config.get('Main', 'forwarder_coalesce_window'))
+        agentConfig['forwarder_coalesce_max_size'] = None
+        if config.has_option('Main', 'forwarder_coalesce_max_size'):
+            agentConfig['forwarder_coalesce_max_size'] = int(config.get('Main', 'forwarder_coalesce_max_size')) * 1024
+
         # optionally send dogstatsd data directly to the agent.
         if config.has_option('Main', 'dogstatsd_use_ddurl'):
             if _is_affirmative(config.get('Main', 'dogstatsd_use_ddurl')):
@@ -486,6 +590,10 @@ def get_config(parse_args=True, cfg_path=None, options=None):
 
         if config.has_option('Main', 'exclude_process_args'):
             agentConfig['exclude_process_args'] = _is_affirmative(config.get('Main', 'exclude_process_args'))
+        if config.has_option('Main', 'processes_mode'):
+            agentConfig['processes_mode'] = config.get('Main', 'processes_mode').strip().lower()
+        if config.has_option('Main', 'processes_top'):
+            agentConfig['processes_top'] = int(config.get('Main', 'processes_top'))
 
         try:
             filter_device_re = config.get('Main', 'device_blacklist_re')
@@ -496,12 +604,6 @@ def get_config(parse_args=True, cfg_path=None, options=None):
         if config.has_option("Main", "nagios_perf_cfg"):
             agentConfig["nagios_perf_cfg"] = config.get("Main", "nagios_perf_cfg")
 
-        if config.has_option("Main", "use_curl_http_client"):
-            agentConfig["use_curl_http_client"] = _is_affirmative(config.get("Main", "use_curl_http_client"))
-        else:
-            # Default to False as there are some issues with the curl client and ELB
-            agentConfig["use_curl_http_client"] = False
-
         if config.has_section('WMI'):
             agentConfig['WMI'] = {}
             for key, value in config.items('WMI'):
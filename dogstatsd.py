@@ -17,7 +17,9 @@ from utils.proxy import set_no_proxy_settings  # noqa
 set_no_proxy_settings()
 
 # stdlib
+import errno
 import logging
+import multiprocessing
 import optparse
 import os
 import select
@@ -27,14 +29,13 @@ import sys
 import threading
 from time import sleep, time
 from urllib import urlencode
-import zlib
+from urlparse import urlparse
 
 # For pickle & PID files, see issue 293
 os.umask(022)
 
 # 3rd party
 import requests
-import simplejson as json
 
 # project
 from aggregator import get_formatter, MetricsBucketAggregator
@@ -44,6 +45,7 @@ from config import get_config, get_version
 from daemon import AgentSupervisor, Daemon
 from util import chunks, get_hostname, get_uuid, plural
 from utils.pidfile import PidFile
+from utils.serialization import encode, encode_compressed
 
 # urllib3 logs a bunch of stuff at the info level
 requests_log = logging.getLogger("requests.packages.urllib3")
@@ -62,13 +64,26 @@ DOGSTATSD_AGGREGATOR_BUCKET_SIZE = 10
 
 WATCHDOG_TIMEOUT = 120
 UDP_SOCKET_TIMEOUT = 5
+# How long the reporter waits for a receiver process to hand over its shard
+SHARD_DRAIN_TIMEOUT = 5
+# Maximum number of datagrams read from the socket for each select call
+RECV_BATCH_SIZE = 64
+# Not exposed by the python 2 socket module, value from <asm-generic/socket.h>
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
 # Since we call flush more often than the metrics aggregation interval, we should
 #  log a bunch of flushes in a row every so often.
 FLUSH_LOGGING_PERIOD = 70
 FLUSH_LOGGING_INITIAL = 10
 FLUSH_LOGGING_COUNT = 5
 EVENT_CHUNK_SIZE = 50
+# Maximum number of series posted in a single payload
+SERIES_CHUNK_SIZE = 10000
+# Connections kept alive to the intake, and payloads posted concurrently
+HTTP_POOL_SIZE = 4
+HTTP_TIMEOUT = 5
 COMPRESS_THRESHOLD = 1024
+# Serialization statuses, from the best to the worst
+SERIALIZATION_STATUSES = ["success", "failure", "permanent_failure"]
 
 
 def add_serialization_status_metric(status, hostname):
@@ -104,31 +119,111 @@ def unicode_metrics(metrics):
     return metrics
 
 
-def serialize_metrics(metrics, hostname):
+def _encode_series(metrics):
+    """
+    Serialize `metrics`, replacing the undecodable characters if needed.
+    Return the payload, or None, whether it's compressed, and the status of
+    the serialization.
+    """
     try:
-        metrics.append(add_serialization_status_metric("success", hostname))
-        serialized = json.dumps({"series": metrics})
+        serialized, compressed = encode_compressed({"series": metrics}, COMPRESS_THRESHOLD)
+        return serialized, compressed, "success"
     except UnicodeDecodeError as e:
         log.exception("Unable to serialize payload. Trying to replace bad characters. %s", e)
-        metrics.append(add_serialization_status_metric("failure", hostname))
-        try:
-            log.error(metrics)
-            serialized = json.dumps({"series": unicode_metrics(metrics)})
-        except Exception as e:
-            log.exception("Unable to serialize payload. Giving up. %s", e)
-            serialized = json.dumps({"series": [add_serialization_status_metric("permanent_failure", hostname)]})
-
-    if len(serialized) > COMPRESS_THRESHOLD:
-        headers = {'Content-Type': 'application/json',
-                   'Content-Encoding': 'deflate'}
-        serialized = zlib.compress(serialized)
-    else:
-        headers = {'Content-Type': 'application/json'}
-    return serialized, headers
+    try:
+        log.error(metrics)
+        serialized, compressed = encode_compressed({"series": unicode_metrics(metrics)}, COMPRESS_THRESHOLD)
+        return serialized, compressed, "failure"
+    except Exception as e:
+        log.exception("Unable to serialize payload. Giving up. %s", e)
+        return None, False, "permanent_failure"
+
+
+def _series_headers(compressed):
+    if compressed:
+        return {'Content-Type': 'application/json',
+                'Content-Encoding': 'deflate'}
+    return {'Content-Type': 'application/json'}
+
+
+def serialize_metrics(metrics, hostname):
+    return list(serialize_metrics_chunks(metrics, hostname, max(len(metrics), 1)))[0]
+
+
+def serialize_metrics_chunks(metrics, hostname, chunk_size=None):
+    """
+    Serialize `metrics` into payloads of at most `chunk_size` series, one at
+    a time, so that only one of them is in memory while it's being posted.
+
+    The last payload carries the one serialization status point of the
+    flush, the worst status of its chunks.
+    """
+    chunk_size = chunk_size or SERIES_CHUNK_SIZE
+    last_start = max(len(metrics) - 1, 0) // chunk_size * chunk_size
+    status = "success"
+    for start in xrange(0, last_start, chunk_size):
+        serialized, compressed, chunk_status = _encode_series(metrics[start:start + chunk_size])
+        status = max(status, chunk_status, key=SERIALIZATION_STATUSES.index)
+        if serialized is not None:
+            yield serialized, _series_headers(compressed)
+
+    status_metric = add_serialization_status_metric(status, hostname)
+    last_chunk = metrics[last_start:] + [status_metric]
+    serialized, compressed, chunk_status = _encode_series(last_chunk)
+    if SERIALIZATION_STATUSES.index(chunk_status) > SERIALIZATION_STATUSES.index(status):
+        # The status point went out with the chunk, serialize it again
+        status_metric['tags'] = ["status:{0}".format(chunk_status)]
+        if serialized is None:
+            last_chunk = [status_metric]
+        serialized, compressed = encode_compressed({"series": last_chunk}, COMPRESS_THRESHOLD)
+    yield serialized, _series_headers(compressed)
+
+
+def summarize_latencies(durations):
+    """ Count, average, median, 95th percentile and max of `durations`, in ms. """
+    durations = sorted(durations)
+    count = len(durations)
+    return {
+        'count': count,
+        'avg': round(sum(durations) / count, 2),
+        'median': durations[int(round(0.5 * count - 1))],
+        '95percentile': durations[int(round(0.95 * count - 1))],
+        'max': durations[-1],
+    }
+
+
+def get_udp_socket_stats(port, proc_path='/proc/net/udp'):
+    """
+    Kernel counters of the UDP sockets bound to `port`, summed over all of
+    them so that SO_REUSEPORT receivers are accounted for too.
+    Returns a (rx_queue bytes, drops) tuple, or None when unavailable.
+    """
+    try:
+        with open(proc_path) as proc_udp:
+            lines = proc_udp.readlines()[1:]
+    except IOError:
+        return None
+
+    port_hex = ':%04X' % port
+    rx_queue = 0
+    drops = 0
+    found = False
+    for line in lines:
+        fields = line.split()
+        # sl local_address rem_address st tx_queue:rx_queue tr:tm->when retrnsmt uid timeout inode ref pointer drops
+        if len(fields) < 13 or not fields[1].endswith(port_hex):
+            continue
+        found = True
+        rx_queue += int(fields[4].split(':')[1], 16)
+        drops += int(fields[12])
+
+    if not found:
+        return None
+    return rx_queue, drops
 
 
 def serialize_event(event):
-    return json.dumps(event)
+    return encode(event)
 
 
 class Reporter(threading.Thread):
@@ -138,11 +233,18 @@ class Reporter(threading.Thread):
     """
 
     def __init__(self, interval, metrics_aggregator, api_host, api_key=None,
-                 use_watchdog=False, event_chunk_size=None):
+                 use_watchdog=False, event_chunk_size=None, server=None, udp_port=None,
+                 series_chunk_size=None, http_pool_size=None):
         threading.Thread.__init__(self)
         self.interval = int(interval)
         self.finished = threading.Event()
         self.metrics_aggregator = metrics_aggregator
+        # Server or ServerPool receiving into aggregators of their own, which
+        # are merged into metrics_aggregator before each flush
+        self.server = server
+        # Port of the statsd server, used to report kernel drops
+        self.udp_port = udp_port
+        self.last_udp_drops = None
         self.flush_count = 0
         self.log_count = 0
         self.hostname = get_hostname()
@@ -155,6 +257,19 @@ class Reporter(threading.Thread):
         self.api_key = api_key
         self.api_host = api_host
         self.event_chunk_size = event_chunk_size or EVENT_CHUNK_SIZE
+        self.series_chunk_size = series_chunk_size or SERIES_CHUNK_SIZE
+
+        # Payloads are posted on their own threads, at most http_pool_size at
+        # a time, over connections kept alive from one flush to the next
+        self.http_pool_size = http_pool_size or HTTP_POOL_SIZE
+        self.http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.http_pool_size)
+        self.http_session.mount('http://', adapter)
+        self.http_session.mount('https://', adapter)
+        self.post_slots = threading.BoundedSemaphore(self.http_pool_size)
+        self.pending_posts = []
+        # Endpoint -> durations in ms of the posts of the current flush
+        self.post_latencies = {}
 
     def stop(self):
         log.info("Stopping reporter")
@@ -170,7 +285,9 @@ class Reporter(threading.Thread):
 
         while not self.finished.isSet():  # Use camel case isSet for 2.4 support.
             self.finished.wait(self.interval)
-            self.metrics_aggregator.send_packet_count('datadog.dogstatsd.packet.count')
+            if self.server is not None:
+                self.server.drain()
+            self.send_intake_stats()
             self.flush()
             if self.watchdog:
                 self.watchdog.reset()
@@ -179,6 +296,27 @@ class Reporter(threading.Thread):
         log.debug("Stopped reporter")
         DogstatsdStatus.remove_latest_status()
 
+    def send_intake_stats(self):
+        """
+        Report how many packets were received and how many were lost, by
+        the parser or by the kernel when our socket buffer overflowed.
+        """
+        self.metrics_aggregator.send_packet_count('datadog.dogstatsd.packet.count')
+        self.metrics_aggregator.send_error_count('datadog.dogstatsd.packet.errors')
+
+        if self.udp_port is None:
+            return
+        udp_stats = get_udp_socket_stats(self.udp_port)
+        if udp_stats is None:
+            return
+        rx_queue, drops = udp_stats
+        self.metrics_aggregator.submit_metric('datadog.dogstatsd.udp.rx_queue', rx_queue, 'g')
+        if self.last_udp_drops is not None:
+            # Counters are per socket and reset when a receiver restarts
+            self.metrics_aggregator.submit_metric('datadog.dogstatsd.udp.drops',
+                                                  max(0, drops - self.last_udp_drops), 'g')
+        self.last_udp_drops = drops
+
     def flush(self):
         try:
             self.flush_count += 1
@@ -203,6 +341,11 @@ class Reporter(threading.Thread):
             if service_check_count:
                 self.submit_service_checks(service_checks)
 
+            self.wait_for_posts()
+            post_latencies = dict((endpoint, summarize_latencies(durations))
+                                  for endpoint, durations in self.post_latencies.iteritems())
+            self.post_latencies = {}
+
             should_log = self.flush_count <= FLUSH_LOGGING_INITIAL or self.log_count <= FLUSH_LOGGING_COUNT
             log_func = log.info
             if not should_log:
@@ -213,6 +356,7 @@ class Reporter(threading.Thread):
 
             # Persist a status message.
             packet_count = self.metrics_aggregator.total_count
+            cache_hits, cache_misses, cache_evictions = self.metrics_aggregator.context_cache_stats()
             DogstatsdStatus(
                 flush_count=self.flush_count,
                 packet_count=packet_count,
@@ -220,6 +364,10 @@ class Reporter(threading.Thread):
                 metric_count=count,
                 event_count=event_count,
                 service_check_count=service_check_count,
+                context_cache_hits=cache_hits,
+                context_cache_misses=cache_misses,
+                context_cache_evictions=cache_evictions,
+                post_latencies=post_latencies,
             ).persist()
 
         except Exception:
@@ -229,18 +377,19 @@ class Reporter(threading.Thread):
                 log.exception("Error flushing metrics")
 
     def submit(self, metrics):
-        body, headers = serialize_metrics(metrics, self.hostname)
         params = {}
         if self.api_key:
             params['api_key'] = self.api_key
         url = '%s/api/v1/series?%s' % (self.api_host, urlencode(params))
-        self.submit_http(url, body, headers)
+        # A chunk that fails to be posted doesn't prevent the others from being sent
+        for body, headers in serialize_metrics_chunks(metrics, self.hostname, self.series_chunk_size):
+            self.submit_http(url, body, headers)
 
     def submit_events(self, events):
-        headers = {'Content-Type':'application/json'}
         event_chunk_size = self.event_chunk_size
 
         for chunk in chunks(events, event_chunk_size):
+            headers = {'Content-Type':'application/json'}
             payload = {
                 'apiKey': self.api_key,
                 'events': {
@@ -254,14 +403,31 @@ class Reporter(threading.Thread):
                 params['api_key'] = self.api_key
             url = '%s/intake?%s' % (self.api_host, urlencode(params))
 
-            self.submit_http(url, json.dumps(payload), headers)
+            self.submit_http(url, encode(payload), headers)
 
     def submit_http(self, url, data, headers):
+        """ Post the payload on its own thread, once fewer than http_pool_size are being posted. """
+        self.post_slots.acquire()
+        try:
+            poster = threading.Thread(target=self._post, args=(url, data, headers))
+            poster.daemon = True
+            poster.start()
+        except Exception:
+            self.post_slots.release()
+            raise
+        self.pending_posts.append(poster)
+
+    def wait_for_posts(self):
+        for poster in self.pending_posts:
+            poster.join()
+        self.pending_posts = []
+
+    def _post(self, url, data, headers):
         headers["DD-Dogstatsd-Version"] = get_version()
         log.debug("Posting payload to %s" % url)
         try:
             start_time = time()
-            r = requests.post(url, data=data, timeout=5, headers=headers)
+            r = self.http_session.post(url, data=data, timeout=HTTP_TIMEOUT, headers=headers)
             r.raise_for_status()
 
             if r.status_code >= 200 and r.status_code < 205:
@@ -270,12 +436,16 @@ class Reporter(threading.Thread):
             status = r.status_code
             duration = round((time() - start_time) * 1000.0, 4)
             log.debug("%s POST %s (%sms)" % (status, url, duration))
+            endpoint = urlparse(url).path
+            self.post_latencies.setdefault(endpoint, []).append(duration)
         except Exception:
             log.exception("Unable to post payload.")
             try:
                 log.error("Received status code: {0}".format(r.status_code))
             except Exception:
                 pass
+        finally:
+            self.post_slots.release()
 
     def submit_service_checks(self, service_checks):
         headers = {'Content-Type':'application/json'}
@@ -285,20 +455,33 @@ class Reporter(threading.Thread):
             params['api_key'] = self.api_key
 
         url = '{0}/api/v1/check_run?{1}'.format(self.api_host, urlencode(params))
-        self.submit_http(url, json.dumps(service_checks), headers)
+        self.submit_http(url, encode(service_checks), headers)
 
 
 class Server(object):
     """
     A statsd udp server.
+    When given a `reporting_aggregator`, `metrics_aggregator` is only a buffer:
+    `drain` swaps it out and merges it into `reporting_aggregator`, so that the
+    reporter never flushes the structures the server is writing to.
     """
 
-    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None):
+    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None,
+                 so_reuseport=False, control_conn=None, recv_batch_size=None, so_rcvbuf=None,
+                 reporting_aggregator=None):
         self.host = host
         self.port = int(port)
         self.address = (self.host, self.port)
         self.metrics_aggregator = metrics_aggregator
+        self.reporting_aggregator = reporting_aggregator
+        # Held while a batch of datagrams is submitted, and while draining
+        self.lock = threading.Lock()
         self.buffer_size = 1024 * 8
+        self.recv_batch_size = recv_batch_size or RECV_BATCH_SIZE
+        self.so_rcvbuf = so_rcvbuf
+        self.so_reuseport = so_reuseport
+        # Pipe end used by a ServerPool to drain our aggregator or stop us
+        self.control_conn = control_conn
 
         self.running = False
 
@@ -323,6 +506,13 @@ class Server(object):
         # IPv4 only
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setblocking(0)
+        if self.so_reuseport:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        if self.so_rcvbuf:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.so_rcvbuf)
+            # The kernel doubles the value and caps it to net.core.rmem_max
+            log.info("Socket receive buffer size: %s bytes" %
+                     self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
         try:
             self.socket.bind(self.address)
         except socket.gaierror:
@@ -335,14 +525,22 @@ class Server(object):
 
         # Inline variables for quick look-up.
         buffer_size = self.buffer_size
-        aggregator_submit = self.metrics_aggregator.submit_packets
+        batch = xrange(self.recv_batch_size)
+        aggregator = self.metrics_aggregator
+        aggregator_submit = aggregator.submit_packets
         sock = [self.socket]
         socket_recv = self.socket.recv
+        socket_error = socket.error
+        would_block = (errno.EAGAIN, errno.EWOULDBLOCK)
         select_select = select.select
         select_error = select.error
         timeout = UDP_SOCKET_TIMEOUT
         should_forward = self.should_forward
         forward_udp_sock = self.forward_udp_sock
+        control_conn = self.control_conn
+        if control_conn is not None:
+            sock.append(control_conn)
+        lock = self.lock
 
         # Run our select loop.
         self.running = True
@@ -350,21 +548,161 @@ class Server(object):
             try:
                 ready = select_select(sock, [], [], timeout)
                 if ready[0]:
-                    message = socket_recv(buffer_size)
-                    aggregator_submit(message)
-
-                    if should_forward:
-                        forward_udp_sock.send(message)
+                    if control_conn is not None and control_conn in ready[0]:
+                        self.handle_control()
+                        if len(ready[0]) == 1:
+                            continue
+
+                    # Drain the socket before going back to select
+                    with lock:
+                        for _ in batch:
+                            try:
+                                message = socket_recv(buffer_size)
+                            except socket_error, e:
+                                if e.errno in would_block:
+                                    break
+                                raise
+
+                            try:
+                                aggregator_submit(message)
+                            except Exception:
+                                aggregator.error_count += 1
+                                log.exception('Error parsing datagram')
+
+                            if should_forward:
+                                forward_udp_sock.send(message)
             except select_error, se:
                 # Ignore interrupted system calls from sigterm.
-                errno = se[0]
-                if errno != 4:
+                if se[0] != errno.EINTR:
                     raise
             except (KeyboardInterrupt, SystemExit):
                 break
             except Exception:
                 log.exception('Error receiving datagram')
 
+    def handle_control(self):
+        try:
+            command = self.control_conn.recv()
+        except EOFError:
+            # Our pool is gone
+            self.running = False
+            return
+
+        if command == 'drain':
+            self.control_conn.send(self.metrics_aggregator.drain_shard())
+        elif command == 'stop':
+            self.running = False
+
+    def drain(self):
+        """ Merge what we received since the last drain into the reporting aggregator. """
+        if self.reporting_aggregator is None:
+            return
+        # Only swap the buffer while holding the lock, ingestion goes on into
+        # a fresh one while the reporter merges and flushes the previous one
+        with self.lock:
+            state = self.metrics_aggregator.drain_shard()
+        self.reporting_aggregator.merge_shard(state)
+
+    def stop(self):
+        self.running = False
+
+
+class ServerWorker(multiprocessing.Process):
+    """
+    Runs a statsd udp server, and its aggregator shard, in a child process.
+    """
+
+    def __init__(self, server):
+        multiprocessing.Process.__init__(self, name='dogstatsd-receiver-%s' % server.port)
+        self.daemon = True
+        self.server = server
+
+    def _handle_sigterm(self, signum, frame):
+        self.server.stop()
+
+    def run(self):
+        # The parent process drives the shutdown
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
+        self.server.start()
+
+
+class ServerPool(object):
+    """
+    Several statsd udp servers listening on the same port with SO_REUSEPORT,
+    each one in its own process with its own aggregator shard, so that the
+    kernel spreads the intake over several cores.
+    The shards are merged into `metrics_aggregator` when the reporter calls `drain`.
+    """
+
+    def __init__(self, metrics_aggregator, shard_factory, host, port, workers,
+                 forward_to_host=None, forward_to_port=None, recv_batch_size=None, so_rcvbuf=None):
+        self.metrics_aggregator = metrics_aggregator
+        self.port = int(port)
+        self.running = False
+        self.lock = threading.Lock()
+        self.conns = []
+        self.workers = []
+        for _ in xrange(workers):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            server = Server(shard_factory(), host, port, forward_to_host=forward_to_host,
+                            forward_to_port=forward_to_port, so_reuseport=True,
+                            control_conn=child_conn, recv_batch_size=recv_batch_size,
+                            so_rcvbuf=so_rcvbuf)
+            self.conns.append(parent_conn)
+            self.workers.append(ServerWorker(server))
+
+    def start(self):
+        """ Run the receiver processes until stopped. """
+        log.info("Starting %s dogstatsd receiver processes on port %s" % (len(self.workers), self.port))
+        for worker in self.workers:
+            worker.start()
+
+        self.running = True
+        while self.running:
+            sleep(1)
+            for worker in self.workers:
+                if not worker.is_alive() and self.running:
+                    log.error("Dogstatsd receiver process %s exited with %s, stopping" % (worker.pid, worker.exitcode))
+                    self.running = False
+
+        self._shutdown()
+
+    def drain(self):
+        """ Merge every shard into our aggregator. """
+        with self.lock:
+            requested = []
+            for conn in self.conns:
+                try:
+                    conn.send('drain')
+                    requested.append(conn)
+                except (EOFError, IOError):
+                    log.warning("Unable to reach a dogstatsd receiver process")
+
+            for conn in requested:
+                try:
+                    if not conn.poll(SHARD_DRAIN_TIMEOUT):
+                        log.warning("A dogstatsd receiver process didn't hand over its metrics in %ss, "
+                                    "they will be flushed later" % SHARD_DRAIN_TIMEOUT)
+                        continue
+                    # Catch up with late replies from previous drains too
+                    while conn.poll():
+                        self.metrics_aggregator.merge_shard(conn.recv())
+                except (EOFError, IOError):
+                    log.warning("Lost a dogstatsd receiver process while draining it")
+
+    def _shutdown(self):
+        with self.lock:
+            for conn in self.conns:
+                try:
+                    conn.send('stop')
+                except (EOFError, IOError):
+                    pass
+        for worker in self.workers:
+            worker.join(UDP_SOCKET_TIMEOUT)
+            if worker.is_alive():
+                worker.terminate()
+
     def stop(self):
         self.running = False
 
@@ -437,7 +775,13 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     forward_to_host = c.get('statsd_forward_host')
     forward_to_port = c.get('statsd_forward_port')
     event_chunk_size = c.get('event_chunk_size')
+    series_chunk_size = c.get('dogstatsd_series_chunk_size')
+    http_pool_size = c.get('dogstatsd_http_pool_size')
     recent_point_threshold = c.get('recent_point_threshold', None)
+    workers = c.get('dogstatsd_workers', 1)
+    recv_batch_size = c.get('dogstatsd_recv_batch_size')
+    so_rcvbuf = c.get('dogstatsd_so_rcvbuf')
+    context_cache_size = c.get('dogstatsd_context_cache_size')
 
     target = c['sd_url']
     if use_forwarder:
@@ -445,22 +789,24 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
 
     hostname = get_hostname(c)
 
-    # Create the aggregator (which is the point of communication between the
-    # server and reporting threads.
+    # Create the aggregator flushed by the reporting thread.
     assert 0 < interval
 
-    aggregator = MetricsBucketAggregator(
-        hostname,
-        aggregator_interval,
-        recent_point_threshold=recent_point_threshold,
-        formatter=get_formatter(c),
-        histogram_aggregates=c.get('histogram_aggregates'),
-        histogram_percentiles=c.get('histogram_percentiles'),
-        utf8_decoding=c['utf8_decoding']
-    )
-
-    # Start the reporting thread.
-    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size)
+    def create_aggregator(formatter=None):
+        return MetricsBucketAggregator(
+            hostname,
+            aggregator_interval,
+            recent_point_threshold=recent_point_threshold,
+            formatter=formatter,
+            histogram_aggregates=c.get('histogram_aggregates'),
+            histogram_percentiles=c.get('histogram_percentiles'),
+            histogram_backend=c.get('histogram_backend'),
+            histogram_relative_accuracy=c.get('histogram_relative_accuracy'),
+            utf8_decoding=c['utf8_decoding'],
+            context_cache_size=context_cache_size
+        )
+
+    aggregator = create_aggregator(get_formatter(c))
 
     # Start the server on an IPv4 stack
     # Default to loopback
@@ -469,7 +815,26 @@ def init(config_path=None, use_watchdog=False, use_forwarder=False, args=None):
     if non_local_traffic:
         server_host = ''
 
-    server = Server(aggregator, server_host, port, forward_to_host=forward_to_host, forward_to_port=forward_to_port)
+    if workers > 1 and SO_REUSEPORT is None:
+        log.warning("SO_REUSEPORT is not supported on this platform, ignoring dogstatsd_workers")
+        workers = 1
+
+    # The servers receive into aggregators of their own, merged into
+    # `aggregator` by the reporting thread before each flush. They keep the
+    # default formatter so that the metrics of receiver processes can be
+    # pickled, the namespace is applied when merging them into `aggregator`
+    if workers > 1:
+        server = ServerPool(aggregator, create_aggregator, server_host, port, workers,
+                            forward_to_host=forward_to_host, forward_to_port=forward_to_port,
+                            recv_batch_size=recv_batch_size, so_rcvbuf=so_rcvbuf)
+    else:
+        server = Server(create_aggregator(), server_host, port, forward_to_host=forward_to_host, forward_to_port=forward_to_port,
+                        recv_batch_size=recv_batch_size, so_rcvbuf=so_rcvbuf, reporting_aggregator=aggregator)
+
+    # Start the reporting thread.
+    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size,
+                        server=server, udp_port=server.port, series_chunk_size=series_chunk_size,
+                        http_pool_size=http_pool_size)
 
     return reporter, server, c
 
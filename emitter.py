@@ -3,17 +3,20 @@
 # Licensed under Simplified BSD License (see LICENSE)
 
 # stdlib
+from collections import deque
 from hashlib import md5
 import logging
 import re
-#import zlib
+import threading
+import time
+import zlib
 
 # 3p
 import requests
-import simplejson as json
 
 # project
 from config import get_version
+from utils.serialization import encode
 
 from utils.proxy import set_no_proxy_settings
 set_no_proxy_settings()
@@ -28,57 +31,220 @@ control_chars = ''.join(map(unichr, range(0, 32) + range(127, 160)))
 control_char_re = re.compile('[%s]' % re.escape(control_chars))
 
 
+HTTP_TIMEOUT = 5
+# Posts to the intake before falling back to the forwarder, and delay
+# before the first retry, doubled for each of the next ones
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 1
+# Share of the check interval a payload may spend being retried, so that
+# retries don't hold up the next payloads
+RETRY_TIME_RATIO = 0.5
+DEFAULT_CHECK_FREQUENCY = 60
+# Payloads waiting to be sent at most, the oldest ones are handed over to
+# the forwarder beyond that
+MAX_PENDING = 10
+FORWARDER_PORT = 17124
+
+_sender = None
+_sender_lock = threading.Lock()
+
+
 def remove_control_chars(s):
     return control_char_re.sub('', s)
 
 
 def http_emitter(message, log, agentConfig, endpoint):
-    "Send payload"
-    url = agentConfig['sd_url']
-
-    log.debug('http_emitter: attempting postback to ' + url)
-
-    # Post back the data
+    """
+    Serialize the payload, and hand it over to the background sender: the
+    collector doesn't wait for the intake.
+    """
     try:
-        payload = json.dumps(message)
+        payload = encode(message)
     except UnicodeDecodeError:
         message = remove_control_chars(message)
-        payload = json.dumps(message)
-
-    #zipped = zlib.compress(payload)
-    zipped = payload
-
-    log.debug("payload_size=%d, compressed_size=%d, compression_ratio=%.3f"
-              % (len(payload), len(zipped), float(len(payload))/float(len(zipped))))
+        payload = encode(message)
 
     agentKey = message.get('agentKey', None)
     if not agentKey:
         raise Exception("The http emitter requires an agent key")
 
-    url = "{0}/intake/{1}?agent_key={2}".format(url, endpoint, agentKey)
-
-    try:
-        headers = post_headers(agentConfig, zipped)
-        r = requests.post(url, data=zipped, timeout=5, headers=headers)
-
-        r.raise_for_status()
-
-        if r.status_code >= 200 and r.status_code < 205:
-            log.debug("Payload accepted")
-
-    except Exception:
-        log.exception("Unable to post payload.")
+    get_sender(agentConfig).submit(endpoint, agentKey, payload, log)
+
+
+def sender_stats():
+    """ Payloads waiting to be sent, and dropped, by the background sender """
+    with _sender_lock:
+        sender = _sender
+    if sender is None:
+        return {'queue_depth': 0, 'dropped': 0}
+    return sender.stats()
+
+# Shown in the collector status
+http_emitter.stats = sender_stats
+
+
+def get_sender(agentConfig):
+    global _sender
+    with _sender_lock:
+        if _sender is None:
+            _sender = PayloadSender(agentConfig)
+            _sender.start()
+    return _sender
+
+
+def flush(timeout):
+    """
+    Wait at most `timeout` seconds for the payloads handed over to the
+    background sender to be sent, return whether they all were
+    """
+    with _sender_lock:
+        sender = _sender
+    if sender is None:
+        return True
+    return sender.flush(timeout)
+
+
+class PayloadSender(threading.Thread):
+    """
+    Posts the collector payloads in the background, over kept-alive
+    connections and compressed.
+
+    A payload is tried MAX_ATTEMPTS times, for at most RETRY_TIME_RATIO of
+    the check interval, then handed over to the local forwarder, which
+    queues it until the intake is back. Beyond MAX_PENDING payloads waiting
+    to be sent, the oldest ones are handed over to the forwarder right
+    away. `flush` waits for what's left, when the collector stops.
+    """
+
+    def __init__(self, agentConfig):
+        threading.Thread.__init__(self, name="http-emitter")
+        self.daemon = True
+        self.agentConfig = agentConfig
+        self.url = agentConfig['sd_url']
+        self.forwarder_url = None
+        if not agentConfig.get('use_forwarder'):
+            self.forwarder_url = "http://%s:%s" % (agentConfig.get('bind_host') or 'localhost',
+                                                  agentConfig.get('listen_port') or FORWARDER_PORT)
+        self.retry_time = RETRY_TIME_RATIO * (agentConfig.get('check_freq') or DEFAULT_CHECK_FREQUENCY)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=1)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pending = deque()
+        # Payloads to hand over to the forwarder without trying the intake
+        self.overflow = deque()
+        self.condition = threading.Condition()
+        self.sending = False
+        self.flushing = False
+        self.dropped_count = 0
+
+    def submit(self, endpoint, agentKey, payload, log):
+        with self.condition:
+            if len(self.pending) >= MAX_PENDING:
+                self.overflow.append(self.pending.popleft())
+                log.warning("%s payloads waiting to be sent, handing the oldest one over to the forwarder"
+                            % MAX_PENDING)
+            self.pending.append((endpoint, agentKey, payload, log))
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'queue_depth': len(self.pending) + len(self.overflow) + (1 if self.sending else 0),
+                'dropped': self.dropped_count,
+            }
+
+    def flush(self, timeout):
+        """ Wait at most `timeout` seconds for the payloads waiting to be sent """
+        deadline = time.time() + timeout
+        with self.condition:
+            # Whatever is left goes to the forwarder after a single attempt
+            self.flushing = True
+            self.condition.notify_all()
+            while self.pending or self.overflow or self.sending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    lost = len(self.pending) + len(self.overflow)
+                    logging.getLogger(__name__).error("%s payloads couldn't be sent before stopping" % lost)
+                    self.dropped_count += lost
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.overflow:
+                    self.condition.wait()
+                if self.overflow:
+                    handover = True
+                    endpoint, agentKey, payload, log = self.overflow.popleft()
+                else:
+                    handover = False
+                    endpoint, agentKey, payload, log = self.pending.popleft()
+                self.sending = True
+            try:
+                self.send(endpoint, agentKey, payload, log, handover)
+            except Exception:
+                log.exception("Unable to post payload.")
+            finally:
+                with self.condition:
+                    self.sending = False
+                    self.condition.notify_all()
+
+    def send(self, endpoint, agentKey, payload, log, handover=False):
+        zipped = zlib.compress(payload)
+        log.debug("payload_size=%d, compressed_size=%d, compression_ratio=%.3f"
+                  % (len(payload), len(zipped), float(len(payload))/float(len(zipped))))
+        headers = post_headers(self.agentConfig, zipped)
+
+        if not handover or self.forwarder_url is None:
+            url = "{0}/intake/{1}?agent_key={2}".format(self.url, endpoint, agentKey)
+            log.debug('http_emitter: attempting postback to ' + self.url)
+            deadline = time.time() + self.retry_time
+            for attempt in xrange(MAX_ATTEMPTS):
+                if attempt:
+                    delay = RETRY_DELAY * 2 ** (attempt - 1)
+                    # Retrying must leave time for a full request, and the
+                    # collector won't wait for retries when stopping
+                    if self.flushing or time.time() + delay + HTTP_TIMEOUT > deadline:
+                        break
+                    time.sleep(delay)
+                if self.post(url, zipped, headers, log):
+                    return
+
+        if self.forwarder_url is None:
+            log.error("Unable to post payload, dropping it")
+            self.dropped_count += 1
+            return
+        log.warning("Handing payload over to the forwarder")
+        url = "{0}/intake/{1}?agent_key={2}".format(self.forwarder_url, endpoint, agentKey)
+        if not self.post(url, zipped, headers, log):
+            log.error("The forwarder didn't accept the payload either, dropping it")
+            self.dropped_count += 1
+
+    def post(self, url, data, headers, log):
         try:
-            log.error("Received status code: {0}".format(r.status_code))
+            r = self.session.post(url, data=data, timeout=HTTP_TIMEOUT, headers=headers)
+            r.raise_for_status()
+
+            if r.status_code >= 200 and r.status_code < 205:
+                log.debug("Payload accepted")
+            return True
         except Exception:
-            pass
+            log.exception("Unable to post payload.")
+            try:
+                log.error("Received status code: {0}".format(r.status_code))
+            except Exception:
+                pass
+            return False
 
 
 def post_headers(agentConfig, payload):
     return {
         'User-Agent': 'Server Density Agent/%s' % agentConfig['version'],
         'Content-Type': 'application/json',
-        #'Content-Encoding': 'deflate',
+        'Content-Encoding': 'deflate',
         'Accept': 'text/html, */*',
         'Content-MD5': md5(payload).hexdigest(),
         'SD-Collector-Version': get_version()
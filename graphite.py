@@ -3,9 +3,11 @@
 # Licensed under Simplified BSD License (see LICENSE)
 
 # stdlib
+from array import array
 import cPickle as pickle
 import logging
 import struct
+import time
 
 # 3p
 from tornado.ioloop import IOLoop
@@ -13,43 +15,140 @@ from tornado.tcpserver import TCPServer
 
 log = logging.getLogger(__name__)
 
+# Points held between two flushes at most, the next ones are dropped
+MAX_POINTS = 100000
+# Longest plaintext line and pickle frame accepted
+MAX_LINE_LENGTH = 4096
+MAX_FRAME_SIZE = 1024 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+
+# Length of the pickle frame that follows
+PICKLE_HEADER = struct.Struct('!L')
+
+
+class GraphiteProtocolError(Exception):
+    pass
+
+
+class GraphitePoints(object):
+    """
+    Points received since the last flush, by metric name, host and device,
+    with their timestamps and values packed in arrays of doubles.
+
+    At most `max_points` are held, the next ones are dropped and counted
+    until the next flush.
+    """
+
+    def __init__(self, max_points=None):
+        self.max_points = max_points or MAX_POINTS
+        self._series = {}
+        self.count = 0
+        self.received_count = 0
+        self.dropped_count = 0
+        self.invalid_count = 0
+        self._flush_dropped_count = 0
+
+    def extend(self, points):
+        """ Add a list of (name, host, device, timestamp, value) tuples """
+        self.received_count += len(points)
+        room = max(self.max_points - self.count, 0)
+        if len(points) > room:
+            self.dropped_count += len(points) - room
+            points = points[:room]
+
+        series = self._series
+        for name, host, device, ts, value in points:
+            key = (name, host, device)
+            values = series.get(key)
+            if values is None:
+                values = series[key] = array('d')
+            values.append(ts)
+            values.append(value)
+        self.count += len(points)
+
+    def flush(self):
+        """
+        Return the points received since the last flush, in the format of the
+        intake: {name: [[host, device, timestamp, value], ...]}
+        """
+        dropped = self.dropped_count - self._flush_dropped_count
+        if dropped:
+            log.warning("Dropped %s graphite points received since the last flush, "
+                        "more than %s of them" % (dropped, self.max_points))
+            self._flush_dropped_count = self.dropped_count
+
+        metrics = {}
+        for (name, host, device), values in self._series.iteritems():
+            points = metrics.get(name)
+            if points is None:
+                points = metrics[name] = []
+            points.extend([host, device, values[i], values[i + 1]] for i in xrange(0, len(values), 2))
+        self._series = {}
+        self.count = 0
+        return metrics
+
+    def stats(self):
+        """ Points received, invalid and dropped since the listener started """
+        return {
+            'received': self.received_count,
+            'invalid': self.invalid_count,
+            'dropped': self.dropped_count,
+        }
+
 
 class GraphiteServer(TCPServer):
 
-    def __init__(self, app, hostname, io_loop=None, ssl_options=None, **kwargs):
+    def __init__(self, points, hostname, io_loop=None, ssl_options=None, **kwargs):
         log.warn('Graphite listener is started -- if you do not need graphite, turn it off in config.cfg.')
         log.warn('Graphite relay uses pickle to transport messages. Pickle is not secured against remote execution exploits.')
         log.warn('See http://blog.nelhage.com/2011/03/exploiting-pickle/ for more details')
-        self.app = app
+        self.points = points
         self.hostname = hostname
         TCPServer.__init__(self, io_loop=io_loop, ssl_options=ssl_options, **kwargs)
 
     def handle_stream(self, stream, address):
-        GraphiteConnection(stream, address, self.app, self.hostname)
+        stream.read_chunk_size = READ_CHUNK_SIZE
+        GraphiteConnection(stream, address, self.points, self.hostname)
 
 
 class GraphiteConnection(object):
+    """
+    A connection from a graphite relay, sending either plaintext lines
+    (`name value timestamp`) or length-prefixed pickle frames: pickle frames
+    start with a null byte, metric names don't.
+
+    Everything read so far is parsed at once, and its points appended
+    together.
+    """
 
-    def __init__(self, stream, address, app, hostname):
+    def __init__(self, stream, address, points, hostname):
         log.debug('received a new connection from %s', address)
-        self.app = app
+        self.points = points
         self.stream = stream
         self.address = address
         self.hostname = hostname
+        self._buffer = ''
+        self._parse = None
         self.stream.set_close_callback(self._on_close)
-        self.stream.read_bytes(4, self._on_read_header)
+        self.stream.read_until_close(self._on_read, streaming_callback=self._on_read)
 
-    def _on_read_header(self, data):
-        try:
-            size = struct.unpack("!L", data)[0]
-            log.debug("Receiving a string of size:" + str(size))
-            self.stream.read_bytes(size, self._on_read_line)
-        except Exception, e:
-            log.error(e)
+    def _on_read(self, data):
+        if not data:
+            return
+        if self._buffer:
+            data = self._buffer + data
+        if self._parse is None:
+            self._parse = self._parse_pickle if data[0] == '\x00' else self._parse_lines
 
-    def _on_read_line(self, data):
-        log.debug('read a new line from %s', self.address)
-        self._decode(data)
+        try:
+            points, self._buffer = self._parse(data)
+        except GraphiteProtocolError, e:
+            log.error("Closing graphite connection from %s: %s" % (self.address, e))
+            self._buffer = ''
+            self.stream.close()
+            return
+        if points:
+            self.points.extend(points)
 
     def _on_close(self):
         log.debug('client quit %s', self.address)
@@ -60,60 +159,95 @@ class GraphiteConnection(object):
         out of the graphite metric name.
 
         For instance, if the hostname is in 4th position,
-        you could use: host = components[3]
+        you could use: host = metric.split('.')[3]
         """
+        return metric, self.hostname, "N/A"
 
+    def _point(self, metric, ts, value):
+        """
+        The (metric, host, device, timestamp, value) tuple of a point, or None
+        for NaN values and metric names `_parseMetric` fails on
+        """
+        if value != value:
+            return None
+        if ts < 0:
+            # Graphite's way to say now
+            ts = time.time()
         try:
-            components = metric.split('.') # NOQA
-
-            host = self.hostname
-            metric = metric
-            device = "N/A"
-
-            return metric, host, device
+            metric, host, device = self._parseMetric(metric)
         except Exception:
             log.exception("Unparsable metric: %s" % metric)
-            return None, None, None
-
-    def _postMetric(self, name, host, device, datapoint):
-
-        ts = datapoint[0]
-        value = datapoint[1]
-        if self.app is not None:
-            self.app.appendMetric("graphite", name, host, device, ts, value)
-
-    def _processMetric(self, metric, datapoint):
-        """Parse the metric name to fetch (host, metric, device) and
-            send the datapoint to datadog"""
-
-        log.debug("New metric: %s, values: %s" % (metric, datapoint))
-        (metric, host, device) = self._parseMetric(metric)
-        if metric is not None:
-            self._postMetric(metric, host, device, datapoint)
-            log.info("Posted metric: %s, host: %s, device: %s" % (metric, host, device))
-
-    def _decode(self, data):
-
-        try:
-            datapoints = pickle.loads(data)
-        except Exception:
-            log.exception("Cannot decode grapite points")
-            return
-
-        for (metric, datapoint) in datapoints:
-            try:
-                datapoint = (float(datapoint[0]), float(datapoint[1]))
-            except Exception, e:
-                log.error(e)
+            return None
+        return metric, host, device, ts, value
+
+    def _parse_lines(self, data):
+        lines = data.split('\n')
+        rest = lines.pop()
+        if len(rest) > MAX_LINE_LENGTH:
+            raise GraphiteProtocolError("line longer than %s bytes" % MAX_LINE_LENGTH)
+
+        points = []
+        invalid = 0
+        for line in lines:
+            fields = line.split()
+            if len(fields) != 3:
+                if fields:
+                    invalid += 1
                 continue
+            try:
+                point = self._point(fields[0], float(fields[2]), float(fields[1]))
+            except ValueError:
+                point = None
+            if point is None:
+                invalid += 1
+            else:
+                points.append(point)
+
+        if invalid:
+            self.points.invalid_count += invalid
+            log.debug("Skipped %s invalid graphite lines from %s", invalid, self.address)
+        return points, rest
+
+    def _parse_pickle(self, data):
+        points = []
+        invalid = 0
+        offset = 0
+        while len(data) - offset >= PICKLE_HEADER.size:
+            size = PICKLE_HEADER.unpack_from(data, offset)[0]
+            if size > MAX_FRAME_SIZE:
+                raise GraphiteProtocolError("pickle frame of %s bytes, more than %s" % (size, MAX_FRAME_SIZE))
+            end = offset + PICKLE_HEADER.size + size
+            if end > len(data):
+                break
 
-            self._processMetric(metric, datapoint)
+            try:
+                datapoints = pickle.loads(data[offset + PICKLE_HEADER.size:end])
+            except Exception:
+                log.exception("Cannot decode graphite points")
+                datapoints = []
+                invalid += 1
+            offset = end
+
+            for item in datapoints:
+                try:
+                    metric, datapoint = item
+                    point = self._point(metric, float(datapoint[0]), float(datapoint[1]))
+                except Exception:
+                    point = None
+                if point is None:
+                    invalid += 1
+                else:
+                    points.append(point)
+
+        if invalid:
+            self.points.invalid_count += invalid
+            log.debug("Skipped %s invalid graphite points from %s", invalid, self.address)
+        return points, data[offset:]
 
-        self.stream.read_bytes(4, self._on_read_header)
 
 def start_graphite_listener(port):
     from util import get_hostname
-    echo_server = GraphiteServer(None, get_hostname(None))
+    echo_server = GraphiteServer(GraphitePoints(), get_hostname(None))
     echo_server.listen(port)
     IOLoop.instance().start()
 
@@ -16,7 +16,7 @@ Name: sd-agent
 BuildArch: x86_64 i386
 %include %{_topdir}/inc/version
 %include %{_topdir}/inc/release
-Requires: python26, sysstat, libyaml
+Requires: python26, libyaml
 BuildRequires: symlinks
 License: Simplified BSD
 Group: System/Monitoring
@@ -35,7 +35,7 @@ python26 virtualenv-13.1.2/virtualenv.py %{__venv}
 
 %setup -qn sd-agent
 # Get rid of conflictive dependencies for el5
-sed -ie 's/^\(pycurl\|psycopg2\)/# \1/' requirements-opt.txt
+sed -ie 's/^\(psycopg2\)/# \1/' requirements-opt.txt
 %{__venv}/bin/python %{__venv}/bin/pip install -r requirements.txt
 %{__venv}/bin/python %{__venv}/bin/pip install -r requirements-opt.txt
 
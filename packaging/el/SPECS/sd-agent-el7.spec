@@ -16,7 +16,7 @@ Name: sd-agent
 BuildArch: x86_64 i386
 %include %{_topdir}/inc/version
 %include %{_topdir}/inc/release
-Requires: python >= 2.6, sysstat, libyaml, initscripts
+Requires: python >= 2.6, libyaml, initscripts
 BuildRequires: symlinks
 License: Simplified BSD
 Group: System/Monitoring
@@ -36,7 +36,7 @@ python virtualenv-13.1.2/virtualenv.py %{__venv}
 
 %setup -qn sd-agent
 %{__venv}/bin/python %{__venv}/bin/pip install -r requirements.txt
-PYCURL_SSL_LIBRARY=nss %{__venv}/bin/python %{__venv}/bin/pip install -r requirements-opt.txt
+%{__venv}/bin/python %{__venv}/bin/pip install -r requirements-opt.txt
 
 %build
 %{__venv}/bin/python setup.py build
@@ -12,26 +12,24 @@ from config import initialize_logging  # noqa
 initialize_logging('forwarder')
 
 # stdlib
+import base64
 from datetime import timedelta
+from hashlib import md5
 import logging
 import os
 from Queue import Full, Queue
 from socket import error as socket_error, gaierror
 import sys
 import threading
+import time
+from urllib import quote
 import zlib
 
 # For pickle & PID files, see issue 293
 os.umask(022)
 
 # 3p
-try:
-    import pycurl
-except ImportError:
-    # For the source install, pycurl might not be installed
-    pycurl = None
-from tornado.escape import json_decode
-import tornado.httpclient
+import requests
 import tornado.httpserver
 import tornado.ioloop
 from tornado.options import define, options, parse_command_line
@@ -53,7 +51,10 @@ from util import (
     json,
     Watchdog,
 )
+from utils import serialization
+from utils.http import PooledHTTPClient
 from utils.logger import RedactedLogRecord
+from utils.spool import Spool
 
 
 logging.LogRecord = RedactedLogRecord
@@ -84,8 +85,48 @@ MAX_QUEUE_SIZE = 30 * 1024 * 1024  # 30MB
 
 THROTTLING_DELAY = timedelta(microseconds=1000000 / 2)  # 2 msg/second
 
+# Weight of the last payload in the emitters latency moving average
+EMITTER_LATENCY_SMOOTHING = 0.1
+
+# Uncompressed bytes of payloads merged into a single transaction
+COALESCE_MAX_SIZE = 1024 * 1024  # 1MB
+# Lists of records concatenated when payloads are coalesced, by their path in
+# the payload, '*' matching any key. The other lists must be equal.
+COALESCED_LISTS = [('metrics',), ('series',), ('service_checks',), ('events', '*')]
+
+
+class EmitterPayload(object):
+    """
+    A payload as posted to the forwarder, shared by every emitter. It's only
+    decoded the first time an emitter asks for its `data`, on the emitter's
+    thread.
+    """
+
+    def __init__(self, raw, headers):
+        self.raw = raw
+        # The transaction changes its headers when it compresses its payload
+        self.headers = dict(headers) if headers else {}
+        self.received_at = time.time()
+        self._data = None
+        self._lock = threading.Lock()
+
+    @property
+    def data(self):
+        with self._lock:
+            if self._data is None:
+                raw = self.raw
+                if self.headers.get('Content-Encoding') == 'deflate':
+                    raw = zlib.decompress(raw)
+                self._data = serialization.decode(raw)
+            return self._data
+
 
 class EmitterThread(threading.Thread):
+    """
+    Feeds the payloads to an emitter. Emitters get the decoded payload,
+    unless they have a true `raw_payload` attribute: they're given the
+    `EmitterPayload` then, and only pay for decoding it if they need to.
+    """
 
     def __init__(self, *args, **kwargs):
         self.__name = kwargs['name']
@@ -94,24 +135,49 @@ class EmitterThread(threading.Thread):
         self.__config = kwargs.pop('config')
         self.__max_queue_size = kwargs.pop('max_queue_size', 100)
         self.__queue = Queue(self.__max_queue_size)
+        self.__raw_payload = getattr(self.__emitter, 'raw_payload', False)
+        # Backpressure metrics
+        self.handled = 0
+        self.dropped = 0
+        self.latency_avg = None
+        self.latency_max = 0
         threading.Thread.__init__(self, *args, **kwargs)
         self.daemon = True
 
     def run(self):
         while True:
-            (data, headers) = self.__queue.get()
+            payload = self.__queue.get()
             try:
                 self.__logger.debug('Emitter %r handling a packet', self.__name)
-                self.__emitter(data, self.__logger, self.__config)
+                self.__emitter(payload if self.__raw_payload else payload.data, self.__logger, self.__config)
             except Exception:
                 self.__logger.error('Failure during operation of emitter %r', self.__name, exc_info=True)
+            self._record_latency(time.time() - payload.received_at)
 
-    def enqueue(self, data, headers):
+    def _record_latency(self, latency):
+        self.handled += 1
+        if self.latency_avg is None:
+            self.latency_avg = latency
+        else:
+            self.latency_avg += EMITTER_LATENCY_SMOOTHING * (latency - self.latency_avg)
+        self.latency_max = max(self.latency_max, latency)
+
+    def enqueue(self, payload):
         try:
-            self.__queue.put((data, headers), block=False)
+            self.__queue.put(payload, block=False)
         except Full:
+            self.dropped += 1
             self.__logger.warn('Dropping packet for %r due to backlog', self.__name)
 
+    def stats(self):
+        return {
+            'queue_depth': self.__queue.qsize(),
+            'handled': self.handled,
+            'dropped': self.dropped,
+            'latency_avg': self.latency_avg,
+            'latency_max': self.latency_max,
+        }
+
 
 class EmitterManager(object):
     """Track custom emitters"""
@@ -138,18 +204,209 @@ class EmitterManager(object):
 
     def send(self, data, headers=None):
         if not self.emitterThreads:
-            return  # bypass decompression/decoding
-        if headers and headers.get('Content-Encoding') == 'deflate':
-            data = zlib.decompress(data)
-        data = json_decode(data)
+            return
+        # Decoded by the emitters threads, once
+        payload = EmitterPayload(data, headers)
         for emitterThread in self.emitterThreads:
             logging.info('Queueing for emitter %r', emitterThread.name)
-            emitterThread.enqueue(data, headers)
+            emitterThread.enqueue(payload)
+
+    def stats(self):
+        """ Backpressure metrics, by emitter """
+        return dict((thread.name, thread.stats()) for thread in self.emitterThreads) or None
+
+
+def merge_payloads(merged, payload):
+    """
+    Merge the JSON object `payload` into `merged` if they only differ by the
+    content of their lists of records (see COALESCED_LISTS), and return True.
+    Leave `merged` untouched and return False otherwise.
+    """
+    if not _mergeable(merged, payload):
+        return False
+    _merge(merged, payload)
+    return True
+
+
+def _is_record_list(path):
+    return any(len(pattern) == len(path) and all(p in ('*', k) for p, k in zip(pattern, path))
+               for pattern in COALESCED_LISTS)
+
+
+def _mergeable(a, b, path=()):
+    for key in set(a) | set(b):
+        values = [v for v in (a.get(key), b.get(key)) if v is not None]
+        if _is_record_list(path + (key,)):
+            if not all(isinstance(v, list) for v in values):
+                return False
+        elif values and all(isinstance(v, dict) for v in values):
+            if not _mergeable(a.get(key) or {}, b.get(key) or {}, path + (key,)):
+                return False
+        elif a.get(key) != b.get(key) or key not in a or key not in b:
+            return False
+    return True
+
+
+def _merge(a, b, path=()):
+    for key, value in b.iteritems():
+        if _is_record_list(path + (key,)):
+            a.setdefault(key, []).extend(value or [])
+        elif isinstance(value, dict):
+            _merge(a.setdefault(key, {}), value, path + (key,))
+
+
+def _load_payload(data, headers):
+    """ JSON object posted to the forwarder, or None if it's something else """
+    if not data:
+        return None
+    encoding = headers.get('Content-Encoding')
+    try:
+        if encoding == 'deflate':
+            data = zlib.decompress(data)
+        elif encoding:
+            return None
+        payload = serialization.decode(data)
+    except (ValueError, zlib.error):
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
+class CoalescedPayload(object):
+    """ Payloads waiting to be sent together """
+
+    def __init__(self, cls, msg_type, data, headers, payload):
+        self.cls = cls
+        self.msg_type = msg_type
+        self.data = data
+        self.headers = headers
+        self.payload = payload
+        self.size = 0
+        self.count = 0
+        self.sources = {}
+        self.timeout = None
+        # Spool positions of the payloads, acked once they're sent together
+        self.positions = []
+
+    def add(self, data, source):
+        self.size += len(data)
+        self.count += 1
+        self.sources[source] = self.sources.get(source, 0) + 1
+
+
+class PayloadCoalescer(object):
+    """
+    Merge the payloads posted to the same intake endpoint within `window`
+    seconds, and up to `max_size` bytes, into a single transaction.
+
+    Only JSON objects which have the same values besides their lists of
+    records are merged, those lists are concatenated: e.g. events posted by
+    the same dogstatsd. Other payloads get their own transaction.
+
+    With the transactions `spool`, held payloads are written to it as
+    transactions of their own, and acked once the merged transaction is
+    spooled: they are replayed one by one if the forwarder stops before.
+    Without it, they are lost if it's killed within the window.
+    """
+
+    def __init__(self, window, max_size=None, spool=None):
+        self.window = window
+        self.max_size = max_size or COALESCE_MAX_SIZE
+        self.spool = spool
+        # (transaction class, message type) -> CoalescedPayloads
+        self.pending = {}
+
+    def add(self, cls, data, headers, msg_type, source):
+        """ Queue a payload, return its transaction if it's sent on its own right away """
+        payload = _load_payload(data, headers)
+        # Transactions waiting in the spool are sent first, the held
+        # payloads can't be written after them
+        if payload is None or (self.spool is not None and self.spool.has_unread()):
+            return cls(data, headers, msg_type, sources={source: 1})
+
+        pending = self.pending.setdefault((cls, msg_type), [])
+        for coalesced in pending:
+            if merge_payloads(coalesced.payload, payload):
+                break
+        else:
+            coalesced = CoalescedPayload(cls, msg_type, data, headers, payload)
+            coalesced.timeout = get_tornado_ioloop().add_timeout(time.time() + self.window,
+                                                                 lambda: self.flush(coalesced))
+            pending.append(coalesced)
+        coalesced.add(data, source)
+        self._hold(coalesced, data, headers, source)
+
+        if coalesced.size >= self.max_size:
+            self.flush(coalesced)
+        return None
+
+    def _hold(self, coalesced, data, headers, source):
+        if self.spool is None:
+            return
+        try:
+            record = coalesced.cls.spool_record(data, headers, coalesced.msg_type, {source: 1})
+            coalesced.positions.append(self.spool.append(record, read=True))
+        except Exception:
+            log.exception("Unable to spool payload, keeping it in memory only until it's sent")
+
+    def flush(self, coalesced):
+        key = (coalesced.cls, coalesced.msg_type)
+        pending = self.pending.get(key, [])
+        if coalesced not in pending:
+            return
+        pending.remove(coalesced)
+        if not pending:
+            del self.pending[key]
+        get_tornado_ioloop().remove_timeout(coalesced.timeout)
+
+        if coalesced.count == 1:
+            coalesced.cls(coalesced.data, coalesced.headers, coalesced.msg_type, sources=coalesced.sources)
+        else:
+            headers = dict(coalesced.headers)
+            for h in ('Content-Encoding', 'Content-MD5'):
+                headers.pop(h, None)
+            log.debug("Sending %s payloads to %s as one transaction" % (coalesced.count, coalesced.msg_type or 'intake'))
+            coalesced.cls(serialization.encode(coalesced.payload), headers, coalesced.msg_type, sources=coalesced.sources)
+        # Spooled again as part of the new transaction
+        for position in coalesced.positions:
+            self.spool.ack(position)
+
+    def flush_all(self):
+        for pending in self.pending.values():
+            for coalesced in list(pending):
+                self.flush(coalesced)
+
+
+def create_http_client(agentConfig, skip_ssl_validation=False):
+    proxies = None
+    proxy_settings = agentConfig.get('proxy_settings')
+    if proxy_settings:
+        log.debug("Configuring the HTTP client to use proxy settings: %s:****@%s:%s" % (
+            proxy_settings['user'], proxy_settings['host'], proxy_settings['port']))
+        credentials = ''
+        if proxy_settings.get('user'):
+            credentials = '%s:%s@' % (quote(proxy_settings['user'], ''), quote(proxy_settings.get('password') or '', ''))
+        proxy_url = 'http://%s%s:%s' % (credentials, proxy_settings['host'], proxy_settings['port'])
+        proxies = {'http': proxy_url, 'https': proxy_url}
+
+    if skip_ssl_validation:
+        # Already logged once at startup
+        requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
+
+    return PooledHTTPClient(
+        get_tornado_ioloop(),
+        max_connections=agentConfig.get('forwarder_max_connections'),
+        idle_timeout=agentConfig.get('forwarder_connection_idle_timeout'),
+        proxies=proxies,
+        verify=not skip_ssl_validation,
+        # Some proxies redirect POSTs, which would be turned into GETs
+        keep_method_on_redirect=agentConfig.get('proxy_forbid_method_switch'),
+    )
 
 
 class AgentTransaction(Transaction):
     _application = None
     _trManager = None
+    _http_client = None
     _endpoints = []
     _emitter_manager = None
     _type = None
@@ -159,6 +416,14 @@ class AgentTransaction(Transaction):
         cls._application = app
         cls._emitter_manager = EmitterManager(cls._application._agentConfig)
 
+    @classmethod
+    def get_http_client(cls):
+        """ The client every transaction is sent with, set up once from the config """
+        if AgentTransaction._http_client is None:
+            AgentTransaction._http_client = create_http_client(cls._application._agentConfig,
+                                                               cls._application.skip_ssl_validation)
+        return AgentTransaction._http_client
+
     @classmethod
     def set_tr_manager(cls, manager):
         cls._trManager = manager
@@ -178,26 +443,58 @@ class AgentTransaction(Transaction):
 
         cls._endpoints.append(SD_ENDPOINT)
 
-    def __init__(self, data, headers, msg_type=""):
+    def __init__(self, data, headers, msg_type="", sources=None):
         self._data = data
         self._headers = headers
         self._headers['SD-Forwarder-Version'] = get_version()
         self._msg_type = msg_type
 
-        # Call after data has been set (size is computed in Transaction's init)
-        Transaction.__init__(self)
-
         # Emitters operate outside the regular transaction framework
         if self._emitter_manager is not None:
             self._emitter_manager.send(data, headers)
 
+        # Keep the payload compressed while it's queued, it's sent as is
+        self._compress()
+
+        # Call after data has been set (size is computed in Transaction's init)
+        Transaction.__init__(self)
+        self._sources = sources
+
         # Insert the transaction in the Manager
         self._trManager.append(self)
         log.debug("Created transaction %d" % self.get_id())
         self._trManager.flush()
 
+    def _compress(self):
+        if not self._data or self._headers.get('Content-Encoding'):
+            return
+        self._data = zlib.compress(self._data)
+        self._headers['Content-Encoding'] = 'deflate'
+        # The digest is the one of the body as sent
+        if self._headers.get('Content-MD5'):
+            self._headers['Content-MD5'] = md5(self._data).hexdigest()
+
     def __sizeof__(self):
-        return sys.getsizeof(self._data)
+        # Everything the transaction keeps around while it's queued
+        size = object.__sizeof__(self) + sys.getsizeof(self.__dict__) + sys.getsizeof(self._data)
+        size += sys.getsizeof(self._headers)
+        for name, value in self._headers.iteritems():
+            size += sys.getsizeof(name) + sys.getsizeof(value)
+        return size
+
+    @classmethod
+    def spool_record(cls, data, headers, msg_type, sources):
+        """ Spool record of a transaction of this type, read by `load_transaction` """
+        return json.dumps({
+            'type': cls.__name__,
+            'data': base64.b64encode(data),
+            'headers': dict(headers),
+            'msg_type': msg_type,
+            'sources': sources,
+        })
+
+    def serialize(self):
+        return self.spool_record(self._data, self._headers, self._msg_type, self._sources)
 
     def get_url(self, endpoint):
         endpoint_base_url = self._application._agentConfig[endpoint]
@@ -208,6 +505,7 @@ class AgentTransaction(Transaction):
         return "{0}/intake/{1}".format(endpoint_base_url, self._msg_type)
 
     def flush(self):
+        http_client = self.get_http_client()
         for endpoint in self._endpoints:
             url = self.get_url(endpoint)
             log.debug(
@@ -215,59 +513,9 @@ class AgentTransaction(Transaction):
                 self._type, endpoint, url
             )
 
-            # Getting proxy settings
-            proxy_settings = self._application._agentConfig.get('proxy_settings', None)
-
-            tornado_client_params = {
-                'url': url,
-                'method': 'POST',
-                'body': self._data,
-                'headers': self._headers,
-                'validate_cert': not self._application.skip_ssl_validation,
-                'allow_ipv6': True,
-            }
-
             # Remove headers that were passed by the emitter. Those don't apply anymore
-            # This is pretty hacky though as it should be done in pycurl or curl or tornado
-            for h in HEADERS_TO_REMOVE:
-                if h in tornado_client_params['headers']:
-                    del tornado_client_params['headers'][h]
-                    log.debug("Removing {0} header.".format(h))
-
-            force_use_curl = False
-
-            if proxy_settings is not None:
-                force_use_curl = True
-                if pycurl is not None:
-                    log.debug("Configuring tornado to use proxy settings: %s:****@%s:%s" % (proxy_settings['user'],
-                              proxy_settings['host'], proxy_settings['port']))
-                    tornado_client_params['proxy_host'] = proxy_settings['host']
-                    tornado_client_params['proxy_port'] = proxy_settings['port']
-                    tornado_client_params['proxy_username'] = proxy_settings['user']
-                    tornado_client_params['proxy_password'] = proxy_settings['password']
-
-                    if self._application._agentConfig.get('proxy_forbid_method_switch'):
-                        # See http://stackoverflow.com/questions/8156073/curl-violate-rfc-2616-10-3-2-and-switch-from-post-to-get
-                        tornado_client_params['prepare_curl_callback'] = lambda curl: curl.setopt(pycurl.POSTREDIR, pycurl.REDIR_POST_ALL)
-
-            # Disable this feature, it needs more testing.
-            # if (not self._application.use_simple_http_client or force_use_curl) and pycurl is not None:
-            #     ssl_certificate = self._application._agentConfig.get('ssl_certificate', None)
-            #     tornado_client_params['ca_certs'] = ssl_certificate
-
-            req = tornado.httpclient.HTTPRequest(**tornado_client_params)
-            use_curl = force_use_curl or self._application._agentConfig.get("use_curl_http_client") and not self._application.use_simple_http_client
-
-            if use_curl:
-                if pycurl is None:
-                    log.error("sd-agent is configured to use the Curl HTTP Client, but pycurl is not available on this system.")
-                else:
-                    log.debug("Using CurlAsyncHTTPClient")
-                    tornado.httpclient.AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
-            else:
-                log.debug("Using SimpleHTTPClient")
-            http = tornado.httpclient.AsyncHTTPClient()
-            http.fetch(req, callback=self.on_response)
+            headers = dict((h, v) for h, v in self._headers.iteritems() if h not in HEADERS_TO_REMOVE)
+            http_client.fetch(url, self._data, headers, self.on_response)
 
     def on_response(self, response):
         if response.error:
@@ -275,9 +523,11 @@ class AgentTransaction(Transaction):
             if response.code == 413:
                 self._trManager.tr_error_too_big(self)
             else:
-                self._trManager.tr_error(self)
+                self._trManager.tr_error(self, response.code)
         else:
-            self._trManager.tr_success(self)
+            # Up to the window of requests are handed to the client at once,
+            # only the time since a worker picked it up tells the endpoint's latency
+            self._trManager.tr_success(self, response.request_time)
 
         self._trManager.flush_next()
 
@@ -310,6 +560,26 @@ class APIServiceCheckTransaction(AgentTransaction):
         return url
 
 
+SPOOLED_TRANSACTION_TYPES = dict((cls.__name__, cls) for cls in [
+    MetricTransaction,
+    APIMetricTransaction,
+    APIServiceCheckTransaction,
+])
+
+
+def load_transaction(record):
+    """ Rebuild a transaction from its spool record, without queuing it. """
+    spooled = json.loads(record)
+    cls = SPOOLED_TRANSACTION_TYPES[spooled['type']]
+    tr = cls.__new__(cls)
+    tr._data = base64.b64decode(spooled['data'])
+    tr._headers = spooled['headers']
+    tr._msg_type = spooled['msg_type']
+    Transaction.__init__(tr)
+    tr._sources = spooled.get('sources')
+    return tr
+
+
 class StatusHandler(tornado.web.RequestHandler):
 
     def get(self):
@@ -340,13 +610,18 @@ class AgentInputHandler(tornado.web.RequestHandler):
         headers = self.request.headers
         msg_type = self._MSG_TYPE
 
-        if msg is not None:
-            # Setup a transaction for this message
-            tr = MetricTransaction(msg, headers, msg_type)
-        else:
+        if msg is None:
             raise tornado.web.HTTPError(500)
 
-        self.write("Transaction: %s" % tr.get_id())
+        source = "%s (%s)" % (headers.get('User-Agent', 'unknown'), self.request.remote_ip)
+        coalescer = self.application._coalescer
+        if coalescer is not None:
+            tr = coalescer.add(MetricTransaction, msg, headers, msg_type, source)
+        else:
+            # Setup a transaction for this message
+            tr = MetricTransaction(msg, headers, msg_type, sources={source: 1})
+
+        self.write("Transaction: %s" % (tr.get_id() if tr is not None else "pending"))
 
 
 class MetricsAgentInputHandler(AgentInputHandler):
@@ -393,20 +668,31 @@ class ApiCheckRunHandler(tornado.web.RequestHandler):
 
 class Application(tornado.web.Application):
 
-    def __init__(self, port, agentConfig, watchdog=True,
-                 skip_ssl_validation=False, use_simple_http_client=False):
+    def __init__(self, port, agentConfig, watchdog=True, skip_ssl_validation=False):
         self._port = int(port)
         self._agentConfig = agentConfig
-        self._metrics = {}
+        self._graphite_points = None
         AgentTransaction.set_application(self)
         AgentTransaction.set_endpoints()
+        spool = self._create_spool()
         self._tr_manager = TransactionManager(MAX_WAIT_FOR_REPLAY,
-                                              MAX_QUEUE_SIZE, THROTTLING_DELAY)
+                                              MAX_QUEUE_SIZE, THROTTLING_DELAY,
+                                              spool=spool,
+                                              load_transaction=load_transaction,
+                                              connection_stats=self._connection_stats,
+                                              emitter_stats=AgentTransaction._emitter_manager.stats,
+                                              graphite_stats=self._graphite_stats)
         AgentTransaction.set_tr_manager(self._tr_manager)
 
+        self._coalescer = None
+        coalesce_window = agentConfig.get('forwarder_coalesce_window')
+        if coalesce_window:
+            self._coalescer = PayloadCoalescer(coalesce_window / 1000.0,
+                                               agentConfig.get('forwarder_coalesce_max_size'),
+                                               spool=spool)
+
         self._watchdog = None
         self.skip_ssl_validation = skip_ssl_validation or agentConfig.get('skip_ssl_validation', False)
-        self.use_simple_http_client = use_simple_http_client
         if self.skip_ssl_validation:
             log.info("Skipping SSL hostname validation, useful when using a transparent proxy")
 
@@ -419,6 +705,30 @@ class Application(tornado.web.Application):
                 max_resets=WATCHDOG_HIGH_ACTIVITY_THRESHOLD
             )
 
+    def _connection_stats(self):
+        if AgentTransaction._http_client is None:
+            return None
+        return AgentTransaction._http_client.stats()
+
+    def _graphite_stats(self):
+        if self._graphite_points is None:
+            return None
+        return self._graphite_points.stats()
+
+    def _create_spool(self):
+        spool_dir = self._agentConfig.get('forwarder_spool_dir')
+        if not spool_dir:
+            return None
+        try:
+            spool = Spool(spool_dir,
+                          max_size=self._agentConfig.get('forwarder_spool_max_size'),
+                          fsync=self._agentConfig.get('forwarder_spool_fsync'))
+        except Exception:
+            log.exception("Unable to open the transaction spool in %s, transactions will only be kept in memory" % spool_dir)
+            return None
+        log.info("Spooling transactions to %s" % spool_dir)
+        return spool
+
     def log_request(self, handler):
         """ Override the tornado logging method.
         If everything goes well, log level is DEBUG.
@@ -437,28 +747,17 @@ class Application(tornado.web.Application):
             handler._request_summary(), request_time
         )
 
-    def appendMetric(self, prefix, name, host, device, ts, value):
-
-        if prefix in self._metrics:
-            metrics = self._metrics[prefix]
-        else:
-            metrics = {}
-            self._metrics[prefix] = metrics
-
-        if name in metrics:
-            metrics[name].append([host, device, ts, value])
-        else:
-            metrics[name] = [[host, device, ts, value]]
-
     def _postMetrics(self):
-
-        if len(self._metrics) > 0:
-            self._metrics['uuid'] = get_uuid()
-            self._metrics['internalHostname'] = get_hostname(self._agentConfig)
-            self._metrics['agentKey'] = self._agentConfig['agent_key']
-            MetricTransaction(json.dumps(self._metrics),
-                              headers={'Content-Type': 'application/json'})
-            self._metrics = {}
+        if self._graphite_points is None or not self._graphite_points.count:
+            return
+        metrics = {
+            'graphite': self._graphite_points.flush(),
+            'uuid': get_uuid(),
+            'internalHostname': get_hostname(self._agentConfig),
+            'agentKey': self._agentConfig['agent_key'],
+        }
+        MetricTransaction(serialization.encode(metrics),
+                          headers={'Content-Type': 'application/json'})
 
     def run(self):
         handlers = [
@@ -526,8 +825,9 @@ class Application(tornado.web.Application):
         gport = self._agentConfig.get("graphite_listen_port", None)
         if gport is not None:
             log.info("Starting graphite listener on port %s" % gport)
-            from graphite import GraphiteServer
-            gs = GraphiteServer(self, get_hostname(self._agentConfig), io_loop=self.mloop)
+            from graphite import GraphitePoints, GraphiteServer
+            self._graphite_points = GraphitePoints(self._agentConfig.get('graphite_max_points'))
+            gs = GraphiteServer(self._graphite_points, get_hostname(self._agentConfig), io_loop=self.mloop)
             if non_local_traffic is True:
                 gs.listen(gport)
             else:
@@ -539,13 +839,18 @@ class Application(tornado.web.Application):
         tr_sched.start()
 
         self.mloop.start()
+        if self._coalescer is not None:
+            self._coalescer.flush_all()
+        self._tr_manager.close()
+        if AgentTransaction._http_client is not None:
+            AgentTransaction._http_client.close()
         log.info("Stopped")
 
     def stop(self):
         self.mloop.stop()
 
 
-def init(skip_ssl_validation=False, use_simple_http_client=False):
+def init(skip_ssl_validation=False):
     agentConfig = get_config(parse_args=False)
 
     port = agentConfig.get('listen_port', 17124)
@@ -554,7 +859,7 @@ def init(skip_ssl_validation=False, use_simple_http_client=False):
     else:
         port = int(port)
 
-    app = Application(port, agentConfig, skip_ssl_validation=skip_ssl_validation, use_simple_http_client=use_simple_http_client)
+    app = Application(port, agentConfig, skip_ssl_validation=skip_ssl_validation)
 
     def sigterm_handler(signum, frame):
         log.info("caught sigterm. stopping")
@@ -573,20 +878,20 @@ def main():
     deprecate_old_command_line_tools()
 
     define("sslcheck", default=1, help="Verify SSL hostname, on by default")
-    define("use_simple_http_client", default=0, help="Use Tornado SimpleHTTPClient instead of CurlAsyncHTTPClient")
+    define("use_simple_http_client", default=0, help="Deprecated, the forwarder always uses its own pooled HTTP client")
     args = parse_command_line()
     skip_ssl_validation = False
-    use_simple_http_client = False
 
     if unicode(options.sslcheck) == u"0":
         skip_ssl_validation = True
 
     if unicode(options.use_simple_http_client) == u"1":
-        use_simple_http_client = True
+        log.warning("--use_simple_http_client is deprecated and has no effect, "
+                    "the forwarder always uses its own pooled HTTP client")
 
     # If we don't have any arguments, run the server.
     if not args:
-        app = init(skip_ssl_validation, use_simple_http_client=use_simple_http_client)
+        app = init(skip_ssl_validation)
         try:
             app.run()
         except Exception:
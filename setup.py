@@ -62,8 +62,6 @@ if sys.platform == 'win32':
         'win32event',
         'simplejson',
         'adodbapi',
-        'pycurl',
-        'tornado.curl_httpclient',
         'pymongo',
         'pymysql',
         'psutil',
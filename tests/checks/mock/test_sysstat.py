@@ -3,11 +3,16 @@ import logging
 import sys
 import unittest
 
+# 3p
+from mock import patch
+
 # project
 from checks.system.unix import (
     IO,
     Load,
     Memory,
+    Processes,
+    PROCESSES_FULL_RUNS,
 )
 from checks.system.unix import System
 from config import get_system_stats
@@ -141,6 +146,52 @@ dm-1              0.00     0.00    0.00    0.00     0.00     0.00     0.00     0
         results = checker._parse_linux2(linux_output_dashes)
         self.assertTrue(sorted(results.keys()) == ['dm-0', 'dm-1', 'sda'])
 
+    def process_tables(self, mode, tables):
+        """ Results of the processes check in `mode` for each of the process `tables` """
+        processes = Processes(logger)
+        agentConfig = {'agent_key': 'key', 'hostname': 'myhost', 'processes_mode': mode, 'processes_top': 2}
+        results = []
+        with patch('checks.system.unix.Platform.is_linux', return_value=True):
+            with patch.object(processes._process_table, 'read', side_effect=tables):
+                for _ in tables:
+                    results.append(processes.check(agentConfig))
+        return results
+
+    def testProcessesDelta(self):
+        init = ['root', '1', '0.0', '0.1', '34000', '4000', '?', 'Ss', '09:00', '0:01', '/sbin/init']
+        cron = ['root', '400', '0.0', '0.0', '2000', '1000', '?', 'Ss', '09:00', '0:00', 'cron']
+        web = ['www-data', '500', '1.0', '2.0', '90000', '40000', '?', 'S', '09:00', '0:10', 'nginx: worker']
+        web_busier = web[:9] + ['0:11', web[10]]
+        tables = [[init, cron, web], [init, cron, web_busier], [init, web_busier]] + \
+            [[init, web_busier]] * (PROCESSES_FULL_RUNS - 2)
+        results = self.process_tables('delta', tables)
+
+        # Everything at first
+        self.assertEqual(results[0]['processes'], [init, cron, web])
+        self.assertFalse(results[0].get('delta'))
+        # Then what changed
+        self.assertTrue(results[1]['delta'])
+        self.assertEqual(results[1]['processes'], [web_busier])
+        self.assertEqual(results[1]['exitedPids'], [])
+        self.assertEqual(results[2]['processes'], [])
+        self.assertEqual(results[2]['exitedPids'], ['400'])
+        self.assertEqual(results[3]['processes'], [])
+        # And everything again from time to time
+        self.assertEqual(results[-1]['processes'], [init, web_busier])
+        self.assertFalse(results[-1].get('delta'))
+
+    def testProcessesTop(self):
+        table = [
+            ['root', '1', '0.0', '0.1', '34000', '4000', '?', 'Ss', '09:00', '0:01', '/sbin/init'],
+            ['mysql', '300', '12.5', '30.0', '900000', '600000', '?', 'Sl', '09:00', '90:00', 'mysqld'],
+            ['root', '400', '0.0', '0.0', '2000', '1000', '?', 'Ss', '09:00', '0:00', 'cron'],
+            ['www-data', '500', '1.0', '2.0', '90000', '40000', '?', 'S', '09:00', '0:10', 'nginx: worker'],
+            ['root', '600', '3.0', '0.0', '1000', '800', 'pts/0', 'R+', '09:00', '0:01', 'gzip'],
+        ]
+        result = self.process_tables('top', [table])[0]
+        self.assertEqual([row[1] for row in result['processes']], ['300', '500', '600'])
+        self.assertEqual(result['processCount'], 5)
+
     def testNetwork(self):
         # FIXME: cx_state to true, but needs sysstat installed
         config = """
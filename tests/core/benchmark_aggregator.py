@@ -2,7 +2,20 @@
 """
 Performance tests for the agent/dogstatsd metrics aggregator.
 """
-from aggregator import MetricsAggregator, MetricsBucketAggregator
+# stdlib
+import multiprocessing
+import random
+import resource
+import socket
+import sys
+import threading
+import time
+import timeit
+
+# project
+from aggregator import api_formatter, Histogram, MetricsAggregator, MetricsBucketAggregator, SketchHistogram
+from dogstatsd import serialize_metrics, serialize_metrics_chunks, ServerPool
+from tests.core.test_dogstatsd import legacy_parse_metric_packet
 
 
 class TestAggregatorPerf(object):
@@ -106,6 +119,247 @@ class TestAggregatorPerf(object):
 
             ma.flush()
 
+
+class TestHistogramPerf(object):
+    """
+    Compares the exact and sketch histograms: flush time, size of the state
+    kept between flushes and error of the reported percentiles.
+    """
+
+    SAMPLE_COUNTS = [1000, 100000, 1000000]
+    PERCENTILES = [0.5, 0.95, 0.99]
+
+    def _state_size(self, histogram):
+        # Approximate: containers and the floats they hold
+        if histogram.samples is not None:
+            return sys.getsizeof(histogram.samples) + 24 * len(histogram.samples)
+        sketch = histogram.sketch
+        bins = sketch.positive_bins, sketch.negative_bins
+        return sum(sys.getsizeof(b) + 48 * len(b) for b in bins)
+
+    def test_histogram_sketch_vs_exact(self):
+        config = {'aggregates': ['median'], 'percentiles': self.PERCENTILES}
+        formatter = lambda metric, value, **kwargs: (metric, value)
+
+        for sample_count in self.SAMPLE_COUNTS:
+            values = [random.lognormvariate(3, 1.5) for _ in xrange(sample_count)]
+            results = {}
+            for cls in (Histogram, SketchHistogram):
+                histogram = cls(formatter, 'h', None, None, None, config)
+                start = time.time()
+                for value in values:
+                    histogram.sample(value, 1)
+                size = self._state_size(histogram)
+                metrics = dict(histogram.flush(0, 10))
+                results[cls] = (time.time() - start, size, metrics)
+
+            exact_metrics = results[Histogram][2]
+            for cls, (duration, size, metrics) in sorted(results.items()):
+                max_error = max(abs(metrics[name] - value) / value
+                                for name, value in exact_metrics.iteritems())
+                print "%s samples, %s: %.2fs, %s KB of state, max relative error %.4f" % (
+                    sample_count, cls.__name__, duration, size / 1024, max_error)
+
+
+class TestBucketFlushPerf(object):
+    """
+    MetricsBucketAggregator flush time with many live counters: a first
+    flush where every counter was sampled, then one where only a few were
+    and the others report zeros.
+    """
+
+    CONTEXT_COUNTS = [10000, 100000, 1000000]
+    TOUCHED_COUNT = 10000
+    INTERVAL = 10
+
+    def test_flush_time(self):
+        for context_count in self.CONTEXT_COUNTS:
+            aggregator = MetricsBucketAggregator('my.host', interval=self.INTERVAL)
+            tags = [['shard:%s' % i] for i in xrange(context_count)]
+
+            # Samples in past buckets, for the flushes to pick them up
+            timestamp = time.time() - 2 * self.INTERVAL
+            for i in xrange(context_count):
+                aggregator.submit_metric('bench.counter', 1, 'c', tags=tags[i], timestamp=timestamp)
+            start = time.time()
+            flushed = len(aggregator.flush())
+            full_flush = time.time() - start
+
+            timestamp += self.INTERVAL
+            for i in xrange(min(self.TOUCHED_COUNT, context_count)):
+                aggregator.submit_metric('bench.counter', 1, 'c', tags=tags[i], timestamp=timestamp)
+            start = time.time()
+            zero_flushed = len(aggregator.flush())
+            zero_flush = time.time() - start
+
+            print "%s contexts: all sampled %.2fs (%s metrics), %s sampled %.2fs (%s metrics)" % (
+                context_count, full_flush, flushed, self.TOUCHED_COUNT, zero_flush, zero_flushed)
+
+
+class TestParserPerf(object):
+    """
+    ns/packet of the dogstatsd metric packet parser for the common packet shapes.
+    """
+
+    REPEAT = 5
+    NUMBER = 20000
+    SHAPES = [
+        ('untagged', 'page.views:1|c'),
+        ('tagged', 'page.views:1|c|#env:prod,role:web,service:api'),
+        ('unsorted tags', 'page.views:1|c|#service:api,role:web,env:prod'),
+        ('sampled', 'song.length:240|ms|@0.5|#env:prod'),
+        ('multi-value', 'page.views:1|c|#env:prod:2|c|#env:prod:3|c|#env:prod'),
+    ]
+
+    def _ns_per_packet(self, parser, packet):
+        timer = timeit.Timer(lambda: parser(packet))
+        return min(timer.repeat(self.REPEAT, self.NUMBER)) / self.NUMBER * 1e9
+
+    def test_parse_metric_packet_perf(self):
+        ma = MetricsBucketAggregator('my.host')
+        for shape, packet in self.SHAPES:
+            legacy = self._ns_per_packet(legacy_parse_metric_packet, packet)
+            current = self._ns_per_packet(ma.parse_metric_packet, packet)
+            print "%-14s legacy: %6d ns/packet, current: %6d ns/packet" % (shape, legacy, current)
+
+
+def _blast(port, packet_count):
+    # Datagrams carrying several metrics each, like most statsd clients send
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    message = '\n'.join(['bench.counter.%s:1|c|#tag1,tag2' % i for i in xrange(10)])
+    for _ in xrange(packet_count):
+        sock.sendto(message, ('127.0.0.1', port))
+
+
+class TestServerPoolPerf(object):
+    """
+    Packets/s sustained by a dogstatsd ServerPool depending on its number of
+    SO_REUSEPORT receiver processes.
+    """
+
+    SENDERS = 8
+    PACKETS_PER_SENDER = 50000
+    WORKER_COUNTS = [1, 2, 4]
+
+    def _free_port(self):
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        return port
+
+    def _run(self, workers):
+        port = self._free_port()
+        aggregator = MetricsBucketAggregator('my.host', interval=10)
+        pool = ServerPool(aggregator, lambda: MetricsBucketAggregator('my.host', interval=10),
+                          '127.0.0.1', port, workers)
+        runner = threading.Thread(target=pool.start)
+        runner.start()
+        time.sleep(0.5)
+
+        senders = [multiprocessing.Process(target=_blast, args=(port, self.PACKETS_PER_SENDER))
+                   for _ in xrange(self.SENDERS)]
+        start = time.time()
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        # Let the receivers catch up with their socket buffers
+        time.sleep(0.5)
+        pool.drain()
+        elapsed = time.time() - start - 0.5
+
+        pool.stop()
+        runner.join()
+
+        received = aggregator.count
+        sent = self.SENDERS * self.PACKETS_PER_SENDER * 10
+        return received, sent, elapsed
+
+    def test_dogstatsd_reuseport_scaling(self):
+        for workers in self.WORKER_COUNTS:
+            received, sent, elapsed = self._run(workers)
+            print "%s receiver(s): %s/%s packets in %.2fs, %d packets/s (%.1f%% dropped)" % (
+                workers, received, sent, elapsed, received / elapsed,
+                100.0 * (sent - received) / sent)
+
+
+def _resident_bytes():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def _measure_contexts(context_count, results):
+    # Runs in a fresh process, so that the RSS delta is only the aggregator's
+    aggregator = MetricsBucketAggregator('my.host', interval=10)
+    start = _resident_bytes()
+    for i in xrange(context_count):
+        mtype = 'cghs'[i % 4]
+        aggregator.submit_packets('bench.%s.%s:%s|%s|#service:web,shard:%s' % (
+            mtype, i % 1000, i, mtype, i))
+    metrics = aggregator.current_mbc.values()
+    object_bytes = sum(sys.getsizeof(m) + sys.getsizeof(getattr(m, '__dict__', None))
+                       for m in metrics[:1000]) / float(min(1000, len(metrics)))
+    results.put(((_resident_bytes() - start) / float(context_count), object_bytes))
+
+
+class TestMetricMemoryPerf(object):
+    """
+    Memory used by MetricsBucketAggregator for each live context: RSS growth
+    and size of a metric object.
+    """
+
+    CONTEXT_COUNTS = [10000, 100000, 1000000]
+
+    def test_bytes_per_context(self):
+        for context_count in self.CONTEXT_COUNTS:
+            results = multiprocessing.Queue()
+            child = multiprocessing.Process(target=_measure_contexts, args=(context_count, results))
+            child.start()
+            rss_per_context, object_bytes = results.get()
+            child.join()
+            print "%s contexts: %d bytes/context RSS, %d bytes/metric object" % (
+                context_count, rss_per_context, object_bytes)
+
+
+def _measure_serialization(series_count, chunked, results):
+    # Runs in a fresh process, so that the peak RSS is only reached by this serialization
+    metrics = [api_formatter('bench.series.%s' % (i % 1000), i, time.time(), ('service:web', 'shard:%s' % i), 'my.host')
+               for i in xrange(series_count)]
+    start_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    if chunked:
+        payload_bytes = sum(len(body) for body, _ in serialize_metrics_chunks(metrics, 'my.host'))
+    else:
+        payload_bytes = len(serialize_metrics(metrics, 'my.host')[0])
+    duration = time.time() - start
+    # ru_maxrss is in kilobytes on linux
+    peak_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_peak
+    results.put((duration, peak_growth * 1024, payload_bytes))
+
+
+class TestSerializationPerf(object):
+    """
+    Time and peak RSS growth of the dogstatsd series serialization, as a
+    single payload and in chunks.
+    """
+
+    SERIES_COUNTS = [10000, 100000, 300000]
+
+    def test_serialization_peak_memory(self):
+        for series_count in self.SERIES_COUNTS:
+            for chunked in (False, True):
+                results = multiprocessing.Queue()
+                child = multiprocessing.Process(target=_measure_serialization,
+                                                args=(series_count, chunked, results))
+                child.start()
+                duration, peak_growth, payload_bytes = results.get()
+                child.join()
+                print "%s series, %s: %.2fs, peak RSS +%d KiB, %d KiB sent" % (
+                    series_count, 'chunked' if chunked else 'single payload', duration,
+                    peak_growth / 1024, payload_bytes / 1024)
+
+
 if __name__ == '__main__':
     t = TestAggregatorPerf()
     #t.test_dogstatsd_aggregation_perf()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Performance tests for the forwarder, running in a child process between
+local senders and a stand-in intake.
+"""
+# stdlib
+import BaseHTTPServer
+import os
+import signal
+import socket
+import SocketServer
+import threading
+import time
+import zlib
+
+# 3p
+import requests
+import simplejson as json
+
+
+class IntakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'deflate':
+            body = zlib.decompress(body)
+        self.server.received.append((time.time(), json.loads(body)))
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Intake(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), IntakeHandler)
+        self.received = []
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class TestCoalescingPerf(object):
+    """
+    Upstream requests and end-to-end latency of event payloads posted by
+    several dogstatsd-like sources, with and without coalescing.
+    """
+
+    SOURCES = 4
+    PAYLOADS_PER_SOURCE = 50
+    POST_INTERVAL = 0.1
+    COALESCE_WINDOWS = [None, 500, 2000]
+
+    def _start_forwarder(self, port, intake_url, window):
+        pid = os.fork()
+        if pid == 0:
+            from sdagent import Application
+            config = {
+                'sd_url': intake_url,
+                'agent_key': 'benchmark',
+                'bind_host': '127.0.0.1',
+                'forwarder_coalesce_window': window,
+            }
+            try:
+                Application(port, config, watchdog=False).run()
+            finally:
+                os._exit(0)
+
+        for _ in xrange(100):
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except socket.error:
+                time.sleep(0.1)
+        return pid
+
+    def _send(self, port, source):
+        session = requests.Session()
+        url = 'http://127.0.0.1:%s/intake/' % port
+        for i in xrange(self.PAYLOADS_PER_SOURCE):
+            payload = {
+                'uuid': 'source-%s' % source,
+                'internalHostname': 'host-%s' % source,
+                'events': {'api': [{'title': 'event %s' % i, 'sent_at': time.time()}]},
+            }
+            session.post(url, data=json.dumps(payload), headers={'Content-Type': 'application/json'})
+            time.sleep(self.POST_INTERVAL)
+
+    def test_coalescing(self):
+        expected = self.SOURCES * self.PAYLOADS_PER_SOURCE
+        for window in self.COALESCE_WINDOWS:
+            intake = Intake()
+            intake_thread = threading.Thread(target=intake.serve_forever)
+            intake_thread.daemon = True
+            intake_thread.start()
+            port = free_port()
+            pid = self._start_forwarder(port, 'http://127.0.0.1:%s' % intake.server_address[1], window)
+            try:
+                senders = [threading.Thread(target=self._send, args=(port, source))
+                           for source in xrange(self.SOURCES)]
+                for sender in senders:
+                    sender.start()
+                for sender in senders:
+                    sender.join()
+
+                latencies = []
+                deadline = time.time() + 60
+                while len(latencies) < expected and time.time() < deadline:
+                    time.sleep(0.5)
+                    latencies = [received_at - event['sent_at']
+                                 for received_at, payload in intake.received
+                                 for event in payload['events']['api']]
+            finally:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                intake.shutdown()
+                intake.server_close()
+
+            latencies.sort()
+            print "coalescing window %5sms: %s payloads in %s upstream requests, latency p50 %.2fs, p99 %.2fs" % (
+                window or 0, len(latencies), len(intake.received),
+                latencies[len(latencies) / 2], latencies[int(len(latencies) * 0.99)])
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Performance tests for the graphite listener, fed by local relays running in
+child processes.
+"""
+# stdlib
+import cPickle as pickle
+import os
+import socket
+import struct
+import time
+
+# 3p
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+
+# project
+from graphite import GraphitePoints, GraphiteServer
+from utils import serialization
+
+
+def plaintext_payload(point_count, metric_count):
+    now = int(time.time())
+    return ''.join('servers.web%s.cpu.user %s %s\n' % (i % metric_count, i * 0.5, now)
+                   for i in xrange(point_count))
+
+
+def pickle_payload(point_count, metric_count, frame_points=500):
+    now = int(time.time())
+    frames = []
+    for start in xrange(0, point_count, frame_points):
+        data = pickle.dumps([('servers.web%s.cpu.user' % (i % metric_count), (now, i * 0.5))
+                             for i in xrange(start, min(start + frame_points, point_count))], protocol=2)
+        frames.append(struct.pack('!L', len(data)) + data)
+    return ''.join(frames)
+
+
+class TestGraphiteListenerPerf(object):
+    """
+    Points/s parsed by the listener over plaintext and pickle connections,
+    and time to turn what it holds into a payload.
+    """
+
+    POINTS_PER_RELAY = 200000
+    METRIC_COUNT = 1000
+    RELAYS = [1, 4]
+
+    def _relay(self, port, payload):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                sock = socket.create_connection(('127.0.0.1', port))
+                sock.sendall(payload)
+                sock.close()
+            finally:
+                os._exit(0)
+        return pid
+
+    def _run(self, payload, relays):
+        io_loop = IOLoop()
+        points = GraphitePoints(max_points=self.POINTS_PER_RELAY * relays)
+        sock, port = bind_unused_port()
+        server = GraphiteServer(points, 'myhost', io_loop=io_loop)
+        server.add_sockets([sock])
+        expected = self.POINTS_PER_RELAY * relays
+        deadline = time.time() + 120
+
+        def check():
+            if points.received_count >= expected or time.time() > deadline:
+                io_loop.stop()
+            else:
+                io_loop.add_timeout(io_loop.time() + 0.005, check)
+
+        start = time.time()
+        pids = [self._relay(port, payload) for _ in xrange(relays)]
+        check()
+        io_loop.start()
+        duration = time.time() - start
+        for pid in pids:
+            os.waitpid(pid, 0)
+        server.stop()
+        io_loop.close(all_fds=True)
+
+        start = time.time()
+        serialization.encode({'graphite': points.flush()})
+        return points.received_count, duration, time.time() - start
+
+    def test_throughput(self):
+        payloads = [
+            ('plaintext', plaintext_payload(self.POINTS_PER_RELAY, self.METRIC_COUNT)),
+            ('pickle', pickle_payload(self.POINTS_PER_RELAY, self.METRIC_COUNT)),
+        ]
+        for protocol, payload in payloads:
+            for relays in self.RELAYS:
+                received, duration, flush = self._run(payload, relays)
+                print "%-9s %s relay(s): %s points in %.2fs, %d points/s, flushed in %.2fs" % (
+                    protocol, relays, received, duration, received / duration, flush)
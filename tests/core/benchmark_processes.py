@@ -0,0 +1,82 @@
+"""
+Performance tests for the process table, read from synthetic /proc trees.
+"""
+# stdlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+# 3p
+from mock import patch
+
+# project
+from checks.system.unix import Processes
+from utils import serialization
+from utils.procfs import ProcessTable
+
+log = logging.getLogger(__name__)
+
+
+def write(path, data):
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+def write_process(proc, pid, utime):
+    os.mkdir(os.path.join(proc, str(pid)))
+    write(os.path.join(proc, str(pid), 'stat'),
+          '%s (worker) S 1 %s %s 0 -1 4194560 100 0 0 0 %s 100 0 0 20 0 1 0 %s 104857600 2500 '
+          '18446744073709551615 1 1 0 0 0 0 0 4096 0 0 0 0 17 0 0 0 0 0 0\n'
+          % (pid, pid, pid, utime, 1000 + pid))
+    write(os.path.join(proc, str(pid), 'cmdline'),
+          '/usr/bin/worker\0--queue\0jobs-%s\0--concurrency\08\0' % (pid % 100))
+
+
+def make_proc_tree(count):
+    proc = tempfile.mkdtemp()
+    write(os.path.join(proc, 'stat'), 'cpu  1 2 3 4\nbtime %s\n' % int(time.time() - 86400))
+    write(os.path.join(proc, 'uptime'), '86400.00 160000.00\n')
+    write(os.path.join(proc, 'meminfo'), 'MemTotal:       16000000 kB\n')
+    for pid in xrange(1, count + 1):
+        write_process(proc, pid, pid % 1000)
+    return proc
+
+
+class TestProcessTablePerf(object):
+    """
+    Time to read the process table, cold and with the static fields cached,
+    and size of the payload in each mode when 1% of the processes changed.
+    """
+
+    PROCESS_COUNTS = [1000, 10000, 50000]
+
+    def _payload_size(self, mode, table, changed):
+        processes = Processes(log)
+        agentConfig = {'agent_key': 'key', 'hostname': 'myhost', 'processes_mode': mode}
+        with patch('checks.system.unix.Platform.is_linux', return_value=True):
+            with patch.object(processes._process_table, 'read', side_effect=[table, changed]):
+                processes.check(agentConfig)
+                return len(serialization.encode(processes.check(agentConfig)))
+
+    def test_read(self):
+        for count in self.PROCESS_COUNTS:
+            proc = make_proc_tree(count)
+            try:
+                table = ProcessTable(proc)
+                start = time.time()
+                rows = table.read()
+                cold = time.time() - start
+                start = time.time()
+                rows = table.read()
+                warm = time.time() - start
+
+                changed = [row[:9] + ['9:99'] + row[10:] if i % 100 == 0 else row
+                           for i, row in enumerate(rows)]
+                sizes = [(mode, self._payload_size(mode, rows, changed)) for mode in ('full', 'delta', 'top')]
+            finally:
+                shutil.rmtree(proc)
+
+            print "%6s processes: read in %.3fs, %.3fs cached, %s" % (
+                count, cold, warm, ', '.join('%s payload %dKB' % (mode, size / 1024) for mode, size in sizes))
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Performance tests for the JSON serialization of the payloads sent to the
+intake, on payloads shaped like the ones of a big host.
+"""
+# stdlib
+import json
+import random
+import time
+import zlib
+
+# 3p
+import simplejson
+
+# project
+from utils import serialization
+
+
+def collector_payload(metric_count, process_count):
+    """ What `Collector.run` hands over to the emitters """
+    now = int(time.time())
+    metrics = []
+    for i in xrange(metric_count):
+        metrics.append(('system.disk.in_use.%s' % (i % 50), now, random.random(), {
+            'hostname': 'myhost.example.com',
+            'device_name': '/dev/sd%s' % i,
+            'tags': ['role:db', 'env:prod', 'instance:%s' % (i % 10)],
+            'type': 'gauge',
+        }))
+    processes = [['dd-agent', 10.2, 5.4, 102345, 40123, 'S', 0.0, 0.1, '/opt/datadog-agent/bin/python agent.py %s' % i]
+                 for i in xrange(process_count)]
+    return {
+        'collection_timestamp': now,
+        'os': 'linux',
+        'python': '2.7.12 (default, Jul  1 2016, 15:12:24)',
+        'agentVersion': '5.9.0',
+        'agentKey': 'deadbeef',
+        'internalHostname': 'myhost.example.com',
+        'uuid': 'a6b3c7e2f5d44f3a9e5fe6d1c7c0b1a2',
+        'host-tags': {'system': ['role:db', 'env:prod']},
+        'metrics': metrics,
+        'events': {},
+        'service_checks': [{'check': 'ntp.in_sync', 'status': 0, 'host_name': 'myhost.example.com',
+                            'timestamp': now, 'id': i} for i in xrange(metric_count / 100)],
+        'resources': {'processes': {'snaps': [(now, processes)], 'format_version': 1}},
+        'cpuIdle': 95.1, 'cpuUser': 3.2, 'cpuSystem': 1.7, 'memPhysFree': 12345678,
+    }
+
+
+def series_payload(metric_count):
+    """ What dogstatsd posts """
+    now = time.time()
+    return {'series': [{
+        'metric': 'app.requests.%s' % (i % 200),
+        'points': [(now, random.random() * 100)],
+        'tags': ['endpoint:/api/v1/resource/%s' % i, 'status:200'],
+        'host': 'myhost.example.com',
+        'device_name': None,
+        'type': 'gauge',
+        'interval': 10,
+    } for i in xrange(metric_count)]}
+
+
+def events_payload(event_count):
+    """ Events posted by dogstatsd or api clients """
+    now = int(time.time())
+    return {'events': {'api': [{
+        'msg_title': u'Deployment of version 1.%s done ✓' % i,
+        'msg_text': u'Deployed by ci on %s hosts\n\n%%%%%%\n```\n%s\n```\n%%%%%%' % (i, 'x' * 200),
+        'timestamp': now,
+        'priority': 'normal',
+        'alert_type': 'success',
+        'aggregation_key': 'deploy-%s' % (i % 20),
+        'tags': ['service:web', 'version:1.%s' % i],
+        'host': 'myhost.example.com',
+    } for i in xrange(event_count)]}}
+
+
+class TestSerializationPerf(object):
+    """
+    Encoding, decoding, and encoding into a compressed payload, with
+    `utils.serialization`, the default simplejson settings used before, and
+    the standard library json module for reference.
+    """
+
+    PAYLOADS = [
+        ('collector, 5k metrics', collector_payload(5000, 500)),
+        ('collector, 50k metrics', collector_payload(50000, 2000)),
+        ('series, 20k metrics', series_payload(20000)),
+        ('events, 1k events', events_payload(1000)),
+    ]
+    RUNS = 5
+
+    def _time(self, func, *args):
+        durations = []
+        for _ in xrange(self.RUNS):
+            start = time.time()
+            func(*args)
+            durations.append(time.time() - start)
+        return min(durations) * 1000
+
+    def test_encoders(self):
+        for name, payload in self.PAYLOADS:
+            reference = simplejson.dumps(payload)
+            timings = []
+            for encoder, encode in [('simplejson.dumps', simplejson.dumps),
+                                    ('serialization.encode', serialization.encode),
+                                    ('json.dumps', json.dumps)]:
+                try:
+                    compatible = encode(payload) == reference
+                except TypeError:
+                    compatible = False
+                timings.append("%s %.1fms%s" % (encoder, self._time(encode, payload),
+                                                "" if compatible else " (different output)"))
+            print "%-24s %s kB, encode: %s" % (name, len(reference) / 1024, ", ".join(timings))
+
+    def test_decoders(self):
+        for name, payload in self.PAYLOADS:
+            raw = simplejson.dumps(payload)
+            timings = ["%s %.1fms" % (decoder, self._time(decode, raw))
+                       for decoder, decode in [('simplejson', serialization.decode), ('json', json.loads)]]
+            print "%-24s decode: %s" % (name, ", ".join(timings))
+
+    def test_encode_compressed(self):
+        for name, payload in self.PAYLOADS:
+            before = self._time(lambda: zlib.compress(simplejson.dumps(payload)))
+            after = self._time(serialization.encode_compressed, payload)
+            largest_chunk = max(len(chunk) for chunk in serialization._iterencode(payload))
+            print "%-24s encode and compress: %.1fms before, %.1fms streamed (largest chunk %s kB)" % (
+                name, before, after, largest_chunk / 1024)
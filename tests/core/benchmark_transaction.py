@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Performance tests for the forwarder transaction queue and spool.
+"""
+# stdlib
+from datetime import datetime, timedelta
+import os
+import shutil
+import signal
+import tempfile
+import time
+
+# project
+from transaction import Transaction, TransactionManager
+from utils.spool import Spool
+
+
+class NoopTransaction(Transaction):
+    def __init__(self, manager, size, next_flush):
+        Transaction.__init__(self)
+        self._trManager = manager
+        self._size = size
+        self._next_flush = next_flush
+
+    def flush(self):
+        self._trManager.tr_success(self)
+        self._trManager.flush_next()
+
+
+class TestTransactionManagerPerf(object):
+    """
+    Cost of queueing, flushing and evicting transactions depending on how many
+    of them are already waiting to be replayed.
+    """
+
+    QUEUE_DEPTHS = [1000, 10000, 100000, 1000000]
+    OPERATIONS = 1000
+    TRANSACTION_SIZE = 100
+
+    def _manager(self, depth):
+        manager = TransactionManager(timedelta(seconds=0), (depth + self.OPERATIONS) * self.TRANSACTION_SIZE,
+                                     timedelta(seconds=0))
+        manager.persist_status = lambda: None
+        # Transactions waiting to be replayed later
+        later = datetime.utcnow() + timedelta(hours=1)
+        for i in xrange(depth):
+            manager.append(NoopTransaction(manager, self.TRANSACTION_SIZE, later + timedelta(seconds=i)))
+        return manager
+
+    def test_queue_depth(self):
+        for depth in self.QUEUE_DEPTHS:
+            start = time.time()
+            manager = self._manager(depth)
+            fill = time.time() - start
+
+            # Flushes while a few live transactions come in
+            now = datetime.utcnow()
+            start = time.time()
+            for _ in xrange(self.OPERATIONS):
+                manager.append(NoopTransaction(manager, self.TRANSACTION_SIZE, now))
+                manager.flush()
+            flush = time.time() - start
+
+            # Full queue, every new transaction evicts one
+            manager._MAX_QUEUE_SIZE = depth * self.TRANSACTION_SIZE
+            start = time.time()
+            for _ in xrange(self.OPERATIONS):
+                manager.append(NoopTransaction(manager, self.TRANSACTION_SIZE, now))
+            evict = time.time() - start
+
+            print "%7d queued: append %.1fus, append and flush %.1fus, append with eviction %.1fus" % (
+                depth, fill / depth * 1e6, flush / self.OPERATIONS * 1e6, evict / self.OPERATIONS * 1e6)
+
+
+class TestSpoolPerf(object):
+    """
+    Records/s appended to and read back from a transaction spool, by fsync
+    policy, and time to reopen a spool left behind by a killed process.
+    """
+
+    RECORD_COUNT = 20000
+    RECORD_SIZE = 2048
+    FSYNC_POLICIES = ['never', 'interval', 'always']
+    RECOVERY_RECORD_COUNTS = [10000, 100000]
+
+    def _spool_dir(self):
+        return tempfile.mkdtemp(prefix='spool-bench-')
+
+    def test_enqueue_dequeue_throughput(self):
+        record = os.urandom(self.RECORD_SIZE)
+        for fsync in self.FSYNC_POLICIES:
+            # Syncing every record is much slower, don't wait for all of them
+            record_count = self.RECORD_COUNT if fsync != 'always' else self.RECORD_COUNT / 20
+            path = self._spool_dir()
+            try:
+                spool = Spool(path, fsync=fsync)
+                start = time.time()
+                for _ in xrange(record_count):
+                    spool.append(record)
+                enqueue = time.time() - start
+
+                start = time.time()
+                while True:
+                    entry = spool.read()
+                    if entry is None:
+                        break
+                    spool.ack(entry[1])
+                dequeue = time.time() - start
+                spool.close()
+            finally:
+                shutil.rmtree(path)
+
+            print "fsync %-8s enqueue: %d records/s (%.1f MB/s), dequeue and ack: %d records/s" % (
+                fsync, record_count / enqueue, record_count * self.RECORD_SIZE / enqueue / 1024 / 1024,
+                record_count / dequeue)
+
+    def test_recovery_after_kill(self):
+        record = os.urandom(self.RECORD_SIZE)
+        for record_count in self.RECOVERY_RECORD_COUNTS:
+            path = self._spool_dir()
+            try:
+                pid = os.fork()
+                if pid == 0:
+                    spool = Spool(path, max_size=2 * record_count * self.RECORD_SIZE)
+                    for i in xrange(record_count):
+                        spool.append(record)
+                        # Half of them were sent before the crash
+                        if i % 2:
+                            spool.ack(spool.read()[1])
+                    spool.writer.flush()
+                    os.kill(os.getpid(), signal.SIGKILL)
+                os.waitpid(pid, 0)
+
+                start = time.time()
+                spool = Spool(path)
+                recovered = 0
+                while spool.read() is not None:
+                    recovered += 1
+                duration = time.time() - start
+                spool.close()
+            finally:
+                shutil.rmtree(path)
+
+            print "%s records before kill -9: %s recovered in %.2fs" % (record_count, recovered, duration)
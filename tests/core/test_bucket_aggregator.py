@@ -9,7 +9,7 @@ from nose.plugins.attrib import attr
 import nose.tools as nt
 
 # project
-from aggregator import DEFAULT_HISTOGRAM_AGGREGATES
+from aggregator import ContextCache, DEFAULT_HISTOGRAM_AGGREGATES
 from dogstatsd import MetricsBucketAggregator
 
 
@@ -845,6 +845,95 @@ class TestUnitMetricsBucketAggregator(unittest.TestCase):
         nt.assert_equal(first['metric'], 'datadog.dogstatsd.packet.count')
         nt.assert_equal(first['points'][0][1], 10)
 
+    def test_shard_merge(self):
+        ag_interval = self.interval
+        stats = MetricsBucketAggregator('myhost', interval=ag_interval)
+        shards = [MetricsBucketAggregator('myhost', interval=ag_interval) for _ in range(2)]
+
+        self.wait_for_bucket_boundary(ag_interval)
+        for i, shard in enumerate(shards):
+            shard.submit_packets('my.counter:%s|c' % (i + 1))
+            shard.submit_packets('my.gauge:%s|g' % (i + 1))
+            shard.submit_packets('my.set:%s|s' % i)
+            shard.submit_packets('my.set:common|s')
+            for j in xrange(5):
+                shard.submit_packets('my.histogram:%s|h' % (i * 5 + j + 1))
+            shard.submit_packets('_e{5,4}:title|text')
+            shard.submit_packets('_sc|check|0')
+            stats.merge_shard(shard.drain_shard())
+            nt.assert_equal(shard.metric_by_bucket, {})
+
+        nt.assert_equal(stats.count, 2 * 9)
+        nt.assert_equal(len(stats.flush_events()), 2)
+        nt.assert_equal(len(stats.flush_service_checks()), 2)
+
+        self.sleep_for_interval_length(ag_interval)
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(metrics['my.counter'], 3 / ag_interval)
+        # The last shard to be sampled wins
+        nt.assert_equal(metrics['my.gauge'], 2)
+        nt.assert_equal(metrics['my.set'], 3)
+        nt.assert_equal(metrics['my.histogram.max'], 10)
+        nt.assert_equal(metrics['my.histogram.count'], 10 / ag_interval)
+        nt.assert_equal(metrics['my.histogram.95percentile'], 10)
+
+    def test_context_cache(self):
+        ag_interval = self.interval
+        stats = MetricsBucketAggregator('myhost', interval=ag_interval)
+
+        self.wait_for_bucket_boundary(ag_interval)
+        for _ in xrange(3):
+            stats.submit_packets('my.counter:1|c|#b,a,host:other,device:sda')
+            stats.submit_packets('my.counter:1|c|#a,b')
+            # Same context as the previous packet, through the uncached path
+            stats.submit_metric('my.counter', 1, 'c', tags=('a', 'b', 'a'))
+        nt.assert_equal(stats.context_cache_stats(), (4, 2, 0))
+
+        self.sleep_for_interval_length(ag_interval)
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal(len(metrics), 2)
+        first, second = sorted(metrics, key=lambda m: m['host'])
+        nt.assert_equal(first['host'], 'myhost')
+        nt.assert_equal(first['tags'], ('a', 'b'))
+        nt.assert_equal(first['points'][0][1], 6 / ag_interval)
+        nt.assert_equal(second['host'], 'other')
+        nt.assert_equal(second['device_name'], 'sda')
+        nt.assert_equal(second['tags'], ('a', 'b'))
+        nt.assert_equal(second['points'][0][1], 3 / ag_interval)
+
+        # Cached contexts land in the new bucket after a flush
+        stats.submit_packets('my.counter:5|c|#a,b')
+        nt.assert_equal(stats.context_cache_stats(), (1, 0, 0))
+        self.sleep_for_interval_length(ag_interval)
+        metrics = stats.flush()
+        nt.assert_equal(len(metrics), 2)
+        nt.assert_equal(sorted(m['points'][0][1] for m in metrics), [0, 5 / ag_interval])
+
+    def test_context_cache_eviction(self):
+        cache = ContextCache(4)
+        for i in xrange(4):
+            cache.set(i, i)
+        # 0 and 1 got pushed to the old generation, 1 comes back to the young one
+        nt.assert_equal(cache.get(1), 1)
+        cache.set(4, 4)
+        # 0 was evicted with the old generation
+        nt.assert_equal(cache.get(0), None)
+        nt.assert_equal(cache.get(4), 4)
+        nt.assert_equal(cache.pop_stats(), (2, 1, 1))
+        nt.assert_equal(len(cache), 4)
+
+    def test_metrics_share_context(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval)
+        stats.submit_packets('my.counter:1|c|#a,b')
+        stats.submit_packets('my.set:1|s|#b,a')
+
+        for context, metric in stats.current_mbc.iteritems():
+            nt.assert_false(hasattr(metric, '__dict__'))
+            nt.assert_true(metric.name is context[0])
+            nt.assert_equal(context[1], ('a', 'b'))
+        counter = stats.current_mbc[('my.counter', ('a', 'b'), 'myhost', None)]
+        nt.assert_true(counter.tags is stats.context_cache.get(('my.counter', ('a', 'b')))[0][1])
+
     def test_histogram_counter(self):
         # Test whether histogram.count == increment
         # same deal with a sample rate
@@ -1,15 +1,99 @@
 # -*- coding: utf-8 -*-
 # stdlib
+import BaseHTTPServer
+import os
 import random
+import socket
+import SocketServer
+import threading
 import time
 import unittest
+import zlib
 
 # 3p
 from nose.plugins.attrib import attr
+from nose.plugins.skip import SkipTest
 import nose.tools as nt
+import simplejson as json
 
 # project
-from aggregator import DEFAULT_HISTOGRAM_AGGREGATES, get_formatter, MetricsAggregator
+from aggregator import (
+    DEFAULT_HISTOGRAM_AGGREGATES,
+    get_formatter,
+    MetricsAggregator,
+    MetricsBucketAggregator,
+)
+from checks.check_status import DogstatsdStatus
+from dogstatsd import get_udp_socket_stats, Reporter, Server, ServerPool, SO_REUSEPORT
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def legacy_parse_metric_packet(packet):
+    """
+    The parser MetricsAggregator used before it was rewritten to tokenize packets
+    in a single pass, kept as the reference the new one is checked against.
+    """
+    parsed_packets = []
+    name_and_metadata = packet.split(':', 1)
+
+    if len(name_and_metadata) != 2:
+        raise Exception('Unparseable metric packet: %s' % packet)
+
+    name = name_and_metadata[0]
+    broken_split = name_and_metadata[1].split(':')
+    data = []
+    partial_datum = None
+    for token in broken_split:
+        if partial_datum is None:
+            partial_datum = token
+        elif "|" not in token:
+            partial_datum += ":" + token
+        else:
+            data.append(partial_datum)
+            partial_datum = token
+    data.append(partial_datum)
+
+    for datum in data:
+        value_and_metadata = datum.split('|')
+
+        if len(value_and_metadata) < 2:
+            raise Exception('Unparseable metric packet: %s' % packet)
+
+        raw_value = value_and_metadata[0]
+        metric_type = value_and_metadata[1]
+
+        if metric_type in MetricsAggregator.ALLOW_STRINGS:
+            value = raw_value
+        else:
+            try:
+                value = int(raw_value)
+            except ValueError:
+                try:
+                    value = float(raw_value)
+                except ValueError:
+                    raise Exception('Metric value must be a number: %s, %s' % (name, raw_value))
+
+        sample_rate = 1
+        tags = None
+        for m in value_and_metadata[2:]:
+            if m[0] == '@':
+                sample_rate = float(m[1:])
+                assert 0 <= sample_rate <= 1
+            elif m[0] == '#':
+                tags = tuple(sorted(m[1:].split(',')))
+
+        parsed_packets.append((name, value, metric_type, tags, sample_rate))
+
+    return parsed_packets
+
+
+def get_free_udp_port():
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
 
 
 class TestUnitDogStatsd(unittest.TestCase):
@@ -170,6 +254,58 @@ class TestUnitDogStatsd(unittest.TestCase):
         serialized = dogstatsd.serialize_metrics([api_formatter("foo", 12, 1, ('tag',), 'host')], "test-host")
         assert '"tags": ["tag"]' in serialized[0]
 
+    def test_serialize_metrics_chunks(self):
+        import dogstatsd
+        from aggregator import api_formatter
+
+        metrics = [api_formatter("foo.%s" % i, 12, 1, ('tag',), 'host') for i in range(25)]
+        # Undecodable tag, only its own chunk falls back to replacing bad characters
+        metrics[12] = api_formatter("foo.12", 12, 1, ('t\xffag',), 'host')
+        payloads = list(dogstatsd.serialize_metrics_chunks(metrics, "test-host", 10))
+        nt.assert_equal(len(payloads), 3)
+
+        names, statuses = self.split_series(payloads)
+        nt.assert_equal(names, ["foo.%s" % i for i in range(25)])
+        # One status point for the whole flush, carried by the last chunk
+        nt.assert_equal(statuses, ['status:failure'])
+        nt.assert_equal(self.split_series(payloads[-1:])[1], ['status:failure'])
+        # The metrics given to the reporter aren't modified
+        nt.assert_equal(len(metrics), 25)
+
+        metrics = [api_formatter("foo.%s" % i, 12, 1, ('tag',), 'host') for i in range(25)]
+        payloads = list(dogstatsd.serialize_metrics_chunks(metrics, "test-host", 10))
+        nt.assert_equal(len(payloads), 3)
+        nt.assert_equal(self.split_series(payloads)[1], ['status:success'])
+
+    def test_serialize_metrics_chunks_last_chunk_fails(self):
+        import dogstatsd
+        from aggregator import api_formatter
+
+        metrics = [api_formatter("foo.%s" % i, 12, 1, ('tag',), 'host') for i in range(20)]
+        metrics[15] = api_formatter("foo.15", 12, 1, ('t\xffag',), 'host')
+        payloads = list(dogstatsd.serialize_metrics_chunks(metrics, "test-host", 10))
+        names, statuses = self.split_series(payloads)
+        nt.assert_equal(names, ["foo.%s" % i for i in range(20)])
+        nt.assert_equal(statuses, ['status:failure'])
+
+        # Nothing to serialize but the status point
+        nt.assert_equal(self.split_series(dogstatsd.serialize_metrics_chunks([], "test-host", 10)),
+                        ([], ['status:success']))
+
+    def split_series(self, payloads):
+        """ Names of the metrics, and serialization statuses in `payloads` """
+        statuses = []
+        names = []
+        for body, headers in payloads:
+            if headers.get('Content-Encoding') == 'deflate':
+                body = zlib.decompress(body)
+            for metric in json.loads(body)['series']:
+                if metric['metric'] == 'datadog.dogstatsd.serialization_status':
+                    statuses.append(metric['tags'][0])
+                else:
+                    names.append(metric['metric'])
+        return names, statuses
+
     def test_counter(self):
         stats = MetricsAggregator('myhost')
 
@@ -887,3 +1023,267 @@ class TestUnitDogStatsd(unittest.TestCase):
         del env["https_proxy"]
         del env["HTTP_PROXY"]
         del env["HTTPS_PROXY"]
+
+
+class TestMetricPacketParser(unittest.TestCase):
+
+    SHAPES = [
+        'page.views:1|c',
+        'page.views:-1.5|c',
+        'fuel.level:0.5|g',
+        'song.length:240|h|@0.5',
+        'users.uniques:1234|s',
+        'users.uniques:abc:def|s',
+        'users.online:1|c|#country:china',
+        'users.online:1|c|@0.5|#country:china,b:1,a:2',
+        'users.online:1|c|#country:china|@0.5',
+        'users.online:1|c|#b,a,b,c',
+        'users.online:1|c|#',
+        'multi:1|c:2|c:3|g',
+        'multi:1|c|#a:b,c:d:2|c|#c:d,a:b:3|h|@0.1',
+        'multi:1|c|#a:b,c:d:e:2|c',
+        'sci:1e3|g',
+        'sci:1.5E-3|ms',
+        'empty_meta:1|c|',
+        'bad_rate:1|c|@2',
+        'bad_value:abc|c',
+        'no_type:1',
+        'no_colon',
+        ':1|c',
+        'trailing_colon:1|c:',
+        'double::1|c',
+    ]
+
+    @staticmethod
+    def parse(parser, packet):
+        try:
+            return parser(packet)
+        except Exception as e:
+            return type(e)
+
+    def assert_same_parse(self, stats, packet):
+        nt.assert_equal(self.parse(legacy_parse_metric_packet, packet),
+                        self.parse(stats.parse_metric_packet, packet), packet)
+
+    def test_parser_matches_legacy_parser(self):
+        stats = MetricsAggregator('myhost')
+        # Twice, to go through the name and tags caches
+        for _ in range(2):
+            for packet in self.SHAPES:
+                self.assert_same_parse(stats, packet)
+                self.assert_same_parse(stats, unicode(packet))
+
+    def test_parser_matches_legacy_parser_random(self):
+        rand = random.Random(42)
+        alphabet = 'ab:|@#,.1-e'
+        stats = MetricsAggregator('myhost')
+        for _ in xrange(20000):
+            packet = rand.choice(self.SHAPES)
+            # Mutate a few characters to explore broken packets too
+            packet = list(packet)
+            for _ in xrange(rand.randint(0, 3)):
+                position = rand.randint(0, len(packet))
+                packet.insert(position, rand.choice(alphabet))
+            self.assert_same_parse(stats, ''.join(packet))
+
+    def test_parser_caches_are_bounded(self):
+        import aggregator
+        stats = MetricsAggregator('myhost')
+        cache_size = aggregator.PARSER_CACHE_SIZE
+        aggregator.PARSER_CACHE_SIZE = 10
+        try:
+            for i in xrange(25):
+                stats.parse_metric_packet('metric.%s:1|c|#tag:%s' % (i, i))
+        finally:
+            aggregator.PARSER_CACHE_SIZE = cache_size
+        self.assertTrue(len(stats._parsed_names) <= 10)
+        self.assertTrue(len(stats._parsed_tags) <= 10)
+        nt.assert_equal(stats.parse_metric_packet('metric.1:1|c|#b,a'),
+                        [('metric.1', 1, 'c', ('a', 'b'), 1)])
+
+
+@attr('unix')
+class TestServerPool(unittest.TestCase):
+
+    def test_shards_are_merged(self):
+        if SO_REUSEPORT is None:
+            raise SkipTest("SO_REUSEPORT is not supported on this platform")
+
+        port = get_free_udp_port()
+        aggregator = MetricsBucketAggregator('myhost', interval=1)
+        pool = ServerPool(aggregator, lambda: MetricsBucketAggregator('myhost', interval=1),
+                          '127.0.0.1', port, 2)
+        runner = threading.Thread(target=pool.start)
+        runner.start()
+        try:
+            time.sleep(0.5)
+            # Several sockets so that the kernel spreads them over the receivers
+            senders = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(8)]
+            for sender in senders:
+                for _ in range(10):
+                    sender.sendto('pool.counter:1|c', ('127.0.0.1', port))
+                sender.close()
+            time.sleep(0.5)
+            pool.drain()
+        finally:
+            pool.stop()
+            runner.join()
+
+        nt.assert_equal(aggregator.count, 80)
+        time.sleep(1)
+        metrics = aggregator.flush()
+        nt.assert_equal(len(metrics), 1)
+        nt.assert_equal(metrics[0]['points'][0][1], 80)
+
+
+@attr('unix')
+class TestServer(unittest.TestCase):
+
+    def test_batched_receive(self):
+        port = get_free_udp_port()
+        aggregator = MetricsBucketAggregator('myhost', interval=1)
+        server = Server(aggregator, '127.0.0.1', port, recv_batch_size=16, so_rcvbuf=1024 * 1024)
+        runner = threading.Thread(target=server.start)
+        runner.start()
+        try:
+            time.sleep(0.5)
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # More datagrams than a single batch
+            for _ in range(50):
+                sender.sendto('batch.counter:1|c', ('127.0.0.1', port))
+            sender.sendto('batch.counter:not_a_number|c', ('127.0.0.1', port))
+            sender.sendto('garbage', ('127.0.0.1', port))
+            sender.close()
+            time.sleep(0.5)
+        finally:
+            server.stop()
+            runner.join()
+
+        nt.assert_equal(aggregator.count, 52)
+        nt.assert_equal(aggregator.error_count, 2)
+
+    def test_drain_during_ingestion(self):
+        port = get_free_udp_port()
+        aggregator = MetricsBucketAggregator('myhost', interval=1)
+        server = Server(MetricsBucketAggregator('myhost', interval=1), '127.0.0.1', port,
+                        so_rcvbuf=4 * 1024 * 1024, reporting_aggregator=aggregator)
+        runner = threading.Thread(target=server.start)
+        runner.start()
+
+        flushed = []
+        events = []
+        stop_flushing = threading.Event()
+
+        def flush_continuously():
+            while not stop_flushing.isSet():
+                server.drain()
+                flushed.extend(aggregator.flush())
+                events.extend(aggregator.flush_events())
+
+        flusher = threading.Thread(target=flush_continuously)
+        flusher.start()
+        sent = 20000
+        try:
+            time.sleep(0.5)
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            for i in xrange(sent):
+                sender.sendto('stress.counter:1|c\n_e{5,4}:title|text', ('127.0.0.1', port))
+                # Don't overflow the socket buffer
+                if i % 100 == 0:
+                    time.sleep(0.001)
+            sender.close()
+            time.sleep(0.5)
+        finally:
+            stop_flushing.set()
+            flusher.join()
+            server.stop()
+            runner.join()
+
+        server.drain()
+        events.extend(aggregator.flush_events())
+        time.sleep(1)
+        flushed.extend(aggregator.flush())
+
+        nt.assert_equal(aggregator.total_count, 2 * sent)
+        nt.assert_equal(sum(m['points'][0][1] for m in flushed if m['metric'] == 'stress.counter'), sent)
+        nt.assert_equal(len(events), sent)
+        nt.assert_equal(server.metrics_aggregator.metric_by_bucket, {})
+
+    def test_udp_socket_stats(self):
+        proc_path = os.path.join(FIXTURE_PATH, 'proc_net_udp')
+        # Two SO_REUSEPORT sockets on 8125 (0x1FBD)
+        nt.assert_equal(get_udp_socket_stats(8125, proc_path), (0x300 + 0x40, 17 + 3))
+        nt.assert_equal(get_udp_socket_stats(8126, proc_path), None)
+        nt.assert_equal(get_udp_socket_stats(8125, '/does/not/exist'), None)
+
+
+class IntakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep the connections alive
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append((self.path.split('?')[0], self.client_address, body))
+        # Slow enough for sequential posts to show in the flush time
+        time.sleep(self.server.delay)
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Intake(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ A stand-in for the HTTP intake, recording the payloads it receives. """
+    daemon_threads = True
+
+    def __init__(self, delay=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), IntakeHandler)
+        self.received = []
+        self.delay = delay
+
+
+class TestReporter(unittest.TestCase):
+
+    def setUp(self):
+        self.intake = Intake(delay=0.2)
+        self.intake_thread = threading.Thread(target=self.intake.serve_forever)
+        self.intake_thread.daemon = True
+        self.intake_thread.start()
+        self.api_host = 'http://127.0.0.1:%s' % self.intake.server_address[1]
+
+    def tearDown(self):
+        self.intake.shutdown()
+        self.intake.server_close()
+
+    def test_concurrent_posts_over_kept_alive_connections(self):
+        aggregator = MetricsBucketAggregator('myhost', interval=1)
+        reporter = Reporter(1, aggregator, self.api_host, api_key='apikey',
+                            event_chunk_size=1, http_pool_size=4)
+
+        for flush in range(2):
+            aggregator.submit_packets('my.counter:1|c')
+            for i in range(8):
+                aggregator.submit_packets('_e{5,4}:title|tex%s' % i)
+            aggregator.submit_packets('_sc|check|0')
+            time.sleep(1)
+            start = time.time()
+            reporter.flush()
+            flush_time = time.time() - start
+
+            # 10 posts of 0.2s, 4 at a time
+            self.assertTrue(flush_time < 1, flush_time)
+
+        endpoints = [path for path, _, _ in self.intake.received]
+        nt.assert_equal(endpoints.count('/api/v1/series'), 2)
+        nt.assert_equal(endpoints.count('/intake'), 16)
+        nt.assert_equal(endpoints.count('/api/v1/check_run'), 2)
+        # The connections of the first flush were kept for the second one
+        connections = set(client for _, client, _ in self.intake.received)
+        self.assertTrue(len(connections) <= 4, connections)
+
+        status = DogstatsdStatus.load_latest_status()
+        nt.assert_equal(status.post_latencies['/intake']['count'], 8)
+        self.assertTrue(status.post_latencies['/intake']['median'] >= 200)
+        nt.assert_equal(status.post_latencies['/api/v1/series']['count'], 1)
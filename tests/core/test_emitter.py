@@ -1,9 +1,68 @@
 # -*- coding: utf-8 -*-
-# 3p
+# stdlib
+import BaseHTTPServer
+from hashlib import md5
+import logging
+import SocketServer
+import threading
+import time
 import unittest
+import zlib
+
+# 3p
+from mock import patch
+import simplejson as json
 
 # project
-from emitter import remove_control_chars
+from checks.check_status import CollectorStatus
+from checks.collector import AgentPayload
+import emitter
+from emitter import http_emitter, PayloadSender, remove_control_chars
+
+log = logging.getLogger(__name__)
+
+
+class IntakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        time.sleep(self.server.delay)
+        self.server.received.append((self.path, dict(self.headers), body))
+        self.send_response(self.server.code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Intake(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ A stand-in for the intake, or the forwarder """
+    daemon_threads = True
+
+    def __init__(self, delay=0, code=202):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), IntakeHandler)
+        self.received = []
+        self.delay = delay
+        self.code = code
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+    def wait_for(self, count, timeout=10):
+        deadline = time.time() + timeout
+        while len(self.received) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return self.received
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
 
 
 class TestEmitter(unittest.TestCase):
@@ -17,3 +76,155 @@ class TestEmitter(unittest.TestCase):
 
         for bad, good in messages:
             self.assertTrue(remove_control_chars(bad) == good, (bad,good))
+
+    def test_collector_doesnt_wait_for_the_intake(self):
+        intake = Intake(delay=1)
+        try:
+            config = {'sd_url': intake.url, 'version': '1.0', 'use_forwarder': True}
+            emitter._sender = None
+            payloads = [{'agentKey': 'key', 'run': i} for i in xrange(3)]
+
+            start = time.time()
+            for payload in payloads:
+                http_emitter(payload, log, config, 'metrics')
+            # Only the serialization happens on the collector loop
+            self.assertTrue(time.time() - start < 0.5, time.time() - start)
+
+            received = intake.wait_for(3)
+            self.assertEqual([json.loads(zlib.decompress(body)) for _, _, body in received], payloads)
+            for path, headers, body in received:
+                self.assertEqual(path, '/intake/metrics?agent_key=key')
+                self.assertEqual(headers['content-encoding'], 'deflate')
+                self.assertEqual(headers['content-md5'], md5(body).hexdigest())
+        finally:
+            emitter._sender = None
+            intake.close()
+
+    @patch('emitter.RETRY_DELAY', 0.01)
+    def test_fallback_to_the_forwarder(self):
+        intake = Intake(code=503)
+        forwarder = Intake()
+        try:
+            sender = PayloadSender({
+                'sd_url': intake.url,
+                'version': '1.0',
+                'bind_host': '127.0.0.1',
+                'listen_port': forwarder.server_address[1],
+            })
+            sender.start()
+            sender.submit('metrics', 'key', '{"run": 1}', log)
+
+            received = forwarder.wait_for(1)
+            self.assertEqual(len(intake.received), emitter.MAX_ATTEMPTS)
+            self.assertEqual(zlib.decompress(received[0][2]), '{"run": 1}')
+            self.assertEqual(received[0][0], '/intake/metrics?agent_key=key')
+        finally:
+            intake.close()
+            forwarder.close()
+
+    def sender(self, intake, forwarder, **config):
+        config.update({
+            'sd_url': intake.url,
+            'version': '1.0',
+            'bind_host': '127.0.0.1',
+            'listen_port': forwarder.server_address[1],
+        })
+        return PayloadSender(config)
+
+    @patch('emitter.HTTP_TIMEOUT', 1)
+    @patch('emitter.RETRY_DELAY', 0.01)
+    def test_retries_fit_in_the_check_interval(self):
+        intake = Intake(code=503)
+        forwarder = Intake()
+        try:
+            # Half a second to retry, a second attempt wouldn't fit
+            sender = self.sender(intake, forwarder, check_freq=1)
+            sender.start()
+            sender.submit('metrics', 'key', '{"run": 1}', log)
+
+            self.assertEqual(len(forwarder.wait_for(1)), 1)
+            self.assertEqual(len(intake.received), 1)
+        finally:
+            intake.close()
+            forwarder.close()
+
+    def test_overflow_goes_to_the_forwarder(self):
+        intake = Intake()
+        forwarder = Intake()
+        try:
+            sender = self.sender(intake, forwarder)
+            for i in xrange(emitter.MAX_PENDING + 2):
+                sender.submit('metrics', 'key', '{"run": %s}' % i, log)
+            sender.start()
+
+            received = forwarder.wait_for(2)
+            self.assertEqual([zlib.decompress(body) for _, _, body in received], ['{"run": 0}', '{"run": 1}'])
+            received = intake.wait_for(emitter.MAX_PENDING)
+            self.assertEqual([zlib.decompress(body) for _, _, body in received],
+                             ['{"run": %s}' % i for i in xrange(2, emitter.MAX_PENDING + 2)])
+            self.assertEqual(sender.dropped_count, 0)
+        finally:
+            intake.close()
+            forwarder.close()
+
+    def test_flush(self):
+        intake = Intake(delay=0.1)
+        forwarder = Intake()
+        try:
+            sender = self.sender(intake, forwarder)
+            sender.start()
+            for i in xrange(3):
+                sender.submit('metrics', 'key', '{"run": %s}' % i, log)
+
+            self.assertTrue(sender.flush(5))
+            self.assertEqual(len(intake.received), 3)
+
+            intake.delay = 1
+            sender.submit('metrics', 'key', '{"run": 3}', log)
+            sender.submit('metrics', 'key', '{"run": 4}', log)
+            self.assertFalse(sender.flush(0.1))
+            self.assertEqual(sender.dropped_count, 1)
+            self.assertEqual(sender.stats(), {'queue_depth': 2, 'dropped': 1})
+        finally:
+            intake.close()
+            forwarder.close()
+
+    @patch('emitter.RETRY_DELAY', 0.01)
+    def test_flush_doesnt_retry(self):
+        intake = Intake(code=503)
+        forwarder = Intake()
+        try:
+            sender = self.sender(intake, forwarder)
+            sender.submit('metrics', 'key', '{"run": 1}', log)
+            sender.start()
+
+            self.assertTrue(sender.flush(5))
+            self.assertEqual(len(intake.received), 1)
+            self.assertEqual(len(forwarder.received), 1)
+        finally:
+            intake.close()
+            forwarder.close()
+
+    def test_flush_without_sender(self):
+        emitter._sender = None
+        self.assertTrue(emitter.flush(0))
+
+    def test_stats_in_the_collector_status(self):
+        emitter._sender = None
+        self.assertEqual(http_emitter.stats(), {'queue_depth': 0, 'dropped': 0})
+
+        sender = emitter._sender = PayloadSender({'sd_url': 'http://127.0.0.1:1', 'version': '1.0'})
+        try:
+            for i in xrange(emitter.MAX_PENDING + 2):
+                sender.submit('metrics', 'key', '{"run": %s}' % i, log)
+            sender.dropped_count = 3
+            payload = AgentPayload()
+            payload['agentKey'] = 'key'
+            statuses = payload.emit(log, {}, [http_emitter], True)
+        finally:
+            emitter._sender = None
+
+        self.assertEqual([es.stats for es in statuses], [{'queue_depth': emitter.MAX_PENDING + 3, 'dropped': 3}])
+        status = CollectorStatus(emitter_statuses=statuses)
+        self.assertEqual(status.to_dict()['emitter'][0]['dropped'], 3)
+        self.assertTrue("  - http_emitter [OK] (13 queued, 3 dropped)" in status.body_lines())
@@ -0,0 +1,143 @@
+# stdlib
+import cPickle as pickle
+from datetime import timedelta
+import socket
+import struct
+import unittest
+
+# 3p
+import nose.tools as nt
+from tornado.testing import AsyncTestCase, bind_unused_port
+
+# project
+from checks.check_status import ForwarderStatus
+from graphite import GraphiteConnection, GraphitePoints, GraphiteServer
+from transaction import TransactionManager
+
+
+class FakeStream(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def set_close_callback(self, callback):
+        pass
+
+    def read_until_close(self, callback, streaming_callback=None):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def pickle_frame(datapoints):
+    data = pickle.dumps(datapoints, protocol=2)
+    return struct.pack('!L', len(data)) + data
+
+
+class TestGraphiteConnection(unittest.TestCase):
+
+    def connection(self, max_points=None):
+        points = GraphitePoints(max_points)
+        return GraphiteConnection(FakeStream(), ('127.0.0.1', 1234), points, 'myhost'), points
+
+    def test_plaintext(self):
+        connection, points = self.connection()
+        data = 'foo.bar 1.5 1476600000\nfoo.bar 2 1476600010\n\nfoo.baz 3 1476600000\n'
+        # Lines split over several reads
+        for start in xrange(0, len(data), 7):
+            connection._on_read(data[start:start + 7])
+        nt.assert_equal(points.flush(), {
+            'foo.bar': [['myhost', 'N/A', 1476600000.0, 1.5], ['myhost', 'N/A', 1476600010.0, 2.0]],
+            'foo.baz': [['myhost', 'N/A', 1476600000.0, 3.0]],
+        })
+        nt.assert_equal(points.flush(), {})
+        nt.assert_equal(points.count, 0)
+
+    def test_pickle(self):
+        connection, points = self.connection()
+        data = pickle_frame([('foo.bar', (1476600000, 1.5)), ('foo.bar', (1476600010, 2))]) \
+            + pickle_frame([('foo.baz', (1476600000, '3'))])
+        for start in xrange(0, len(data), 5):
+            connection._on_read(data[start:start + 5])
+        nt.assert_equal(points.flush(), {
+            'foo.bar': [['myhost', 'N/A', 1476600000.0, 1.5], ['myhost', 'N/A', 1476600010.0, 2.0]],
+            'foo.baz': [['myhost', 'N/A', 1476600000.0, 3.0]],
+        })
+
+    def test_invalid_points(self):
+        connection, points = self.connection()
+        connection._on_read('foo.bar 1 1476600000\nfoo.bar one 1476600000\nfoo.bar nan 1476600000\n'
+                            'foo.bar 1\nfoo.bar 2 -1\n')
+        nt.assert_equal(points.invalid_count, 3)
+        flushed = points.flush()['foo.bar']
+        nt.assert_equal(len(flushed), 2)
+        # -1 is now
+        self.assertTrue(flushed[1][2] > 1476600000)
+
+        connection, points = self.connection()
+        connection._on_read(pickle_frame([('foo.bar', (1476600000, 1)), ('foo.bar', 'garbage')]) +
+                            struct.pack('!L', 3) + 'bad')
+        nt.assert_equal(points.invalid_count, 2)
+        nt.assert_equal(points.count, 1)
+
+    def test_protocol_errors(self):
+        connection, points = self.connection()
+        connection._on_read('foo.bar' * 1000)
+        self.assertTrue(connection.stream.closed)
+
+        connection, points = self.connection()
+        connection._on_read(struct.pack('!L', 10 * 1024 * 1024))
+        self.assertTrue(connection.stream.closed)
+
+    def test_max_points(self):
+        connection, points = self.connection(max_points=10)
+        connection._on_read(''.join('foo.%s 1 1476600000\n' % i for i in xrange(8)))
+        connection._on_read(''.join('bar.%s 1 1476600000\n' % i for i in xrange(8)))
+        nt.assert_equal(points.count, 10)
+        nt.assert_equal(points.received_count, 16)
+        nt.assert_equal(points.dropped_count, 6)
+        nt.assert_equal(len(points.flush()), 10)
+
+        # There's room again after a flush
+        connection._on_read('foo.0 1 1476600000\n')
+        nt.assert_equal(points.count, 1)
+        nt.assert_equal(points.dropped_count, 6)
+        nt.assert_equal(points.stats(), {'received': 17, 'invalid': 0, 'dropped': 6})
+
+        # Reported in the forwarder status
+        trManager = TransactionManager(timedelta(seconds=0), 1024, timedelta(seconds=0),
+                                       graphite_stats=points.stats)
+        trManager.persist_status()
+        status = ForwarderStatus.load_latest_status()
+        nt.assert_equal(status.graphite, {'received': 17, 'invalid': 0, 'dropped': 6})
+        self.assertTrue("Graphite points: 17 received, 0 invalid, 6 dropped" in status.body_lines())
+
+
+class TestGraphiteServer(AsyncTestCase):
+
+    def test_both_protocols(self):
+        points = GraphitePoints()
+        sock, port = bind_unused_port()
+        server = GraphiteServer(points, 'myhost', io_loop=self.io_loop)
+        server.add_sockets([sock])
+
+        plaintext = socket.create_connection(('127.0.0.1', port))
+        plaintext.sendall('foo.bar 1 1476600000\n' * 100)
+        pickled = socket.create_connection(('127.0.0.1', port))
+        pickled.sendall(pickle_frame([('foo.baz', (1476600000, 2))] * 100))
+
+        def check():
+            if points.count < 200:
+                self.io_loop.add_timeout(self.io_loop.time() + 0.01, check)
+            else:
+                self.stop()
+        check()
+        self.wait()
+        plaintext.close()
+        pickled.close()
+        server.stop()
+
+        metrics = points.flush()
+        nt.assert_equal(len(metrics['foo.bar']), 100)
+        nt.assert_equal(len(metrics['foo.baz']), 100)
@@ -1,9 +1,21 @@
 # stdlib
+import random
 import unittest
 
 # project
-from aggregator import Histogram, MetricsAggregator
-from config import get_histogram_aggregates, get_histogram_percentiles
+from aggregator import (
+    Histogram,
+    MetricsAggregator,
+    MetricsBucketAggregator,
+    QuantileSketch,
+    SketchHistogram,
+)
+from config import (
+    get_histogram_aggregates,
+    get_histogram_backend,
+    get_histogram_percentiles,
+    get_histogram_relative_accuracy,
+)
 
 class TestHistogram(unittest.TestCase):
     def test_default(self):
@@ -151,3 +163,124 @@ class TestHistogram(unittest.TestCase):
         self.assertEquals(value_by_type['median'], 9, value_by_type)
         self.assertEquals(value_by_type['max'], 19, value_by_type)
         self.assertEquals(value_by_type['95percentile'], 18, value_by_type)
+
+
+class TestSketchHistogram(unittest.TestCase):
+    PERCENTILES = [0.5, 0.75, 0.9, 0.95, 0.99]
+
+    def assertWithinRelativeError(self, actual, expected, relative_accuracy):
+        self.assertTrue(
+            abs(actual - expected) <= relative_accuracy * abs(expected),
+            "%s not within %s of %s" % (actual, relative_accuracy, expected)
+        )
+
+    def _flush_values(self, stats, name):
+        value_by_type = {}
+        for k in stats.flush():
+            value_by_type[k['metric'][len(name)+1:]] = k['points'][0][1]
+        return value_by_type
+
+    def test_config(self):
+        self.assertEquals(get_histogram_backend('Sketch '), 'sketch')
+        self.assertEquals(get_histogram_backend('exact'), 'exact')
+        self.assertEquals(get_histogram_backend('tdigest'), None)
+        self.assertEquals(get_histogram_relative_accuracy('0.005'), 0.005)
+        self.assertEquals(get_histogram_relative_accuracy('1'), None)
+        self.assertEquals(get_histogram_relative_accuracy('foo'), None)
+
+        stats = MetricsAggregator('myhost', histogram_backend='sketch')
+        self.assertEquals(stats.histogram_class, SketchHistogram)
+        stats = MetricsBucketAggregator('myhost')
+        self.assertEquals(stats.histogram_class, Histogram)
+
+    def test_default(self):
+        stats = MetricsAggregator('myhost', histogram_backend='sketch')
+
+        for i in xrange(20):
+            stats.submit_packets('myhistogram:{0}|h'.format(i))
+
+        value_by_type = self._flush_values(stats, 'myhistogram')
+
+        self.assertEquals(
+            sorted(value_by_type.keys()),
+            ['95percentile', 'avg', 'count', 'max', 'median'], value_by_type
+        )
+
+        self.assertEquals(value_by_type['max'], 19, value_by_type)
+        self.assertWithinRelativeError(value_by_type['median'], 9, 0.01)
+        self.assertEquals(value_by_type['avg'], 9.5, value_by_type)
+        self.assertEquals(value_by_type['count'], 20.0, value_by_type)
+        self.assertWithinRelativeError(value_by_type['95percentile'], 18, 0.01)
+
+    def test_same_names_as_exact(self):
+        kwargs = {
+            'histogram_aggregates': ['min', 'max', 'median', 'avg', 'count'],
+            'histogram_percentiles': self.PERCENTILES,
+        }
+        exact = MetricsAggregator('myhost', **kwargs)
+        sketch = MetricsAggregator('myhost', histogram_backend='sketch', **kwargs)
+
+        for stats in (exact, sketch):
+            for i in xrange(100):
+                stats.submit_packets('myhistogram:{0}|ms|@0.5'.format(i))
+
+        exact_values = self._flush_values(exact, 'myhistogram')
+        sketch_values = self._flush_values(sketch, 'myhistogram')
+
+        self.assertEquals(sorted(exact_values.keys()), sorted(sketch_values.keys()))
+        for key in ('min', 'max', 'avg', 'count'):
+            self.assertEquals(exact_values[key], sketch_values[key], key)
+
+    def test_relative_accuracy(self):
+        for relative_accuracy in (0.01, 0.05):
+            for distribution in (lambda: random.lognormvariate(0, 2),
+                                 lambda: random.uniform(-1000, 1000),
+                                 lambda: random.randint(0, 5)):
+                values = [distribution() for _ in xrange(5000)]
+                sketch = QuantileSketch(relative_accuracy)
+                for value in values:
+                    sketch.add(value)
+
+                values.sort()
+                for rank in [0, -1] + [int(round(p * len(values) - 1)) for p in self.PERCENTILES]:
+                    self.assertWithinRelativeError(
+                        sketch.value_at_rank(rank), values[rank], relative_accuracy
+                    )
+
+    def test_bounded_bins(self):
+        sketch = QuantileSketch(0.01, max_bins=100)
+        values = [1.01 ** i for i in xrange(5000)]
+        for value in values:
+            sketch.add(value)
+
+        self.assertEquals(len(sketch.positive_bins), 100)
+        self.assertEquals(sketch.count, 5000)
+        # Collapsing only affects the lowest values
+        self.assertWithinRelativeError(sketch.value_at_rank(4950), values[4950], 0.01)
+        self.assertWithinRelativeError(sketch.value_at_rank(-1), values[-1], 0.01)
+
+    def test_merge(self):
+        values = [random.expovariate(0.01) for _ in xrange(2000)]
+        merged = QuantileSketch()
+        single = QuantileSketch()
+        for i in xrange(4):
+            shard = QuantileSketch()
+            for value in values[i::4]:
+                shard.add(value)
+                single.add(value)
+            merged.merge(shard)
+
+        self.assertEquals(merged.count, single.count)
+        self.assertEquals(merged.positive_bins, single.positive_bins)
+
+        first = SketchHistogram(None, 'myhistogram', None, None, None)
+        second = SketchHistogram(None, 'myhistogram', None, None, None)
+        for value in values[:1000]:
+            first.sample(value, 1)
+        for value in values[1000:]:
+            second.sample(value, 1)
+        first.merge(second)
+
+        self.assertEquals(first.count, 2000)
+        self.assertEquals(first.min, min(values))
+        self.assertEquals(first.max, max(values))
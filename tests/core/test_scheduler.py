@@ -0,0 +1,290 @@
+# stdlib
+import threading
+import time
+import unittest
+
+# 3p
+from mock import MagicMock, patch
+import nose.tools as nt
+
+# project
+from checks import AgentCheck
+from checks.check_status import STATUS_ERROR, STATUS_OK
+from checks.collector import Collector
+from checks.scheduler import CheckJob, CheckRunner, CheckScheduler
+
+
+class SlowCheck(AgentCheck):
+
+    def check(self, instance):
+        time.sleep(instance['duration'])
+        self.gauge('slow.duration', instance['duration'])
+
+
+class BlockedCheck(AgentCheck):
+
+    def __init__(self, *args, **kwargs):
+        AgentCheck.__init__(self, *args, **kwargs)
+        self.unblocked = threading.Event()
+
+    def check(self, instance):
+        self.unblocked.wait()
+        self.gauge('blocked.done', 1)
+
+
+def slow_check(name, duration, init_config=None):
+    return SlowCheck(name, init_config or {}, {}, [{'duration': duration}])
+
+
+class TestCheckRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = CheckRunner('myhost', max_workers=4)
+
+    def tearDown(self):
+        self.runner.stop()
+
+    def test_cycle_time_bounded_by_slowest_check(self):
+        durations = [0.5, 0.1, 0.4, 0.2]
+        checks = [slow_check('slow%s' % i, duration) for i, duration in enumerate(durations)]
+        start = time.time()
+        jobs = self.runner.collect(self.runner.submit(checks))
+        cycle_time = time.time() - start
+
+        # Instead of sum(durations) when run one after another
+        self.assertTrue(cycle_time < max(durations) + 0.3, cycle_time)
+        # Results in the order of the checks
+        nt.assert_equal([job.check.name for job in jobs], ['slow0', 'slow1', 'slow2', 'slow3'])
+        for job, duration in zip(jobs, durations):
+            self.assertTrue(job.collected)
+            nt.assert_equal(job.check_status.status, STATUS_OK)
+            nt.assert_equal(job.metrics[0][2], duration)
+            self.assertTrue(job.run_time >= duration)
+            self.assertTrue(job.queue_time < 0.1)
+
+    def test_bounded_pool(self):
+        runner = CheckRunner('myhost', max_workers=2)
+        checks = [slow_check('slow%s' % i, 0.3) for i in xrange(4)]
+        start = time.time()
+        jobs = runner.collect(runner.submit(checks))
+        cycle_time = time.time() - start
+        runner.stop()
+
+        self.assertTrue(0.6 <= cycle_time < 0.9, cycle_time)
+        # The last two waited for a worker
+        self.assertTrue(all(job.queue_time >= 0.3 for job in jobs[2:]))
+
+    def test_timeout(self):
+        blocked = BlockedCheck('blocked', {'check_timeout': 0.2}, {}, [{}])
+        checks = [blocked, slow_check('slow', 0.1)]
+        start = time.time()
+        jobs = self.runner.collect(self.runner.submit(checks))
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertFalse(jobs[0].collected)
+        self.assertTrue(jobs[1].collected)
+
+        check_status, service_check = jobs[0].timeout_results()
+        nt.assert_equal(check_status.status, STATUS_ERROR)
+        nt.assert_equal(service_check['status'], AgentCheck.CRITICAL)
+
+        # Still running during the next run, not run again
+        jobs = self.runner.collect(self.runner.submit(checks))
+        self.assertFalse(jobs[0].collected)
+        self.assertTrue(jobs[1].collected)
+
+        # Its results come with the run after it's done, once
+        blocked.unblocked.set()
+        time.sleep(0.1)
+        jobs = self.runner.collect(self.runner.submit(checks))
+        self.assertTrue(jobs[0].collected)
+        nt.assert_equal(jobs[0].metrics[0][0], 'blocked.done')
+        jobs = self.runner.collect(self.runner.submit(checks))
+        self.assertTrue(jobs[0].collected)
+        nt.assert_equal(jobs[0].metrics[0][0], 'blocked.done')
+        self.assertTrue(jobs[0].run_time < 0.1)
+
+    def test_blocked_checks_dont_starve_the_pool(self):
+        runner = CheckRunner('myhost', max_workers=1, timeout=0.2)
+        blocked = BlockedCheck('blocked', {}, {}, [{}])
+        jobs = runner.collect(runner.submit([blocked, slow_check('slow', 0.05)]))
+        self.assertFalse(jobs[0].collected)
+        self.assertTrue(jobs[1].collected)
+        blocked.unblocked.set()
+        runner.stop()
+
+    def test_stop(self):
+        blocked = BlockedCheck('blocked', {'check_timeout': 10}, {}, [{}])
+        running = [True]
+        jobs = self.runner.submit([blocked])
+        threading.Timer(0.1, lambda: running.pop()).start()
+        nt.assert_equal(self.runner.collect(jobs, lambda: bool(running)), None)
+        blocked.unblocked.set()
+
+
+class FakeRunner(object):
+    """ Runs nothing, and records what it was given """
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, checks):
+        jobs = []
+        for check in checks:
+            self.submitted.append(check.name)
+            jobs.append(CheckJob(check, 'myhost', 10))
+        return jobs
+
+    def ready(self, jobs):
+        return ([job for job in jobs if job.finished_at is not None],
+                [job for job in jobs if job.finished_at is None])
+
+
+class TestCheckScheduler(unittest.TestCase):
+
+    def checks(self):
+        return [
+            slow_check('default', 0),
+            SlowCheck('fast', {'min_collection_interval': 5}, {}, [{'duration': 0}]),
+            SlowCheck('slow', {}, {}, [{'duration': 0, 'min_collection_interval': 300},
+                                       {'duration': 0, 'min_collection_interval': 600}]),
+        ]
+
+    def run_scheduler(self, scheduler, runner, start, end, step=1):
+        now = start
+        names = [check.name for check in self.checks()]
+        while now < end:
+            scheduler.run_due(now)
+            # Everything finishes right away
+            for job in scheduler._jobs:
+                job.finished_at = now
+            ready = [job.check.name for job in scheduler.ready_jobs()]
+            # In the order of the checks
+            nt.assert_equal(ready, sorted(ready, key=names.index))
+            now += step
+        submitted = runner.submitted
+        runner.submitted = []
+        return submitted
+
+    def test_intervals(self):
+        runner = FakeRunner()
+        scheduler = CheckScheduler(runner, 15)
+        checks = self.checks()
+        nt.assert_equal([scheduler.interval(check) for check in checks], [15, 5, 300])
+
+        with patch('random.uniform', return_value=0):
+            scheduler.schedule(checks, now=1000)
+        submitted = self.run_scheduler(scheduler, runner, 1000, 1600)
+        nt.assert_equal(submitted.count('fast'), 120)
+        nt.assert_equal(submitted.count('default'), 40)
+        nt.assert_equal(submitted.count('slow'), 2)
+        nt.assert_equal(submitted[:3], ['default', 'fast', 'slow'])
+        nt.assert_equal(scheduler.ready_jobs(), [])
+
+    def test_jitter(self):
+        runner = FakeRunner()
+        scheduler = CheckScheduler(runner, 15)
+        scheduler.schedule([SlowCheck('slow%s' % i, {'min_collection_interval': 300}, {}, [{'duration': 0}])
+                            for i in xrange(50)], now=1000)
+        # Spread over the first 15s instead of all running at once
+        first_runs = sorted(entry[0] for entry in scheduler._heap)
+        self.assertTrue(first_runs[0] < 1005 and first_runs[-1] > 1010)
+        self.assertTrue(first_runs[-1] <= 1015)
+
+    def test_no_drift(self):
+        runner = FakeRunner()
+        scheduler = CheckScheduler(runner, 15)
+        with patch('random.uniform', return_value=0):
+            scheduler.schedule([slow_check('default', 0)], now=1000)
+        # Woken up late every time
+        for now in (1000.7, 1015.9, 1030.2, 1045.8):
+            nt.assert_equal(scheduler.run_due(now), now - now % 15 + 10 + 15)
+            for job in scheduler._jobs:
+                job.finished_at = now
+        nt.assert_equal(runner.submitted, ['default'] * 4)
+
+    def test_overrun(self):
+        runner = FakeRunner()
+        scheduler = CheckScheduler(runner, 15)
+        checks = self.checks()
+        with patch('random.uniform', return_value=0):
+            scheduler.schedule(checks, now=1000)
+        scheduler.run_due(1000)
+        nt.assert_equal(runner.submitted, ['default', 'fast', 'slow'])
+
+        # `fast` is still running when it's due again, the others aren't held back
+        running = [job for job in scheduler._jobs if job.check.name == 'fast']
+        for job in scheduler._jobs:
+            if job not in running:
+                job.finished_at = 1001
+        runner.submitted = []
+        nt.assert_equal(scheduler.run_due(1005), 1010)
+        nt.assert_equal(runner.submitted, [])
+        nt.assert_equal(scheduler.run_due(1015), 1020)
+        nt.assert_equal(runner.submitted, ['default'])
+
+        # Runs missed meanwhile aren't caught up
+        for job in scheduler._jobs:
+            job.finished_at = 1030
+        runner.submitted = []
+        nt.assert_equal(scheduler.run_due(1032), 1035)
+        nt.assert_equal(sorted(runner.submitted), ['default', 'fast'])
+
+
+class TestCollectorChecks(unittest.TestCase):
+
+    def test_slow_checks(self):
+        agentConfig = {
+            'agent_key': 'test_agentkey',
+            'check_timings': True,
+            'collect_ec2_tags': False,
+            'collect_instance_metadata': False,
+            'create_dd_check_tags': False,
+            'version': 'test',
+            'tags': '',
+            'check_timeout': 1,
+        }
+        durations = [0.6, 0.2, 0.5, 0.3]
+        checks = [slow_check('slow%s' % i, duration) for i, duration in enumerate(durations)]
+        collector = Collector(agentConfig, [], {}, 'myhost')
+        # The first run also collects the host metadata
+        collector.run({'initialized_checks': [], 'init_failed_checks': {}})
+
+        start = time.time()
+        payload = collector.run({'initialized_checks': checks, 'init_failed_checks': {}})
+        cycle_time = time.time() - start
+        collector.stop()
+
+        self.assertTrue(cycle_time < max(durations) + 0.4, cycle_time)
+        nt.assert_equal([m[2] for m in payload['metrics'] if m[0] == 'slow.duration'], durations)
+        timings = [m for m in payload['metrics'] if m[0] == 'sd.agent.check_run_time']
+        nt.assert_equal([m[3]['tags'] for m in timings], [['check:slow%s' % i] for i in xrange(4)])
+
+    def test_scheduled_checks(self):
+        agentConfig = {
+            'agent_key': 'test_agentkey',
+            'collect_ec2_tags': False,
+            'collect_instance_metadata': False,
+            'create_dd_check_tags': False,
+            'version': 'test',
+            'tags': '',
+        }
+        checks = [slow_check('first', 0), slow_check('second', 0)]
+        checksd = {'initialized_checks': checks, 'init_failed_checks': {}}
+        collector = Collector(agentConfig, [], {}, 'myhost')
+        runner = collector.check_runner
+        statuses = []
+
+        def persist(check_statuses, *args):
+            statuses.append([status.name for status in check_statuses])
+            return MagicMock()
+
+        with patch('checks.collector.CollectorStatus', side_effect=persist):
+            payload = collector.run(checksd, check_jobs=runner.collect(runner.submit(checks[1:])))
+            nt.assert_equal(len([m for m in payload['metrics'] if m[0] == 'slow.duration']), 1)
+            payload = collector.run(checksd, check_jobs=runner.collect(runner.submit(checks[:1])))
+            nt.assert_equal(len([m for m in payload['metrics'] if m[0] == 'slow.duration']), 1)
+            collector.run(checksd, check_jobs=[])
+        collector.stop()
+
+        # The latest status of each check, in their order
+        nt.assert_equal(statuses, [['second'], ['first', 'second'], ['first', 'second']])
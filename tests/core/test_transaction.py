@@ -1,8 +1,16 @@
 # stdlib
 from datetime import datetime, timedelta
+import logging
+import random
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+import zlib
 
 # 3rd party
+from mock import patch
 from nose.plugins.attrib import attr
 from nose.plugins.skip import SkipTest
 import requests
@@ -10,15 +18,22 @@ import simplejson as json
 from tornado.web import Application
 
 # project
+from checks.check_status import ForwarderStatus
 from config import get_version
 from sdagent import (
     APIMetricTransaction,
     APIServiceCheckTransaction,
+    EmitterManager,
+    EmitterThread,
+    load_transaction,
     MAX_QUEUE_SIZE,
+    merge_payloads,
     MetricTransaction,
+    PayloadCoalescer,
     THROTTLING_DELAY,
 )
 from transaction import Transaction, TransactionManager
+from utils.spool import Spool
 
 
 class memTransaction(Transaction):
@@ -40,6 +55,46 @@ class memTransaction(Transaction):
         self._trManager.flush_next()
 
 
+class asyncTransaction(memTransaction):
+    """ A transaction whose request stays in flight until the test answers it """
+    sent = []
+
+    def flush(self):
+        self.sent.append(self)
+
+    def respond(self, response_code=None, latency=None):
+        if response_code is None:
+            self._trManager.tr_success(self, latency)
+        else:
+            self._trManager.tr_error(self, response_code)
+        self._trManager.flush_next()
+
+
+class spoolTransaction(memTransaction):
+    """ A transaction that can be written to a spool, and succeeds once flushable """
+    flushed = []
+
+    def __init__(self, payload, manager):
+        memTransaction.__init__(self, len(payload), manager)
+        self.payload = payload
+
+    def flush(self):
+        if self.is_flushable:
+            self.flushed.append(self.payload)
+        memTransaction.flush(self)
+
+    def serialize(self):
+        return self.payload
+
+    @classmethod
+    def loader(cls, manager, flushable):
+        def load_transaction(record):
+            tr = cls(record, manager)
+            tr.is_flushable = flushable
+            return tr
+        return load_transaction
+
+
 @attr(requires='core_integration')
 class TestTransaction(unittest.TestCase):
 
@@ -63,7 +118,7 @@ class TestTransaction(unittest.TestCase):
         # There should be exactly step transaction in the list, with
         # a flush count of 1
         self.assertEqual(len(trManager._transactions), step)
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             self.assertEqual(tr._flush_count, 1)
 
         # Try to add one more
@@ -72,13 +127,13 @@ class TestTransaction(unittest.TestCase):
 
         # At this point, transaction one (the oldest) should have been removed from the list
         self.assertEqual(len(trManager._transactions), step)
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             self.assertNotEqual(tr._id, 1)
 
         trManager.flush()
         self.assertEqual(len(trManager._transactions), step)
         # Check and allow transactions to be flushed
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             tr.is_flushable = True
             # Last transaction has been flushed only once
             if tr._id == step + 1:
@@ -109,6 +164,193 @@ class TestTransaction(unittest.TestCase):
         self.assertTrue((after - before) > 3 * THROTTLING_DELAY - timedelta(microseconds=100000),
                         "before = %s after = %s" % (before, after))
 
+    def testSpool(self):
+        """Test that transactions which don't fit in memory are spooled, and replayed after a restart"""
+        spool_dir = tempfile.mkdtemp()
+        try:
+            spoolTransaction.flushed = []
+            trManager = TransactionManager(timedelta(seconds=0), 300, timedelta(seconds=0),
+                                           spool=Spool(spool_dir, segment_size=200))
+            trManager._load_transaction = spoolTransaction.loader(trManager, False)
+            for i in xrange(10):
+                trManager.append(spoolTransaction('%s' % i * 100, trManager))
+
+            # Only 3 transactions fit in memory, the others are on disk
+            self.assertEqual(len(trManager._transactions), 3)
+            trManager.flush()
+            self.assertEqual(len(trManager._transactions), 3)
+
+            # The endpoint came back after a restart
+            trManager.close()
+            trManager = TransactionManager(timedelta(seconds=0), 300, timedelta(seconds=0),
+                                           spool=Spool(spool_dir, segment_size=200))
+            trManager._load_transaction = spoolTransaction.loader(trManager, True)
+            for _ in xrange(4):
+                trManager.flush()
+
+            self.assertEqual(sorted(spoolTransaction.flushed), ['%s' % i * 100 for i in xrange(10)])
+            self.assertEqual(len(trManager._transactions), 0)
+            self.assertEqual(trManager._spool.read(), None)
+
+            # Nothing is replayed twice
+            trManager.close()
+            spool = Spool(spool_dir)
+            self.assertEqual(spool.read(), None)
+        finally:
+            shutil.rmtree(spool_dir)
+
+    def testSpoolDropped(self):
+        """Test that the transactions dropped from a full spool are reported"""
+        spool_dir = tempfile.mkdtemp()
+        try:
+            trManager = TransactionManager(timedelta(seconds=0), 300, timedelta(seconds=0),
+                                           spool=Spool(spool_dir, max_size=400, segment_size=200))
+            trManager._load_transaction = spoolTransaction.loader(trManager, False)
+            trManager.persist_status()
+            self.assertEqual(ForwarderStatus.load_latest_status().spool_dropped, 0)
+
+            for i in xrange(10):
+                trManager.append(spoolTransaction('%s' % i * 100, trManager))
+            dropped = trManager._spool.dropped_count
+            self.assertTrue(dropped > 0)
+
+            trManager.persist_status()
+            status = ForwarderStatus.load_latest_status()
+            self.assertEqual(status.spool_dropped, dropped)
+            self.assertTrue("Spool dropped: %s transactions" % dropped in status.body_lines())
+            trManager.close()
+        finally:
+            shutil.rmtree(spool_dir)
+
+        # Without a spool, there's nothing to report
+        trManager = TransactionManager(timedelta(seconds=0), 300, timedelta(seconds=0))
+        trManager.persist_status()
+        self.assertEqual(ForwarderStatus.load_latest_status().spool_dropped, None)
+
+    def testConcurrentFlush(self):
+        """Test that the number of requests in flight adapts to the endpoint"""
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, THROTTLING_DELAY,
+                                       max_in_flight=4)
+        trManager._send_delay = 0
+        asyncTransaction.sent = []
+        for i in xrange(20):
+            trManager.append(asyncTransaction(10, trManager))
+
+        trManager.flush()
+        self.assertEqual(len(asyncTransaction.sent), 1)
+        # Every success lets one more request in flight, so the window
+        # doubles with every round trip, up to 4
+        in_flight = []
+        for _ in xrange(4):
+            sent = asyncTransaction.sent
+            asyncTransaction.sent = []
+            for tr in sent:
+                tr.respond()
+            in_flight.append(len(asyncTransaction.sent))
+        self.assertEqual(in_flight, [2, 4, 4, 4])
+
+        # The endpoint is overloaded, the window is halved for each error
+        sent = asyncTransaction.sent
+        asyncTransaction.sent = []
+        sent[0].respond(503)
+        self.assertEqual(trManager._window, 2)
+        self.assertEqual(trManager._in_flight, 3)
+        self.assertTrue(trManager._send_delay >= THROTTLING_DELAY.total_seconds())
+        # A bad payload doesn't slow down the others
+        sent[1].respond(400)
+        self.assertEqual(trManager._window, 2)
+        self.assertEqual(len(asyncTransaction.sent), 0)
+
+    def testWindowLargerThanClient(self):
+        """Test that requests waiting for a connection don't count as the endpoint being slow"""
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, THROTTLING_DELAY,
+                                       max_in_flight=8)
+        trManager._send_delay = 0
+        asyncTransaction.sent = []
+        for i in xrange(40):
+            trManager.append(asyncTransaction(10, trManager))
+        trManager.flush()
+
+        # A client with 2 workers, the other requests in the window wait for them
+        workers = 2
+        queued = 0
+        for _ in xrange(12):
+            started = asyncTransaction.sent[:workers]
+            del asyncTransaction.sent[:workers]
+            start = time.time()
+            time.sleep(0.1)
+            for tr in started:
+                queued = max(queued, start - tr._sent_at)
+                tr.respond(latency=time.time() - start)
+        self.assertTrue(queued > 0.2, queued)
+        self.assertEqual(trManager._window, 8)
+        self.assertEqual(len(asyncTransaction.sent), 8)
+
+    def testLiveBeforeReplay(self):
+        """Test that transactions which never failed are sent first"""
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0))
+        asyncTransaction.sent = []
+        replayed = asyncTransaction(10, trManager)
+        trManager.append(replayed)
+        trManager.flush()
+        asyncTransaction.sent[0].respond(500)
+
+        trManager._send_delay = 0
+        live = [asyncTransaction(10, trManager) for _ in xrange(3)]
+        for tr in live:
+            trManager.append(tr)
+        asyncTransaction.sent = []
+        trManager.flush()
+        while asyncTransaction.sent[-1] is not replayed:
+            asyncTransaction.sent[-1].respond()
+        self.assertEqual(set(asyncTransaction.sent[:3]), set(live))
+
+        # The drain rate and time to empty are reported
+        for tr in asyncTransaction.sent:
+            if tr._sent_at is not None:
+                tr.respond()
+        trManager.flush()
+        status = ForwarderStatus.load_latest_status()
+        self.assertTrue(status.drain_rate > 0)
+        self.assertEqual(status.time_to_empty, 0)
+
+    def testRetryIndex(self):
+        """Test that flushes only pick due transactions, and that the queue index stays compact"""
+        trManager = TransactionManager(timedelta(seconds=60), MAX_QUEUE_SIZE, timedelta(seconds=0))
+        for i in xrange(10):
+            trManager.append(memTransaction(10, trManager))
+
+        # Every transaction fails, and is only replayed a while later
+        trManager.flush()
+        trManager.flush()
+        for tr in trManager.get_transactions():
+            self.assertEqual(tr._flush_count, 1)
+
+        # Transactions due the soonest are flushed first, the latest ones are dropped first
+        late, soon = trManager.get_transactions()[:2]
+        late._next_flush = datetime.utcnow() + timedelta(days=1)
+        soon._next_flush = datetime.utcnow() - timedelta(seconds=1)
+        soon.is_flushable = True
+        trManager._schedule(late)
+        trManager._schedule(soon)
+        trManager.flush()
+        self.assertEqual(soon._flush_count, 2)
+        self.assertEqual(len(trManager._transactions), 9)
+        trManager._MAX_QUEUE_SIZE = 90
+        trManager.append(memTransaction(10, trManager))
+        self.assertTrue(late.get_id() not in trManager._transactions)
+        trManager._MAX_QUEUE_SIZE = MAX_QUEUE_SIZE
+
+        # Removed entries don't pile up in the heaps
+        for i in xrange(2500):
+            tr = memTransaction(10, trManager)
+            tr.is_flushable = True
+            trManager.append(tr)
+            trManager.flush()
+        self.assertEqual(len(trManager._transactions), 9)
+        self.assertTrue(len(trManager._flush_heap) < 2100)
+        self.assertTrue(len(trManager._evict_heap) < 2100)
+
     def testCustomEndpoint(self):
         MetricTransaction._endpoints = []
 
@@ -121,7 +363,6 @@ class TestTransaction(unittest.TestCase):
         app = Application()
         app.skip_ssl_validation = False
         app._agentConfig = config
-        app.use_simple_http_client = True
 
         trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, THROTTLING_DELAY)
         trManager._flush_without_ioloop = True  # Use blocking API to emulate tornado ioloop
@@ -134,6 +375,148 @@ class TestTransaction(unittest.TestCase):
         expected = ['https://foo.bar.com/intake/msgtype?agent_key=foo']
         self.assertEqual(endpoints, expected, (endpoints, expected))
 
+    def testQueuedPayloadSize(self):
+        """Test that payloads are queued compressed, and that the queue size is their actual footprint"""
+        MetricTransaction._endpoints = []
+        app = Application()
+        app.skip_ssl_validation = False
+        app._agentConfig = {"sd_url": "https://foo.bar.com"}
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, THROTTLING_DELAY)
+        MetricTransaction._trManager = trManager
+        MetricTransaction.set_application(app)
+
+        payloads = []
+        for i in xrange(30):
+            metrics = [["system.disk.%s" % j, random.random() * 1000, {"device": "/dev/sd%s" % j}]
+                       for j in xrange(1000)]
+            payloads.append(json.dumps({"agentKey": "foo", "metrics": metrics}))
+        raw_size = sum(len(payload) for payload in payloads)
+
+        trs = [MetricTransaction(payload, {'Content-Type': 'application/json'}, "metrics")
+               for payload in payloads]
+
+        self.assertEqual(zlib.decompress(trs[0]._data), payloads[0])
+        self.assertEqual(trs[0]._headers['Content-Encoding'], 'deflate')
+        self.assertTrue(trManager._total_size < raw_size / 3, (trManager._total_size, raw_size))
+        self.assertEqual(trManager._total_size, sum(tr.get_size() for tr in trs))
+
+        # The compressed payload, the headers, and the transaction itself
+        for tr in trs:
+            headers = sum(len(name) + len(value) for name, value in tr._headers.iteritems())
+            parts = len(tr._data) + headers
+            self.assertTrue(parts < tr.get_size() < parts + 4096, (tr.get_size(), parts))
+
+    def testMergePayloads(self):
+        merged = {'uuid': 'a', 'events': {'api': [1, 2]}}
+        self.assertTrue(merge_payloads(merged, {'uuid': 'a', 'events': {'api': [3], 'other': [4]}}))
+        self.assertEqual(merged, {'uuid': 'a', 'events': {'api': [1, 2, 3], 'other': [4]}})
+
+        # Payloads with different values, or values only one of them has, are kept apart
+        for payload in [{'uuid': 'b', 'events': {'api': [3]}},
+                        {'events': {'api': [3]}},
+                        {'uuid': 'a', 'events': {'api': [3]}, 'timestamp': 1},
+                        {'uuid': 'a', 'events': {'api': [3], 'count': 1}},
+                        {'uuid': 'a', 'events': [3]}]:
+            self.assertFalse(merge_payloads(merged, payload), payload)
+        self.assertEqual(merged, {'uuid': 'a', 'events': {'api': [1, 2, 3], 'other': [4]}})
+
+        # Only lists of records are concatenated, the others must be equal
+        merged = {'series': [1], 'tags': ['env:prod'], 'host-tags': {'system': ['role:db']}}
+        for payload in [{'series': [2], 'tags': ['env:dev'], 'host-tags': {'system': ['role:db']}},
+                        {'series': [2], 'tags': ['env:prod'], 'host-tags': {'system': ['role:web']}}]:
+            self.assertFalse(merge_payloads(merged, payload), payload)
+        self.assertTrue(merge_payloads(merged, {'series': [2], 'tags': ['env:prod'],
+                                                'host-tags': {'system': ['role:db']}}))
+        self.assertEqual(merged, {'series': [1, 2], 'tags': ['env:prod'], 'host-tags': {'system': ['role:db']}})
+
+    def testCoalescer(self):
+        """Test that compatible payloads are sent as one transaction, and accounted for by source"""
+        MetricTransaction._endpoints = []
+        app = Application()
+        app._agentConfig = {"sd_url": "https://foo.bar.com"}
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, THROTTLING_DELAY)
+        MetricTransaction._trManager = trManager
+        MetricTransaction.set_application(app)
+
+        def events(source, *ids):
+            return json.dumps({'uuid': source, 'events': {'api': list(ids)}})
+
+        coalescer = PayloadCoalescer(60, max_size=200)
+        headers = {'Content-Type': 'application/json'}
+        for source, data in [('a', events('a', 1)), ('a', events('b', 3)), ('b', events('a', 2)),
+                             ('a', events('b', 4)), ('c', 'not json')]:
+            coalescer.add(MetricTransaction, data, dict(headers), '', source)
+        # Not JSON: sent right away
+        self.assertEqual(len(trManager._transactions), 1)
+        coalescer.flush_all()
+
+        trs = trManager.get_transactions()
+        self.assertEqual([json.loads(zlib.decompress(tr._data)) for tr in trs[1:]],
+                         [{'uuid': 'a', 'events': {'api': [1, 2]}}, {'uuid': 'b', 'events': {'api': [3, 4]}}])
+        self.assertEqual([tr._sources for tr in trs], [{'c': 1}, {'a': 1, 'b': 1}, {'a': 2}])
+
+        # Big enough batches are sent without waiting
+        for i in xrange(10):
+            coalescer.add(MetricTransaction, events('c', *range(10)), dict(headers), '', 'c')
+        self.assertEqual(len(trManager._transactions), 5)
+        self.assertEqual(coalescer.pending.values()[0][0].count, 2)
+
+        for tr in trs[:2]:
+            trManager.tr_success(tr)
+        trManager.persist_status()
+        self.assertEqual(ForwarderStatus.load_latest_status().sources,
+                         {'a': {'received': 3, 'flushed': 1},
+                          'b': {'received': 1, 'flushed': 1},
+                          'c': {'received': 9, 'flushed': 1}})
+
+    def testCoalescerSpool(self):
+        """Test that held payloads are spooled until the transaction they're merged in is"""
+        MetricTransaction._endpoints = []
+        app = Application()
+        app._agentConfig = {"sd_url": "https://foo.bar.com"}
+        MetricTransaction.set_application(app)
+
+        def events(*ids):
+            return json.dumps({'uuid': 'a', 'events': {'api': list(ids)}})
+
+        def spooled(spool_dir):
+            spool = Spool(spool_dir)
+            records = []
+            entry = spool.read()
+            while entry is not None:
+                tr = load_transaction(entry[0])
+                data = zlib.decompress(tr._data) if tr._headers.get('Content-Encoding') else tr._data
+                records.append((json.loads(data), tr._sources))
+                entry = spool.read()
+            spool.close()
+            return records
+
+        for flush in (False, True):
+            spool_dir = tempfile.mkdtemp()
+            try:
+                spool = Spool(spool_dir)
+                trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, THROTTLING_DELAY,
+                                               spool=spool, load_transaction=load_transaction)
+                MetricTransaction._trManager = trManager
+                coalescer = PayloadCoalescer(60, spool=spool)
+                headers = {'Content-Type': 'application/json'}
+                coalescer.add(MetricTransaction, events(1), dict(headers), '', 'a')
+                coalescer.add(MetricTransaction, events(2), dict(headers), '', 'b')
+                self.assertEqual(len(trManager._transactions), 0)
+                if flush:
+                    coalescer.flush_all()
+                spool.close()
+
+                if flush:
+                    # Only the merged transaction is left
+                    self.assertEqual(spooled(spool_dir), [(json.loads(events(1, 2)), {'a': 1, 'b': 1})])
+                else:
+                    # Stopped while they're held: they're replayed on their own
+                    self.assertEqual(spooled(spool_dir), [(json.loads(events(1)), {'a': 1}),
+                                                          (json.loads(events(2)), {'b': 1})])
+            finally:
+                shutil.rmtree(spool_dir)
+
     def testEndpoints(self):
         """
         Tests that the logic behind the agent version specific endpoints is ok.
@@ -151,7 +534,6 @@ class TestTransaction(unittest.TestCase):
         app = Application()
         app.skip_ssl_validation = False
         app._agentConfig = config
-        app.use_simple_http_client = True
 
         trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, THROTTLING_DELAY)
         trManager._flush_without_ioloop = True  # Use blocking API to emulate tornado ioloop
@@ -197,3 +579,68 @@ class TestTransaction(unittest.TestCase):
             r = requests.post(url, data=json.dumps({'check': 'test', 'status': 0}),
                               headers={'Content-Type': "application/json"})
             r.raise_for_status()
+
+
+class TestEmitterManager(unittest.TestCase):
+
+    def emitter_thread(self, emitter, **kwargs):
+        thread = EmitterThread(name=emitter.__name__, emitter=lambda: emitter, logger=logging,
+                               config={}, **kwargs)
+        thread.start()
+        return thread
+
+    def testSharedDecoding(self):
+        done = threading.Semaphore(0)
+        received = {}
+
+        def decoded(data, logger, config):
+            received['decoded'] = data
+            done.release()
+
+        def raw(payload, logger, config):
+            received['raw'] = payload.raw
+            received['raw_data'] = payload.data
+            done.release()
+        raw.raw_payload = True
+
+        manager = EmitterManager({})
+        manager.emitterThreads = [self.emitter_thread(decoded), self.emitter_thread(raw)]
+        headers = {'Content-Encoding': 'deflate'}
+        body = zlib.compress(json.dumps({'metrics': [1, 2]}))
+        with patch('utils.serialization.decode', side_effect=json.loads) as decode:
+            manager.send(body, headers)
+            # Changes made by the transaction afterwards don't apply to the emitters
+            headers['Content-Encoding'] = 'gzip'
+            done.acquire()
+            done.acquire()
+            self.assertEqual(decode.call_count, 1)
+
+        self.assertEqual(received, {'decoded': {'metrics': [1, 2]}, 'raw': body,
+                                    'raw_data': {'metrics': [1, 2]}})
+
+    def testBackpressureMetrics(self):
+        blocked = threading.Event()
+
+        def slow(data, logger, config):
+            blocked.wait()
+        slow.raw_payload = True
+
+        manager = EmitterManager({})
+        manager.emitterThreads = [self.emitter_thread(slow, max_queue_size=2)]
+        manager.send('{}')
+        # Wait for the emitter to be busy with it
+        while manager.stats()['slow']['queue_depth']:
+            time.sleep(0.01)
+        for i in xrange(4):
+            manager.send('{}')
+        stats = manager.stats()['slow']
+        self.assertEqual(stats['queue_depth'], 2)
+        self.assertEqual(stats['dropped'], 2)
+
+        blocked.set()
+        while manager.stats()['slow']['handled'] < 3:
+            time.sleep(0.01)
+        stats = manager.stats()['slow']
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertTrue(stats['latency_max'] >= stats['latency_avg'] > 0)
+
@@ -0,0 +1,133 @@
+# stdlib
+import BaseHTTPServer
+import os
+import SocketServer
+import ssl
+import threading
+import time
+import unittest
+
+# 3p
+import nose.tools as nt
+from tornado.ioloop import IOLoop
+
+# project
+from utils.http import PooledHTTPClient
+
+CERTS_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'ci', 'resources', 'nginx')
+
+
+class IntakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append((self.path, body))
+        code = 202 if self.path != '/fail' else 503
+        if self.path == '/redirect':
+            # What some proxies do
+            code = 302
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        if code == 302:
+            self.send_header('Location', '/intake')
+        if self.path == '/close':
+            self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPSIntake(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ A stand-in for the HTTPS intake """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), IntakeHandler)
+        self.socket = ssl.wrap_socket(self.socket, server_side=True,
+                                      certfile=os.path.join(CERTS_DIR, 'testing.crt'),
+                                      keyfile=os.path.join(CERTS_DIR, 'testing.key'))
+        self.received = []
+
+    def handle_error(self, request, client_address):
+        # Clients refusing the certificate
+        pass
+
+
+class TestPooledHTTPClient(unittest.TestCase):
+
+    def setUp(self):
+        self.intake = HTTPSIntake()
+        thread = threading.Thread(target=self.intake.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'https://127.0.0.1:%s' % self.intake.server_address[1]
+        self.io_loop = IOLoop()
+
+    def tearDown(self):
+        self.intake.shutdown()
+        self.intake.server_close()
+        self.io_loop.close()
+
+    def post(self, client, count, path='/intake'):
+        responses = []
+
+        def on_response(response):
+            responses.append(response)
+            if len(responses) == count:
+                self.io_loop.stop()
+
+        for i in xrange(count):
+            client.fetch(self.url + path, 'payload %s' % i, {'Content-Type': 'text/plain'}, on_response)
+        self.io_loop.add_timeout(time.time() + 10, self.io_loop.stop)
+        self.io_loop.start()
+        return responses
+
+    def test_connections_are_reused(self):
+        client = PooledHTTPClient(self.io_loop, max_connections=2, verify=False)
+        responses = self.post(client, 20)
+        nt.assert_equal([r.code for r in responses], [202] * 20)
+        nt.assert_equal(sorted(body for _, body in self.intake.received),
+                        sorted('payload %s' % i for i in xrange(20)))
+
+        stats = client.stats()
+        nt.assert_equal(stats['requests'], 20)
+        self.assertTrue(stats['connections_opened'] <= 2, stats)
+        nt.assert_equal(stats['connections_reused'], 20 - stats['connections_opened'])
+
+    def test_errors(self):
+        client = PooledHTTPClient(self.io_loop, verify=False)
+        response = self.post(client, 1, path='/fail')[0]
+        nt.assert_equal(response.code, 503)
+        self.assertTrue(response.error is not None)
+
+        # Certificate not trusted
+        client = PooledHTTPClient(self.io_loop)
+        response = self.post(client, 1)[0]
+        nt.assert_equal(response.code, 599)
+        self.assertTrue(response.error is not None)
+
+    def test_redirections_keep_the_post(self):
+        client = PooledHTTPClient(self.io_loop, verify=False, keep_method_on_redirect=True)
+        response = self.post(client, 1, path='/redirect')[0]
+        nt.assert_equal(response.code, 202)
+        nt.assert_equal(self.intake.received, [('/redirect', 'payload 0'), ('/intake', 'payload 0')])
+
+    def test_connections_closed_by_the_server(self):
+        client = PooledHTTPClient(self.io_loop, max_connections=1, verify=False)
+        for _ in xrange(3):
+            nt.assert_equal(self.post(client, 1, path='/close')[0].code, 202)
+        stats = client.stats()
+        nt.assert_equal(stats['connections_opened'], 3)
+        nt.assert_equal(stats['connections_reused'], 0)
+
+    def test_idle_connections_are_closed(self):
+        client = PooledHTTPClient(self.io_loop, max_connections=1, idle_timeout=0.1, verify=False)
+        self.post(client, 2)
+        nt.assert_equal(client.stats()['connections_opened'], 1)
+        time.sleep(0.2)
+        self.post(client, 2)
+        stats = client.stats()
+        nt.assert_equal(stats['connections_opened'], 2)
+        nt.assert_equal(stats['connections_reused'], 2)
@@ -0,0 +1,233 @@
+# stdlib
+import logging
+import os
+import pwd
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+# 3p
+import nose.tools as nt
+
+# project
+from checks.system.unix import IO
+from utils.procfs import (
+    CPU_PERCENT_FIELDS,
+    CpuSampler,
+    CpuTimes,
+    DISK_IO_FIELDS,
+    DiskSampler,
+    parse_cpu_times,
+    ProcessTable,
+)
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'fixtures', 'procfs')
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURE_DIR, name)) as f:
+        return f.read()
+
+
+def parse_mpstat(output):
+    """ Averages of an `mpstat -P ALL` report, {cpu: {field: percentage}} """
+    lines = [l.split() for l in output.splitlines() if l.startswith('Average:')]
+    fields = [h.lstrip('%') for h in lines[0][2:]]
+    cpus = {}
+    for line in lines[1:]:
+        cpu = line[1] if line[1] == 'all' else int(line[1])
+        cpus[cpu] = dict(zip(fields, map(float, line[2:])))
+    return cpus
+
+
+class TestCpuSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'stat')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_stat(self, data):
+        with open(self.path, 'w') as f:
+            f.write(data)
+
+    def test_parse(self):
+        cpus = parse_cpu_times(read_fixture('stat_1'))
+        nt.assert_equal(sorted(cpus), [0, 1, 'all'])
+        nt.assert_equal(cpus['all'], CpuTimes(4705, 356, 584, 3699176, 23060, 0, 277, 2051, 1034, 0))
+
+        # Before guest_nice, guest and steal
+        cpus = parse_cpu_times('cpu  10 20 30 40 50 60 70\n')
+        nt.assert_equal(cpus['all'], CpuTimes(10, 20, 30, 40, 50, 60, 70, 0, 0, 0))
+
+    def test_mpstat_parity(self):
+        sampler = CpuSampler(self.path)
+        self.write_stat(read_fixture('stat_1'))
+        sampler.sample()
+        self.write_stat(read_fixture('stat_2'))
+        sample = sampler.sample()
+
+        mpstat = parse_mpstat(read_fixture('mpstat'))
+        nt.assert_equal(sorted(sample), sorted(mpstat))
+        for cpu, expected in mpstat.iteritems():
+            nt.assert_equal(sorted(sample[cpu]), sorted(CPU_PERCENT_FIELDS))
+            for field, value in expected.iteritems():
+                nt.assert_almost_equal(sample[cpu][field], value, delta=0.005,
+                                       msg="%s of cpu %s" % (field, cpu))
+            nt.assert_almost_equal(sum(sample[cpu].values()), 100)
+
+    def test_first_sample_since_boot(self):
+        self.write_stat('cpu  300 0 100 600 0 0 0 0 0 0\n')
+        sample = CpuSampler(self.path).sample()
+        nt.assert_equal(sample['all']['usr'], 30)
+        nt.assert_equal(sample['all']['sys'], 10)
+        nt.assert_equal(sample['all']['idle'], 60)
+
+    def test_idle_or_offline_cpu(self):
+        sampler = CpuSampler(self.path)
+        self.write_stat('cpu  300 0 100 600 0 0 0 0 0 0\ncpu0 300 0 100 600 0 0 0 0 0 0\n')
+        sampler.sample()
+        # No tick, and a hotplugged cpu sampled since boot
+        self.write_stat('cpu  300 0 100 600 0 0 0 0 0 0\ncpu0 300 0 100 600 0 0 0 0 0 0\n'
+                        'cpu1 0 0 50 50 0 0 0 0 0 0\n')
+        sample = sampler.sample()
+        nt.assert_equal(sample['all']['idle'], 100)
+        nt.assert_equal(sample['all']['usr'], 0)
+        nt.assert_equal(sample[1]['sys'], 50)
+
+
+class TestDiskSampler(unittest.TestCase):
+
+    WHOLE_DISKS = ['loop0', 'loop1', 'sda', 'sdb', 'dm-0', 'cciss!c0d0', 'nvme0n1']
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'diskstats')
+        self.uptime_path = os.path.join(self.tmp_dir, 'uptime')
+        self.sys_block_path = os.path.join(self.tmp_dir, 'block')
+        os.mkdir(self.sys_block_path)
+        for name in self.WHOLE_DISKS:
+            os.mkdir(os.path.join(self.sys_block_path, name))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def sample(self, sampler, index):
+        shutil.copy(os.path.join(FIXTURE_DIR, 'diskstats_%s' % index), self.path)
+        shutil.copy(os.path.join(FIXTURE_DIR, 'uptime_%s' % index), self.uptime_path)
+        return sampler.sample()
+
+    def test_iostat_parity(self):
+        sampler = DiskSampler(self.path, self.uptime_path, self.sys_block_path)
+        # Since boot
+        sample = self.sample(sampler, 1)
+        nt.assert_equal(sample['sda']['r/s'], '92.83')
+        nt.assert_equal(sample['sda']['%util'], '100.00')
+
+        sample = self.sample(sampler, 2)
+        iostat = IO(logging.getLogger(__file__))._parse_linux2(read_fixture('iostat'))
+        # Whole disks that did some IO, no partitions
+        nt.assert_equal(sorted(sample), ['cciss/c0d0', 'dm-0', 'nvme0n1', 'sda', 'sdb'])
+        nt.assert_equal(sample, iostat)
+        for device in sample:
+            nt.assert_equal(sorted(sample[device]), sorted(DISK_IO_FIELDS))
+
+    def test_without_sysfs(self):
+        sampler = DiskSampler(self.path, self.uptime_path, os.path.join(self.tmp_dir, 'missing'))
+        sample = self.sample(sampler, 1)
+        nt.assert_equal(sorted(sample), ['cciss/c0d0', 'dm-0', 'nvme0n1', 'sda', 'sda1', 'sda2', 'sdb'])
+
+    def test_same_uptime(self):
+        sampler = DiskSampler(self.path, self.uptime_path, self.sys_block_path)
+        self.sample(sampler, 1)
+        nt.assert_equal(self.sample(sampler, 1), {})
+
+
+BOOT_TIME = 1476600000
+
+
+def stat_line(pid, comm, state='S', pgrp=None, session=None, tty_nr=0, tpgid=-1, utime=0, stime=0,
+              nice=0, threads=1, start_ticks=100, vsize=0, rss=0):
+    """ A /proc/<pid>/stat line """
+    return ('%s (%s) %s 1 %s %s %s %s 4194560 100 0 0 0 %s %s 0 0 20 %s %s 0 %s %s %s '
+            '18446744073709551615 1 1 0 0 0 0 0 4096 0 0 0 0 17 0 0 0 0 0 0\n') % (
+        pid, comm, state, pid if pgrp is None else pgrp, pid if session is None else session, tty_nr, tpgid, utime, stime,
+        nice, threads, start_ticks, vsize, rss)
+
+
+class TestProcessTable(unittest.TestCase):
+
+    def setUp(self):
+        self.proc = tempfile.mkdtemp()
+        self.write('stat', 'cpu  1 2 3 4\nbtime %s\n' % BOOT_TIME)
+        self.write('uptime', '7200.00 14000.00\n')
+        self.write('meminfo', 'MemTotal:        2000000 kB\nMemFree:          500000 kB\n')
+        self.write_process(1, stat_line(1, 'init', utime=50000, stime=22000, vsize=34000 * 1024, rss=1000),
+                           '/sbin/init\0splash\0')
+        self.write_process(42, stat_line(42, 'kworker/0:1', 'I', pgrp=0, session=0, nice=-20, start_ticks=200), '')
+        self.write_process(1234, stat_line(1234, 'python (worker)', 'R', session=1200, tty_nr=(136 << 8) | 3,
+                                           tpgid=1234, utime=300, stime=100, nice=5, threads=4,
+                                           start_ticks=620000, vsize=100 * 1024 * 1024, rss=25000),
+                           'python\0worker.py\0--name\0a\nb\0')
+        self.table = ProcessTable(self.proc)
+        self.table.ticks = 100
+        self.table.page_kb = 4
+        self.user = pwd.getpwuid(os.getuid()).pw_name[:8]
+
+    def tearDown(self):
+        shutil.rmtree(self.proc)
+
+    def write(self, path, data):
+        with open(os.path.join(self.proc, path), 'w') as f:
+            f.write(data)
+
+    def write_process(self, pid, stat, cmdline):
+        os.mkdir(os.path.join(self.proc, str(pid)))
+        self.write('%s/stat' % pid, stat)
+        self.write('%s/cmdline' % pid, cmdline)
+
+    def start(self, seconds):
+        return time.strftime('%H:%M', time.localtime(BOOT_TIME + seconds))
+
+    def test_columns(self):
+        rows = self.table.read(now=BOOT_TIME + 7200)
+        nt.assert_equal(rows, [
+            [self.user, '1', '10.0', '0.2', '34000', '4000', '?', 'Ss', self.start(1), '12:00', '/sbin/init splash'],
+            [self.user, '42', '0.0', '0.0', '0', '0', '?', 'I<', self.start(2), '0:00', '[kworker/0:1]'],
+            [self.user, '1234', '0.4', '5.0', '102400', '100000', 'pts/3', 'RNl+', self.start(6200), '0:04',
+             'python worker.py --name a?b'],
+        ])
+        nt.assert_equal([row[10] for row in self.table.read(exclude_args=True)],
+                        ['/sbin/init', '[kworker/0:1]', 'python'])
+
+        # Started more than a day ago
+        nt.assert_equal(self.table.read(now=BOOT_TIME + 3 * 24 * 3600)[0][8],
+                        time.strftime('%b%d', time.localtime(BOOT_TIME + 1)))
+
+    def test_static_fields_cached(self):
+        self.table.read()
+        self.write('1/cmdline', '/sbin/init\0')
+        nt.assert_equal(self.table.read()[0][10], '/sbin/init splash')
+
+        # Same pid, another process
+        self.write('1/stat', stat_line(1, 'init', start_ticks=300))
+        nt.assert_equal(self.table.read()[0][10], '/sbin/init')
+
+        # Exited
+        shutil.rmtree(os.path.join(self.proc, '1234'))
+        nt.assert_equal([row[1] for row in self.table.read()], ['1', '42'])
+        nt.assert_equal(sorted(self.table._static), [('1', '300'), ('42', '200')])
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "requires /proc")
+    def test_ps_parity(self):
+        rows = dict((row[1], row) for row in ProcessTable().read())
+        ps = subprocess.check_output(['ps', 'uww', '-p', str(os.getpid())]).splitlines()[1].split(None, 10)
+        row = rows[str(os.getpid())]
+        # USER, PID, TTY, START and COMMAND
+        for column in (0, 1, 6, 8, 10):
+            nt.assert_equal(row[column], ps[column])
@@ -0,0 +1,60 @@
+# stdlib
+from collections import namedtuple
+from decimal import Decimal
+import unittest
+import zlib
+
+# 3p
+from mock import patch
+import nose.tools as nt
+import simplejson
+
+# project
+from utils import serialization
+
+
+class TestSerialization(unittest.TestCase):
+
+    def payload(self, metric_count):
+        Point = namedtuple('Point', ['timestamp', 'value'])
+        return {
+            'series': [{'metric': 'metric.%s' % i, 'points': [Point(1476600000, i * 0.5)],
+                        'tags': [u'caf\xe9', 'env:prod'], 'host': None} for i in xrange(metric_count)],
+            'metrics': [('metric', 1476600000, Decimal('1.10'), {'type': 'gauge'})] * metric_count,
+            'events': {'api': [{'msg_title': u'\u2603', 'priority': 'normal'}]},
+        }
+
+    def test_encode(self):
+        payload = self.payload(10)
+        nt.assert_equal(serialization.encode(payload), simplejson.dumps(payload))
+        raw = simplejson.dumps(payload)
+        nt.assert_equal(serialization.decode(raw), simplejson.loads(raw))
+
+    def test_encode_compressed(self):
+        for metric_count in (0, 10, 1234):
+            payload = self.payload(metric_count)
+            payload[42] = {'not a string key': True}
+            data, compressed = serialization.encode_compressed(payload)
+            self.assertTrue(compressed)
+            nt.assert_equal(zlib.decompress(data), simplejson.dumps(payload))
+
+    def test_encode_compressed_is_streamed(self):
+        payload = self.payload(2000)
+        with patch.object(serialization, 'STREAM_CHUNK_ITEMS', 100):
+            chunks = list(serialization._iterencode(payload))
+            data, _ = serialization.encode_compressed(payload)
+        nt.assert_equal(zlib.decompress(data), simplejson.dumps(payload))
+        # The series and metrics lists are encoded 100 items at a time
+        self.assertTrue(len(chunks) >= 40)
+        self.assertTrue(max(len(chunk) for chunk in chunks) < len(simplejson.dumps(payload)) / 20)
+
+    def test_encode_compressed_threshold(self):
+        payload = {'series': []}
+        nt.assert_equal(serialization.encode_compressed(payload, 100), ('{"series": []}', False))
+        data, compressed = serialization.encode_compressed(self.payload(10), 100)
+        self.assertTrue(compressed)
+        nt.assert_equal(zlib.decompress(data), simplejson.dumps(self.payload(10)))
+
+    def test_invalid_strings(self):
+        # dogstatsd relies on it to replace them
+        self.assertRaises(UnicodeDecodeError, serialization.encode_compressed, {'series': ['\xff' * 10] * 1000})
@@ -0,0 +1,91 @@
+# stdlib
+import os
+import shutil
+import tempfile
+import unittest
+
+# 3p
+import nose.tools as nt
+
+# project
+from utils.spool import Spool
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def read_all(self, spool):
+        records = []
+        while True:
+            entry = spool.read()
+            if entry is None:
+                return records
+            records.append(entry)
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.path) if name.endswith('.seg'))
+
+    def test_fifo(self):
+        spool = Spool(self.path, segment_size=100)
+        for i in xrange(20):
+            spool.append('record %s' % i)
+        nt.assert_equal([record for record, _ in self.read_all(spool)],
+                        ['record %s' % i for i in xrange(20)])
+        nt.assert_equal(spool.read(), None)
+
+        spool.append('late record')
+        nt.assert_equal(spool.read()[0], 'late record')
+
+    def test_segments_are_removed_once_acknowledged(self):
+        spool = Spool(self.path, segment_size=100)
+        for i in xrange(20):
+            spool.append('record %s' % i)
+        self.assertTrue(len(self.segments()) > 2)
+
+        for _, position in self.read_all(spool):
+            spool.ack(position)
+        # Only the segment being written is left
+        nt.assert_equal(len(self.segments()), 1)
+
+    def test_reopen_after_crash(self):
+        spool = Spool(self.path, segment_size=100, fsync='never')
+        for i in xrange(20):
+            spool.append('record %s' % i)
+        for record, position in self.read_all(spool)[:5]:
+            spool.ack(position)
+        spool.writer.flush()
+
+        # Torn write of a record that never made it
+        with open(os.path.join(self.path, self.segments()[-1]), 'ab') as f:
+            f.write('\x00\x00\x01\x00garbage')
+
+        spool = Spool(self.path, segment_size=100)
+        nt.assert_equal([record for record, _ in self.read_all(spool)],
+                        ['record %s' % i for i in xrange(5, 20)])
+
+    def test_read_on_append(self):
+        spool = Spool(self.path)
+        position = spool.append('in memory', read=True)
+        nt.assert_equal(spool.read(), None)
+        spool.append('on disk')
+        nt.assert_equal(spool.read()[0], 'on disk')
+
+        spool.ack(position)
+        spool.close()
+        spool = Spool(self.path)
+        nt.assert_equal([record for record, _ in self.read_all(spool)], ['on disk'])
+
+    def test_max_size(self):
+        spool = Spool(self.path, max_size=1000, segment_size=100)
+        for i in xrange(100):
+            spool.append('record %02d' % i)
+        self.assertTrue(spool.size <= 1000)
+        records = [record for record, _ in self.read_all(spool)]
+        # The oldest records were dropped
+        nt.assert_equal(records[-1], 'record 99')
+        nt.assert_equal(len(records) + spool.dropped_count, 100)
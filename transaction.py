@@ -4,8 +4,8 @@
 
 # stdlib
 from datetime import datetime, timedelta
+import heapq
 import logging
-from operator import attrgetter
 import sys
 import time
 
@@ -18,6 +18,24 @@ log = logging.getLogger(__name__)
 FLUSH_LOGGING_PERIOD = 20
 FLUSH_LOGGING_INITIAL = 5
 
+# Requests sent at the same time when the endpoint keeps up
+MAX_IN_FLIGHT = 8
+# Longest delay between two requests when the endpoint is struggling, in seconds
+MAX_THROTTLING_DELAY = 30
+# Below that, requests are sent right away
+MIN_THROTTLING_DELAY = 0.01
+# The endpoint is considered overloaded when its latency gets that many times its
+# best one, and over MIN_OVERLOADED_LATENCY seconds
+LATENCY_TOLERANCE = 3
+MIN_OVERLOADED_LATENCY = 0.2
+# Weight of the last latency in the latency moving average
+LATENCY_SMOOTHING = 0.2
+# The queue heaps are rebuilt once they hold that many times more removed
+# entries than transactions
+MAX_STALE_RATIO = 2
+
+EPOCH = datetime(1970, 1, 1)
+
 class Transaction(object):
 
     def __init__(self):
@@ -26,6 +44,18 @@ class Transaction(object):
         self._error_count = 0
         self._next_flush = datetime.utcnow()
         self._size = None
+        # Where the transaction is stored in the manager's spool, if any
+        self._spool_position = None
+        # Set for transactions which failed before or come from the spool,
+        # they are sent after the live ones
+        self._replay = False
+        # When the pending request for the transaction was sent
+        self._sent_at = None
+        # Entries of the transaction in the manager's heaps
+        self._flush_entry = None
+        self._evict_entry = None
+        # Number of payloads the transaction carries for each of their sources
+        self._sources = None
 
     def get_id(self):
         return self._id
@@ -65,18 +95,51 @@ class Transaction(object):
     def flush(self):
         raise NotImplementedError("To be implemented in a subclass")
 
+    def serialize(self):
+        """ Bytes the manager's `load_transaction` turns back into this transaction """
+        raise NotImplementedError("To be implemented in a subclass")
+
 class TransactionManager(object):
     """Holds any transaction derived object list and make sure they
-       are all commited, without exceeding parameters (throttling, memory consumption) """
-
-    def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay):
+       are all commited, without exceeding parameters (throttling, memory consumption)
+
+       With a `spool`, every transaction is also written to disk until it's
+       commited. Transactions that don't fit in the queue are only kept in the
+       spool, and loaded back with `load_transaction` once there's room.
+
+       Up to `max_in_flight` transactions are sent at the same time. That
+       window grows by one with each success, and is halved on errors and
+       when the endpoint latency climbs. The delay between two requests starts
+       at `throttling_delay`, doubles on errors and halves on successes.
+
+       Transactions are indexed by id, and kept in two heaps: one by next
+       flush time to find the ones to flush, one by latest next flush time
+       to find the ones to drop when the queue is full. Removed transactions
+       are only marked as such in the heaps, which are rebuilt once they hold
+       too many of them. """
+
+    def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay,
+                 spool=None, load_transaction=None, max_in_flight=None, connection_stats=None,
+                 emitter_stats=None, graphite_stats=None):
         self._MAX_WAIT_FOR_REPLAY = max_wait_for_replay
         self._MAX_QUEUE_SIZE = max_queue_size
         self._THROTTLING_DELAY = throttling_delay
+        self._MAX_IN_FLIGHT = max_in_flight or MAX_IN_FLIGHT
+
+        # Adaptive throttling state
+        self._send_delay = throttling_delay.total_seconds()
+        self._window = 1
+        self._in_flight = 0
+        self._best_latency = None
+        self._latency = None
+        self._flush_next_scheduled = False
 
         self._flush_without_ioloop = False # useful for tests
 
-        self._transactions = []  # List of all non commited transactions
+        self._transactions = {}  # All non commited transactions, by id
+        self._flush_heap = []  # [next flush, id, transaction], soonest first
+        self._evict_heap = []  # [-next flush timestamp, id, transaction], latest first
+        self._stale_entries = 0  # Removed entries still in the heaps
         self._total_count = 0  # Maintain size/count not to recompute it everytime
         self._total_size = 0
         self._flush_count = 0
@@ -84,19 +147,35 @@ class TransactionManager(object):
         self._transactions_flushed = 0
 
         self._too_big_count = 0
+        # Payloads received and flushed, by source
+        self._source_counts = {}
+
+        self._spool = spool
+        self._load_transaction = load_transaction
+        # Returns the connection reuse counters of the HTTP client, if any
+        self._connection_stats = connection_stats
+        # Returns the backpressure metrics of the custom emitters, if any
+        self._emitter_stats = emitter_stats
+        # Returns the counters of the graphite listener, if any
+        self._graphite_stats = graphite_stats
 
         # Global counter to assign a number to each transaction: we may have an issue
         #  if this overlaps
         self._counter = 0
 
         self._trs_to_flush = None # Current transactions being flushed
-        self._last_flush = datetime.utcnow() # Last flush (for throttling)
+        self._last_flush = time.time() # Last flush (for throttling)
+
+        # Transactions only kept in the spool, and drain rate estimate
+        self._spooled_count = 0
+        self._drain_rate = None
+        self._last_drain_check = (time.time(), 0)
 
         # Track an initial status message.
         ForwarderStatus().persist()
 
     def get_transactions(self):
-        return self._transactions
+        return sorted(self._transactions.itervalues(), key=lambda tr: tr.get_id())
 
     def print_queue_stats(self):
         log.debug("Queue size: at %s, %s transaction(s), %s KB" %
@@ -110,44 +189,204 @@ class TransactionManager(object):
 
         # Give the transaction an id
         tr.set_id(self.get_tr_id())
+        self._count_sources(tr, 0)
 
         # Check the size
         tr_size = tr.get_size()
 
+        if self._spool is not None:
+            self._spool_append(tr, tr_size)
+            return
+
         log.debug("New transaction to add, total size of queue would be: %s KB" %
             ((self._total_size + tr_size) / 1024))
 
         if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
             log.warn("Queue is too big, removing old transactions...")
-            new_trs = sorted(self._transactions,key=attrgetter('_next_flush'), reverse = True)
-            for tr2 in new_trs:
-                if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
-                    self._transactions.remove(tr2)
-                    self._total_count = self._total_count - 1
-                    self._total_size = self._total_size - tr2.get_size()
-                    log.warn("Removed transaction %s from queue" % tr2.get_id())
+            # Drop the transactions that would be flushed last
+            while self._evict_heap and (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
+                tr2 = heapq.heappop(self._evict_heap)[-1]
+                if tr2 is None:
+                    self._stale_entries -= 1
+                    continue
+                tr2._evict_entry = None
+                self._remove(tr2)
+                log.warn("Removed transaction %s from queue" % tr2.get_id())
 
         # Done
-        self._transactions.append(tr)
-        self._total_count += 1
         self._transactions_received += 1
+        self._add(tr, tr_size)
+        self._prioritize(tr)
+
+    def _count_sources(self, tr, index):
+        if not tr._sources:
+            return
+        for source, count in tr._sources.iteritems():
+            counts = self._source_counts.setdefault(source, [0, 0])
+            counts[index] += count
+
+    def _prioritize(self, tr):
+        # Live data doesn't wait for the end of the current flush
+        if self._trs_to_flush is not None:
+            self._trs_to_flush.append(tr)
+
+    def _add(self, tr, tr_size):
+        self._transactions[tr.get_id()] = tr
+        self._total_count += 1
         self._total_size = self._total_size + tr_size
+        self._schedule(tr)
 
         log.debug("Transaction %s added" % (tr.get_id()))
         self.print_queue_stats()
 
+    def _spool_append(self, tr, tr_size):
+        # Keep the queue in the spool order: once some transactions only live
+        # in the spool, the new ones wait for them there
+        in_memory = not self._spool.has_unread() and self._total_size + tr_size <= self._MAX_QUEUE_SIZE
+        self._transactions_received += 1
+        try:
+            tr._spool_position = self._spool.append(tr.serialize(), read=in_memory)
+        except Exception:
+            log.exception("Unable to spool transaction %s, keeping it in memory only" % tr.get_id())
+            self._add(tr, tr_size)
+            return
+
+        if in_memory:
+            self._add(tr, tr_size)
+            self._prioritize(tr)
+        else:
+            self._spooled_count += 1
+            log.debug("Queue is full, transaction %s is only kept on disk" % tr.get_id())
+
+    def load_spooled(self):
+        """ Move transactions from the spool to the queue while there's room for them. """
+        if self._spool is None:
+            return
+        while self._total_size < self._MAX_QUEUE_SIZE:
+            entry = self._spool.read()
+            if entry is None:
+                return
+            record, position = entry
+            self._spooled_count = max(0, self._spooled_count - 1)
+            try:
+                tr = self._load_transaction(record)
+            except Exception:
+                log.exception("Unable to load a spooled transaction, dropping it")
+                self._spool.ack(position)
+                continue
+            tr.set_id(self.get_tr_id())
+            tr._spool_position = position
+            tr._replay = True
+            self._add(tr, tr.get_size())
+            log.debug("Transaction %s loaded from the spool" % tr.get_id())
+
+    def _invalidate(self, entry):
+        if entry is not None:
+            entry[-1] = None
+            self._stale_entries += 1
+
+    def _schedule(self, tr):
+        """ (Re)index `tr` by its next flush time. """
+        if tr.get_id() not in self._transactions:
+            # Removed from the queue while it was being flushed
+            return
+        self._invalidate(tr._flush_entry)
+        self._invalidate(tr._evict_entry)
+        next_flush = tr.get_next_flush()
+        tr._flush_entry = [next_flush, tr.get_id(), tr]
+        heapq.heappush(self._flush_heap, tr._flush_entry)
+        tr._evict_entry = [-(next_flush - EPOCH).total_seconds(), tr.get_id(), tr]
+        heapq.heappush(self._evict_heap, tr._evict_entry)
+        self._compact()
+
+    def _compact(self):
+        if self._stale_entries <= MAX_STALE_RATIO * max(self._total_count, 1000):
+            return
+        self._flush_heap = [entry for entry in self._flush_heap if entry[-1] is not None]
+        heapq.heapify(self._flush_heap)
+        self._evict_heap = [entry for entry in self._evict_heap if entry[-1] is not None]
+        heapq.heapify(self._evict_heap)
+        self._stale_entries = 0
+
+    def _remove(self, tr):
+        if self._transactions.pop(tr.get_id(), None) is None:
+            return
+        self._invalidate(tr._flush_entry)
+        self._invalidate(tr._evict_entry)
+        tr._flush_entry = tr._evict_entry = None
+        self._total_count -= 1
+        self._total_size -= tr.get_size()
+        self._compact()
+
+    def _forget(self, tr):
+        self._remove(tr)
+        self._transactions_flushed += 1
+        self._count_sources(tr, 1)
+        if tr._spool_position is not None:
+            self._spool.ack(tr._spool_position)
+
+    def close(self):
+        if self._spool is not None:
+            self._spool.close()
+
+    def _update_drain_rate(self):
+        """ Transactions commited per second since the last call """
+        now = time.time()
+        last_time, last_flushed = self._last_drain_check
+        if now > last_time:
+            self._drain_rate = (self._transactions_flushed - last_flushed) / (now - last_time)
+        self._last_drain_check = (now, self._transactions_flushed)
+
+    def persist_status(self):
+        backlog = self._total_count + self._spooled_count
+        time_to_empty = None
+        if not backlog:
+            time_to_empty = 0
+        elif self._drain_rate:
+            time_to_empty = int(backlog / self._drain_rate)
+        ForwarderStatus(
+            queue_length=self._total_count,
+            queue_size=self._total_size,
+            flush_count=self._flush_count,
+            transactions_received=self._transactions_received,
+            transactions_flushed=self._transactions_flushed,
+            too_big_count=self._too_big_count,
+            spool_size=self._spool.size if self._spool is not None else None,
+            spool_dropped=self._spool.dropped_count if self._spool is not None else None,
+            drain_rate=self._drain_rate,
+            time_to_empty=time_to_empty,
+            sources=dict((source, {'received': received, 'flushed': flushed})
+                         for source, (received, flushed) in self._source_counts.iteritems()),
+            connections=self._connection_stats() if self._connection_stats is not None else None,
+            emitters=self._emitter_stats() if self._emitter_stats is not None else None,
+            graphite=self._graphite_stats() if self._graphite_stats is not None else None).persist()
+
     def flush(self):
 
         if self._trs_to_flush is not None:
             log.debug("A flush is already in progress, not doing anything")
             return
 
-        to_flush = []
+        # Replays what was spooled before a restart or while the endpoint was down
+        self.load_spooled()
+
+        replayed, live = [], []
         # Do we have something to do ?
         now = datetime.utcnow()
-        for tr in self._transactions:
-            if tr.time_to_flush(now):
-                to_flush.append(tr)
+        while self._flush_heap:
+            tr = self._flush_heap[0][-1]
+            if tr is None:
+                heapq.heappop(self._flush_heap)
+                self._stale_entries -= 1
+                continue
+            if not tr.time_to_flush(now):
+                break
+            heapq.heappop(self._flush_heap)
+            # Indexed again if it has to be replayed
+            tr._flush_entry = None
+            (replayed if tr._replay else live).append(tr)
+        # Transactions are sent from the end of the list: live ones first
+        to_flush = replayed + live
 
         count = len(to_flush)
         should_log = self._flush_count + 1 <= FLUSH_LOGGING_INITIAL or (self._flush_count + 1) % FLUSH_LOGGING_PERIOD == 0
@@ -170,77 +409,108 @@ class TransactionManager(object):
 
         self._flush_count += 1
 
-        ForwarderStatus(
-            queue_length=self._total_count,
-            queue_size=self._total_size,
-            flush_count=self._flush_count,
-            transactions_received=self._transactions_received,
-            transactions_flushed=self._transactions_flushed,
-            too_big_count=self._too_big_count).persist()
-
-    def flush_next(self):
+        self._update_drain_rate()
+        self.persist_status()
 
-        if len(self._trs_to_flush) > 0:
+    def _scheduled_flush_next(self):
+        self._flush_next_scheduled = False
+        self.flush_next()
 
-            td = self._last_flush + self._THROTTLING_DELAY - datetime.utcnow()
-            # Python 2.7 has this built in, python < 2.7 don't...
-            if hasattr(td,'total_seconds'):
-                delay = td.total_seconds()
-            else:
-                delay = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10.0**6
-
-            if delay <= 0:
-                tr = self._trs_to_flush.pop()
-                self._last_flush = datetime.utcnow()
-                log.debug("Flushing transaction %d" % tr.get_id())
-                try:
-                    tr.flush()
-                except Exception,e :
-                    log.exception(e)
-                    self.tr_error(tr)
-                    self.flush_next()
-            else:
+    def flush_next(self):
+        """ Send the next transactions, called again every time one is done. """
+        while self._trs_to_flush and self._in_flight < self._window:
+            delay = self._last_flush + self._send_delay - time.time()
+            if delay > 0:
                 # Wait a little bit more
+                if self._flush_next_scheduled:
+                    return
                 tornado_ioloop = get_tornado_ioloop()
                 if tornado_ioloop._running:
-                    tornado_ioloop.add_timeout(time.time() + delay,
-                        lambda: self.flush_next())
+                    self._flush_next_scheduled = True
+                    tornado_ioloop.add_timeout(time.time() + delay, self._scheduled_flush_next)
+                    return
                 elif self._flush_without_ioloop:
                     # Tornado is no started (ie, unittests), do it manually: BLOCKING
                     time.sleep(delay)
-                    self.flush_next()
-        else:
+                else:
+                    return
+
+            tr = self._trs_to_flush.pop()
+            if tr._sent_at is not None:
+                # Prioritized while it was already being sent
+                continue
+            self._last_flush = time.time()
+            self._in_flight += 1
+            tr._sent_at = self._last_flush
+            log.debug("Flushing transaction %d" % tr.get_id())
+            try:
+                tr.flush()
+            except Exception,e :
+                log.exception(e)
+                self.tr_error(tr)
+
+        if not self._trs_to_flush and self._in_flight == 0:
             self._trs_to_flush = None
 
-    def tr_error(self,tr):
+    def _done(self, tr, success, overloaded=False, latency=None):
+        """
+        Adapt the sending rate to how the request of `tr` went. `latency` is
+        the time the request took once the HTTP client started it, without
+        the time it waited for a connection.
+        """
+        if tr._sent_at is None:
+            return
+        if latency is None:
+            latency = time.time() - tr._sent_at
+        tr._sent_at = None
+        self._in_flight -= 1
+
+        if success:
+            if self._best_latency is None or latency < self._best_latency:
+                self._best_latency = latency
+            if self._latency is None:
+                self._latency = latency
+            else:
+                self._latency += LATENCY_SMOOTHING * (latency - self._latency)
+            if self._latency > max(LATENCY_TOLERANCE * self._best_latency, MIN_OVERLOADED_LATENCY):
+                overloaded = True
+            else:
+                self._window = min(self._window + 1, self._MAX_IN_FLIGHT)
+                self._send_delay /= 2
+                if self._send_delay < MIN_THROTTLING_DELAY:
+                    self._send_delay = 0
+
+        if overloaded:
+            self._window = max(1, self._window / 2)
+            self._send_delay = min(max(2 * self._send_delay, self._THROTTLING_DELAY.total_seconds()),
+                                   MAX_THROTTLING_DELAY)
+            log.debug("Endpoint is overloaded, sending at most %s transaction%s every %ss" % (
+                self._window, plural(self._window), self._send_delay))
+
+    def tr_error(self, tr, response_code=None):
+        # Client errors are specific to the transaction, others are the endpoint's
+        overloaded = response_code is None or response_code == 429 or not 400 <= response_code < 500
+        self._done(tr, False, overloaded)
+        tr._replay = True
         tr.inc_error_count()
         tr.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
+        self._schedule(tr)
         log.warn("Transaction %d in error (%s error%s), it will be replayed after %s" %
           (tr.get_id(), tr.get_error_count(), plural(tr.get_error_count()),
            tr.get_next_flush()))
 
     def tr_error_too_big(self,tr):
+        self._done(tr, False)
         tr.inc_error_count()
         log.warn("Transaction %d is %sKB, it has been rejected as too large. \
           It will not be replayed." % (tr.get_id(), tr.get_size() / 1024))
-        self._transactions.remove(tr)
-        self._total_count -= 1
-        self._total_size -= tr.get_size()
-        self._transactions_flushed += 1
+        self._forget(tr)
         self.print_queue_stats()
         self._too_big_count += 1
-        ForwarderStatus(
-            queue_length=self._total_count,
-            queue_size=self._total_size,
-            flush_count=self._flush_count,
-            transactions_received=self._transactions_received,
-            transactions_flushed=self._transactions_flushed,
-            too_big_count=self._too_big_count).persist()
+        self.persist_status()
 
-    def tr_success(self,tr):
+    def tr_success(self, tr, latency=None):
         log.debug("Transaction %d completed" % tr.get_id())
-        self._transactions.remove(tr)
-        self._total_count -= 1
-        self._total_size -= tr.get_size()
-        self._transactions_flushed += 1
+        self._done(tr, True, latency=latency)
+        self._forget(tr)
         self.print_queue_stats()
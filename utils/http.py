@@ -2,13 +2,196 @@
 # All rights reserved
 # Licensed under Simplified BSD License (see LICENSE)
 
+# stdlib
+import logging
+from Queue import Queue
+import threading
+import time
+from urlparse import urljoin, urlparse
+
+# 3p
 import requests
+from tornado.httpclient import HTTPRequest, HTTPResponse
 
+log = logging.getLogger(__name__)
 
 DEFAULT_TIMEOUT = 10
 
+# Requests sent at the same time by the pooled client, which is also the
+# number of connections it keeps open to an endpoint at most
+MAX_CONNECTIONS = 4
+# Connections unused for that long are closed, in seconds
+IDLE_TIMEOUT = 30
+REQUEST_TIMEOUT = 20
+# Redirections followed at most when they're followed with the same POST
+MAX_REDIRECTS = 5
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
 
 def retrieve_json(url, timeout=DEFAULT_TIMEOUT):
     r = requests.get(url, timeout=timeout)
     r.raise_for_status()
     return r.json()
+
+
+class CountingHTTPAdapter(requests.adapters.HTTPAdapter):
+    """ An adapter counting the connections it opens, reconnections included """
+
+    def __init__(self, *args, **kwargs):
+        self.connections_opened = 0
+        self._lock = threading.Lock()
+        requests.adapters.HTTPAdapter.__init__(self, *args, **kwargs)
+
+    def _count_connection(self):
+        with self._lock:
+            self.connections_opened += 1
+
+    def _counting_manager(self, manager):
+        new_pool = manager._new_pool
+        count_connection = self._count_connection
+
+        def _new_pool(scheme, host, port):
+            pool = new_pool(scheme, host, port)
+            connection_cls = pool.ConnectionCls
+
+            class CountingConnection(connection_cls):
+                def connect(self):
+                    count_connection()
+                    connection_cls.connect(self)
+
+            pool.ConnectionCls = CountingConnection
+            return pool
+
+        manager._new_pool = _new_pool
+        return manager
+
+    def init_poolmanager(self, *args, **kwargs):
+        requests.adapters.HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self._counting_manager(self.poolmanager)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        if proxy not in self.proxy_manager:
+            self._counting_manager(requests.adapters.HTTPAdapter.proxy_manager_for(self, proxy, **proxy_kwargs))
+        return self.proxy_manager[proxy]
+
+
+class PooledHTTPClient(object):
+    """
+    An HTTP client for the tornado ioloop which sends up to `max_connections`
+    requests at the same time, whatever their endpoint, over connections
+    kept alive.
+
+    Requests are sent by as many worker threads, with a requests session for
+    each endpoint, and their responses handed back to the ioloop as tornado
+    `HTTPResponse`s. The connections to an endpoint are closed once nothing
+    was sent to it for `idle_timeout` seconds.
+
+    With `keep_method_on_redirect`, redirections are followed with the same
+    POST, body and headers, instead of the GET browsers switch to.
+    """
+
+    def __init__(self, io_loop, max_connections=None, idle_timeout=None, proxies=None,
+                 verify=True, keep_method_on_redirect=False, timeout=None):
+        self.io_loop = io_loop
+        self.max_connections = max_connections or MAX_CONNECTIONS
+        self.idle_timeout = idle_timeout or IDLE_TIMEOUT
+        self.timeout = timeout or REQUEST_TIMEOUT
+        self.proxies = proxies or {}
+        self.verify = verify
+        self.keep_method_on_redirect = keep_method_on_redirect
+
+        # Endpoint (scheme://host:port) -> session, requests in flight, last request time
+        self.sessions = {}
+        self.in_flight = {}
+        self.last_used = {}
+        self.requests_sent = 0
+        # Connections opened by the sessions which were closed
+        self.closed_connections = 0
+
+        self.requests = Queue()
+        self.workers = []
+
+    def _endpoint(self, url):
+        parsed = urlparse(url)
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        return "%s://%s:%s" % (parsed.scheme, parsed.hostname, port)
+
+    def _session(self, endpoint):
+        session = self.sessions.get(endpoint)
+        if session is not None and not self.in_flight.get(endpoint) \
+                and time.time() - self.last_used[endpoint] > self.idle_timeout:
+            log.debug("Nothing sent to %s for %ss, closing its connections" % (endpoint, self.idle_timeout))
+            self._close_session(endpoint)
+            session = None
+        if session is None:
+            session = requests.Session()
+            adapter = CountingHTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.proxies = self.proxies
+            self.sessions[endpoint] = session
+        return session
+
+    def _close_session(self, endpoint):
+        session = self.sessions.pop(endpoint)
+        self.closed_connections += session.get_adapter('http://').connections_opened
+        session.close()
+
+    def fetch(self, url, body, headers, callback):
+        """ POST `body` to `url`, and call `callback` with the response on the ioloop """
+        endpoint = self._endpoint(url)
+        session = self._session(endpoint)
+        self.in_flight[endpoint] = self.in_flight.get(endpoint, 0) + 1
+        self.last_used[endpoint] = time.time()
+
+        if len(self.workers) < self.max_connections:
+            worker = threading.Thread(target=self._work, name="http-client-%s" % len(self.workers))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        self.requests.put((endpoint, session, HTTPRequest(url, method='POST', body=body, headers=headers), callback))
+
+    def _work(self):
+        while True:
+            endpoint, session, request, callback = self.requests.get()
+            start = time.time()
+            try:
+                r = self._post(session, request)
+                response = HTTPResponse(request, r.status_code, headers=r.headers, reason=r.reason,
+                                        effective_url=r.url, request_time=time.time() - start)
+            except Exception, e:
+                response = HTTPResponse(request, 599, error=e, request_time=time.time() - start)
+            self.io_loop.add_callback(self._done, endpoint, callback, response)
+
+    def _post(self, session, request):
+        if not self.keep_method_on_redirect:
+            return session.post(request.url, data=request.body, headers=dict(request.headers),
+                                timeout=self.timeout, verify=self.verify)
+        url = request.url
+        for _ in xrange(MAX_REDIRECTS + 1):
+            r = session.post(url, data=request.body, headers=dict(request.headers),
+                             timeout=self.timeout, allow_redirects=False, verify=self.verify)
+            if r.status_code not in REDIRECT_CODES or 'location' not in r.headers:
+                return r
+            url = urljoin(r.url, r.headers['location'])
+            log.debug("Following redirection to %s with the same POST" % url)
+        return r
+
+    def _done(self, endpoint, callback, response):
+        self.in_flight[endpoint] -= 1
+        self.requests_sent += 1
+        callback(response)
+
+    def stats(self):
+        """ Connections opened, and requests sent over them """
+        connections = self.closed_connections + sum(
+            session.get_adapter('http://').connections_opened for session in self.sessions.values())
+        return {
+            'connections_opened': connections,
+            'connections_reused': max(0, self.requests_sent - connections),
+            'requests': self.requests_sent,
+        }
+
+    def close(self):
+        for endpoint in self.sessions.keys():
+            self._close_session(endpoint)
@@ -0,0 +1,340 @@
+# (C) Datadog, Inc. 2010-2016
+# All rights reserved
+# Licensed under Simplified BSD License (see LICENSE)
+
+"""
+Samplers of the Linux kernel counters in /proc: they read them once per run
+and compute rates from the previous run, where the sysstat tools sleep to
+take two samples of their own.
+"""
+# stdlib
+from collections import namedtuple
+import os
+import pwd
+import time
+
+# Columns of the cpu lines of /proc/stat, in ticks since boot. Older kernels
+# have fewer of them, the missing ones are 0.
+CPU_TIME_FIELDS = ('user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'steal', 'guest', 'guest_nice')
+CpuTimes = namedtuple('CpuTimes', CPU_TIME_FIELDS)
+BOOT_CPU_TIMES = CpuTimes(*[0] * len(CPU_TIME_FIELDS))
+
+# Percentages of the time spent in each state, named after the mpstat columns
+CPU_PERCENT_FIELDS = ('usr', 'nice', 'sys', 'iowait', 'irq', 'soft', 'steal', 'guest', 'gnice', 'idle')
+
+
+def parse_cpu_times(data):
+    """
+    Parse the content of /proc/stat into {cpu: CpuTimes}, `cpu` being 'all'
+    for the aggregate of all cpus, or the number of a cpu.
+    """
+    cpus = {}
+    for line in data.splitlines():
+        if not line.startswith('cpu'):
+            continue
+        fields = line.split()
+        ticks = [int(v) for v in fields[1:len(CPU_TIME_FIELDS) + 1]]
+        ticks.extend([0] * (len(CPU_TIME_FIELDS) - len(ticks)))
+        cpu = fields[0][3:]
+        cpus[int(cpu) if cpu else 'all'] = CpuTimes(*ticks)
+    return cpus
+
+
+def cpu_percentages(previous, current):
+    """
+    Percentages of the time a cpu spent in each state between two samples of
+    its CpuTimes, computed the way mpstat does.
+    """
+    delta = CpuTimes(*[max(c - p, 0) for c, p in zip(current, previous)])
+    # Time running guests is accounted for in user and nice time too
+    percentages = {
+        'usr': max(delta.user - delta.guest, 0),
+        'nice': max(delta.nice - delta.guest_nice, 0),
+        'sys': delta.system,
+        'iowait': delta.iowait,
+        'irq': delta.irq,
+        'soft': delta.softirq,
+        'steal': delta.steal,
+        'guest': delta.guest,
+        'gnice': delta.guest_nice,
+        'idle': delta.idle,
+    }
+    total = float(sum(percentages.itervalues()))
+    if not total:
+        # Offline, or nothing happened since the previous sample
+        percentages = dict.fromkeys(CPU_PERCENT_FIELDS, 0.0)
+        percentages['idle'] = 100.0
+        return percentages
+    return dict((field, 100 * ticks / total) for field, ticks in percentages.iteritems())
+
+
+class CpuSampler(object):
+    """
+    Percentages of the time spent in each state by all cpus and each of
+    them, since the previous sample. The first one covers the time since
+    boot.
+    """
+
+    def __init__(self, path='/proc/stat'):
+        self.path = path
+        self._previous = {}
+
+    def sample(self):
+        """ Return {cpu: {field: percentage}}, see `parse_cpu_times` """
+        with open(self.path, 'r') as proc_stat:
+            current = parse_cpu_times(proc_stat.read())
+        previous, self._previous = self._previous, current
+        return dict((cpu, cpu_percentages(previous.get(cpu, BOOT_CPU_TIMES), times))
+                    for cpu, times in current.iteritems())
+
+
+# Columns of /proc/diskstats after the device name used by iostat. Newer
+# kernels append discard and flush counters.
+DISK_STAT_FIELDS = ('rd_ios', 'rd_merges', 'rd_sectors', 'rd_ticks', 'wr_ios', 'wr_merges',
+                    'wr_sectors', 'wr_ticks', 'ios_in_progress', 'tot_ticks', 'rq_ticks')
+DiskStats = namedtuple('DiskStats', DISK_STAT_FIELDS)
+BOOT_DISK_STATS = DiskStats(*[0] * len(DISK_STAT_FIELDS))
+
+# Fields computed, named after the columns of `iostat -d -x -k`
+DISK_IO_FIELDS = ('rrqm/s', 'wrqm/s', 'r/s', 'w/s', 'rkB/s', 'wkB/s', 'avgrq-sz', 'avgqu-sz',
+                  'await', 'r_await', 'w_await', 'svctm', '%util')
+
+
+def parse_disk_stats(data, devices=None):
+    """
+    Parse the content of /proc/diskstats into {device: DiskStats}, keeping
+    only the `devices` given if any, and the devices that did some IO.
+    """
+    disks = {}
+    size = len(DISK_STAT_FIELDS)
+    for line in data.splitlines():
+        fields = line.split()
+        if len(fields) < size + 3:
+            # Partitions of kernels before 2.6.25 have 4 columns only
+            continue
+        device = fields[2]
+        if devices is not None and device not in devices:
+            continue
+        if fields[3] == '0' and fields[7] == '0':
+            continue
+        disks[device] = DiskStats(*map(int, fields[3:size + 3]))
+    return disks
+
+
+def disk_io_stats(previous, current, interval):
+    """
+    The `DISK_IO_FIELDS` of a device over `interval` seconds between two
+    samples of its DiskStats, computed the way iostat does and formatted
+    like it.
+    """
+    d = DiskStats(*[max(c - p, 0) for c, p in zip(current, previous)])
+    ios = d.rd_ios + d.wr_ios
+    stats = {
+        'rrqm/s': d.rd_merges / interval,
+        'wrqm/s': d.wr_merges / interval,
+        'r/s': d.rd_ios / interval,
+        'w/s': d.wr_ios / interval,
+        # In 512 bytes sectors
+        'rkB/s': d.rd_sectors / interval / 2,
+        'wkB/s': d.wr_sectors / interval / 2,
+        'avgrq-sz': float(d.rd_sectors + d.wr_sectors) / ios if ios else 0.0,
+        # Ticks are milliseconds
+        'avgqu-sz': d.rq_ticks / interval / 1000,
+        'await': float(d.rd_ticks + d.wr_ticks) / ios if ios else 0.0,
+        'r_await': float(d.rd_ticks) / d.rd_ios if d.rd_ios else 0.0,
+        'w_await': float(d.wr_ticks) / d.wr_ios if d.wr_ios else 0.0,
+        'svctm': float(d.tot_ticks) / ios if ios else 0.0,
+        '%util': min(d.tot_ticks / interval / 10, 100.0),
+    }
+    return dict((field, '%.2f' % value) for field, value in stats.iteritems())
+
+
+class DiskSampler(object):
+    """
+    IO statistics of the block devices since the previous sample, like the
+    extended report of iostat: the whole disks that did some IO, no
+    partitions. The first sample covers the time since boot.
+    """
+
+    def __init__(self, path='/proc/diskstats', uptime_path='/proc/uptime', sys_block_path='/sys/block'):
+        self.path = path
+        self.uptime_path = uptime_path
+        self.sys_block_path = sys_block_path
+        self._previous = {}
+        self._previous_uptime = 0.0
+
+    def _whole_disks(self):
+        try:
+            # Slashes of device names are bangs in sysfs, e.g. cciss!c0d0
+            return set(name.replace('!', '/') for name in os.listdir(self.sys_block_path))
+        except OSError:
+            return None
+
+    def sample(self):
+        """ Return {device: {field: value}}, see `disk_io_stats` """
+        with open(self.uptime_path, 'r') as proc_uptime:
+            uptime = float(proc_uptime.read().split()[0])
+        with open(self.path, 'r') as proc_diskstats:
+            current = parse_disk_stats(proc_diskstats.read(), self._whole_disks())
+        previous, self._previous = self._previous, current
+        interval, self._previous_uptime = uptime - self._previous_uptime, uptime
+        if interval <= 0:
+            return {}
+        return dict((device, disk_io_stats(previous.get(device, BOOT_DISK_STATS), stats, interval))
+                    for device, stats in current.iteritems())
+
+
+# ps shows the control characters of command lines as question marks
+PS_CONTROL_CHARS = ''.join('?' if i < 32 or i == 127 else chr(i) for i in xrange(256))
+
+
+def tty_name(tty_nr):
+    """ Name of the controlling terminal of a process, as shown by ps """
+    major = (tty_nr >> 8) & 0xfff
+    minor = (tty_nr & 0xff) | ((tty_nr >> 12) & 0xfff00)
+    if 136 <= major <= 143:
+        return 'pts/%s' % ((major - 136) * 256 + minor)
+    if major == 4:
+        return 'tty%s' % minor if minor < 64 else 'ttyS%s' % (minor - 64)
+    return '?'
+
+
+class ProcessTable(object):
+    """
+    The processes of /proc in the columns of `ps aux`: USER, PID, %CPU, %MEM,
+    VSZ, RSS, TTY, STAT, START, TIME and COMMAND, as strings formatted like ps.
+    STAT doesn't have the L flag of processes with locked pages.
+
+    Only /proc/<pid>/stat is read for each process on every run: the user,
+    command line and start time of a process are read once and kept until
+    it exits, by pid and start time since a pid can be reused.
+    """
+
+    def __init__(self, proc_path='/proc'):
+        self.proc_path = proc_path
+        self.ticks = os.sysconf('SC_CLK_TCK')
+        self.page_kb = os.sysconf('SC_PAGE_SIZE') / 1024
+        self._boot_time = None
+        # (pid, start time in ticks since boot) -> (user, command, name, start time)
+        self._static = {}
+        self._users = {}
+
+    def _read(self, *path):
+        with open(os.path.join(self.proc_path, *path), 'r') as f:
+            return f.read()
+
+    def _user(self, uid):
+        user = self._users.get(uid)
+        if user is None:
+            try:
+                user = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                user = str(uid)
+            if len(user) > 8:
+                # Like ps, that keeps its column 8 characters wide
+                user = user[:7] + '+'
+            self._users[uid] = user
+        return user
+
+    def _read_static(self, pid, comm, start_ticks):
+        uid = os.stat(os.path.join(self.proc_path, pid)).st_uid
+        args = self._read(pid, 'cmdline').rstrip('\0')
+        if args:
+            command = args.replace('\0', ' ').translate(PS_CONTROL_CHARS)
+            name = args.split('\0', 1)[0].translate(PS_CONTROL_CHARS)
+        else:
+            # Kernel threads and zombies
+            command = name = '[%s]' % comm
+        return self._user(uid), command, name, self._boot_time + float(start_ticks) / self.ticks
+
+    @staticmethod
+    def _format_start(start, now):
+        if now - start < 24 * 3600:
+            return time.strftime('%H:%M', time.localtime(start))
+        if now - start < 365 * 24 * 3600:
+            return time.strftime('%b%d', time.localtime(start))
+        return time.strftime('%Y', time.localtime(start))
+
+    def read(self, exclude_args=False, now=None):
+        """
+        Return the rows of the processes running, by pid. With `exclude_args`
+        the command is the name of the program only.
+        """
+        now = now or time.time()
+        if self._boot_time is None:
+            for line in self._read('stat').splitlines():
+                if line.startswith('btime'):
+                    self._boot_time = int(line.split()[1])
+        uptime = float(self._read('uptime').split()[0])
+        mem_total_kb = 0
+        for line in self._read('meminfo').splitlines():
+            if line.startswith('MemTotal:'):
+                mem_total_kb = int(line.split()[1])
+                break
+
+        ticks = self.ticks
+        static = self._static
+        proc_prefix = os.path.join(self.proc_path, '')
+        seen = {}
+        starts = {}
+        rows = []
+        pids = [name for name in os.listdir(self.proc_path) if name.isdigit()]
+        pids.sort(key=int)
+        for pid in pids:
+            try:
+                with open(proc_prefix + pid + '/stat', 'r') as proc_stat:
+                    data = proc_stat.read()
+                # The command name is in parentheses and can contain anything
+                comm_end = data.rindex(')')
+                comm = data[data.index('(') + 1:comm_end]
+                fields = data[comm_end + 2:].split()
+                start_ticks = fields[19]
+                key = (pid, start_ticks)
+                info = static.get(key)
+                if info is None:
+                    info = self._read_static(pid, comm, start_ticks)
+            except (IOError, OSError, ValueError, IndexError):
+                # Exited meanwhile
+                continue
+            seen[key] = info
+            user, command, name, start = info
+
+            cpu_ticks = int(fields[11]) + int(fields[12])
+            elapsed = int(uptime - float(start_ticks) / ticks)
+            rss_kb = int(fields[21]) * self.page_kb
+            # Per mille, rounded down like ps does
+            cpu = cpu_ticks * 1000 / ticks / elapsed if elapsed > 0 else 0
+            mem = rss_kb * 1000 / mem_total_kb if mem_total_kb else 0
+            state = fields[0]
+            nice = int(fields[16])
+            if nice < 0:
+                state += '<'
+            elif nice > 0:
+                state += 'N'
+            if fields[3] == pid:
+                state += 's'
+            if fields[17] != '1':
+                state += 'l'
+            if fields[5] == fields[2]:
+                state += '+'
+            start_minute = int(start // 60)
+            start_str = starts.get(start_minute)
+            if start_str is None:
+                start_str = starts[start_minute] = self._format_start(start, now)
+
+            rows.append([
+                user,
+                pid,
+                '%d.%d' % divmod(cpu, 10),
+                '%d.%d' % divmod(mem, 10),
+                str(int(fields[20]) / 1024),
+                str(rss_kb),
+                '?' if fields[4] == '0' else tty_name(int(fields[4])),
+                state,
+                start_str,
+                '%d:%02d' % divmod(cpu_ticks / ticks, 60),
+                name if exclude_args else command,
+            ])
+
+        self._static = seen
+        return rows
@@ -0,0 +1,86 @@
+# (C) Datadog, Inc. 2010-2016
+# All rights reserved
+# Licensed under Simplified BSD License (see LICENSE)
+
+"""
+JSON serialization of the payloads sent to the intake, with simplejson and
+its default output format.
+"""
+
+# stdlib
+import zlib
+
+# 3p
+import simplejson
+
+# Items of a list encoded at once when streaming it into a compressor
+STREAM_CHUNK_ITEMS = 500
+
+# Circular references are never sent, skip their bookkeeping on every container
+encode = simplejson.JSONEncoder(check_circular=False).encode
+decode = simplejson.loads
+
+
+def _iterencode(obj):
+    """
+    Yield the JSON encoding of `obj` in pieces, each encoded in one go by the
+    C encoder. Dictionaries and lists are split, except for what they hold
+    beyond the first level of lists.
+    """
+    obj_type = type(obj)
+    if obj_type is dict:
+        if not obj or not all(isinstance(key, basestring) for key in obj):
+            yield encode(obj)
+            return
+        yield '{'
+        first = True
+        for key, value in obj.iteritems():
+            if first:
+                first = False
+            else:
+                yield ', '
+            yield encode(key)
+            yield ': '
+            for chunk in _iterencode(value):
+                yield chunk
+        yield '}'
+    elif obj_type is list or obj_type is tuple:
+        if len(obj) <= STREAM_CHUNK_ITEMS:
+            yield encode(obj)
+            return
+        yield '['
+        for start in xrange(0, len(obj), STREAM_CHUNK_ITEMS):
+            if start:
+                yield ', '
+            yield encode(obj[start:start + STREAM_CHUNK_ITEMS])[1:-1]
+        yield ']'
+    else:
+        yield encode(obj)
+
+
+def encode_compressed(obj, threshold=0):
+    """
+    Encode `obj` straight into a deflate stream, without holding the whole
+    JSON document in memory.
+    Returns a (data, compressed) tuple: documents of at most `threshold`
+    bytes are returned as they are.
+    """
+    pending = []
+    size = 0
+    compressor = None
+    for chunk in _iterencode(obj):
+        if compressor is None:
+            pending.append(chunk)
+            size += len(chunk)
+            if size <= threshold:
+                continue
+            compressor = zlib.compressobj()
+            compressed = [compressor.compress(''.join(pending))]
+            pending = None
+        else:
+            compressed.append(compressor.compress(chunk))
+
+    if compressor is None:
+        return ''.join(pending), False
+    compressed.append(compressor.flush())
+    return ''.join(compressed), True
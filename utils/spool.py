@@ -0,0 +1,259 @@
+# (C) Datadog, Inc. 2010-2016
+# All rights reserved
+# Licensed under Simplified BSD License (see LICENSE)
+
+# stdlib
+import logging
+import os
+import struct
+import time
+import zlib
+
+log = logging.getLogger(__name__)
+
+SEGMENT_SIZE = 4 * 1024 * 1024
+MAX_SPOOL_SIZE = 512 * 1024 * 1024
+FSYNC_INTERVAL = 1
+
+# fsync after every record, at most every FSYNC_INTERVAL seconds, or never
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL_POLICY = 'interval'
+FSYNC_NEVER = 'never'
+FSYNC_POLICIES = [FSYNC_ALWAYS, FSYNC_INTERVAL_POLICY, FSYNC_NEVER]
+
+# Record length and crc32 of the record
+RECORD_HEADER = struct.Struct('>Ii')
+# Offset of an acknowledged record
+ACK = struct.Struct('>Q')
+
+SEGMENT_SUFFIX = '.seg'
+ACK_SUFFIX = '.ack'
+
+
+class Spool(object):
+    """
+    A persistent FIFO of records, stored in append-only segment files.
+
+    Records are read back in order with `read`, and deleted once they are
+    acknowledged with `ack`: a segment file is removed when all its records
+    have been read and acknowledged. Acknowledgements are appended to a file
+    next to their segment, so that a spool reopened after a crash only
+    returns the records that weren't acknowledged yet.
+
+    The oldest segments are dropped when the spool grows over `max_size` bytes.
+    """
+
+    def __init__(self, path, max_size=None, segment_size=None, fsync=None):
+        self.path = path
+        self.max_size = max_size or MAX_SPOOL_SIZE
+        self.segment_size = segment_size or SEGMENT_SIZE
+        self.fsync = fsync or FSYNC_INTERVAL_POLICY
+        if self.fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy %s, should be one of %s" % (self.fsync, FSYNC_POLICIES))
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # Segment sequence number -> size in bytes, in order
+        self.segment_sizes = {}
+        for name in os.listdir(path):
+            if name.endswith(SEGMENT_SUFFIX):
+                seq = int(name[:-len(SEGMENT_SUFFIX)])
+                self.segment_sizes[seq] = os.path.getsize(self._segment_path(seq))
+        self.size = sum(self.segment_sizes.itervalues())
+        self.dropped_count = 0
+
+        # Records read but not acknowledged yet, by segment
+        self.unacked = {}
+
+        # Reading position
+        seqs = sorted(self.segment_sizes)
+        self.read_seq = seqs[0] if seqs else 0
+        self.read_offset = 0
+        self.reader = None
+        self.read_acks = None
+
+        # Never append to segments of a previous run, they may end with a torn record
+        self.write_seq = seqs[-1] + 1 if seqs else 0
+        self.write_offset = 0
+        self.writer = None
+        self.last_fsync = 0
+        if seqs:
+            log.info("Found %s spooled bytes in %s" % (self.size, path))
+
+    def _segment_path(self, seq):
+        return os.path.join(self.path, '%020d%s' % (seq, SEGMENT_SUFFIX))
+
+    def _ack_path(self, seq):
+        return os.path.join(self.path, '%020d%s' % (seq, ACK_SUFFIX))
+
+    def _sync(self, f, force=False):
+        if self.fsync == FSYNC_NEVER:
+            return
+        now = time.time()
+        if force or self.fsync == FSYNC_ALWAYS or now - self.last_fsync >= FSYNC_INTERVAL:
+            f.flush()
+            os.fsync(f.fileno())
+            self.last_fsync = now
+
+    def append(self, record, read=False):
+        """
+        Add a record at the end of the spool, return its position.
+        With `read`, which requires every previous record to be read already,
+        the record is handed over to the caller right away and won't be
+        returned by `read`.
+        """
+        assert not (read and self.has_unread())
+        if self.writer is None or self.write_offset >= self.segment_size:
+            self._roll()
+
+        position = (self.write_seq, self.write_offset)
+        self.writer.write(RECORD_HEADER.pack(len(record), zlib.crc32(record)))
+        self.writer.write(record)
+        length = RECORD_HEADER.size + len(record)
+        self.write_offset += length
+        self.segment_sizes[self.write_seq] += length
+        self.size += length
+        self._sync(self.writer)
+
+        if read:
+            while self.read_seq < self.write_seq:
+                self._next_segment()
+            self._close_reader()
+            self.read_offset = self.write_offset
+            self.unacked[self.write_seq] = self.unacked.get(self.write_seq, 0) + 1
+
+        while self.size > self.max_size and len(self.segment_sizes) > 1:
+            self._drop_oldest()
+        return position
+
+    def _roll(self):
+        if self.writer is not None:
+            self._sync(self.writer, force=True)
+            self.writer.close()
+            self.write_seq += 1
+        self.writer = open(self._segment_path(self.write_seq), 'ab')
+        self.write_offset = 0
+        self.segment_sizes[self.write_seq] = 0
+
+    def _drop_oldest(self):
+        seq = min(self.segment_sizes)
+        log.warning("Spool is over %s bytes, dropping its oldest segment" % self.max_size)
+        if seq == self.read_seq:
+            self._close_reader()
+            # Records left to read in the segment are lost
+            self.dropped_count += self._count_records(seq, self.read_offset)
+            self.read_seq = seq + 1
+            self.read_offset = 0
+        elif seq > self.read_seq:
+            self.dropped_count += self._count_records(seq, 0)
+        self._remove_segment(seq)
+
+    def _count_records(self, seq, offset):
+        count = 0
+        with open(self._segment_path(seq), 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return count
+                length, _ = RECORD_HEADER.unpack(header)
+                f.seek(length, os.SEEK_CUR)
+                count += 1
+
+    def _remove_segment(self, seq):
+        self.size -= self.segment_sizes.pop(seq)
+        self.unacked.pop(seq, None)
+        for path in (self._segment_path(seq), self._ack_path(seq)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _close_reader(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        self.read_acks = None
+
+    def has_unread(self):
+        return (self.read_seq, self.read_offset) < (self.write_seq, self.write_offset) \
+            if self.writer is not None else self.read_seq < self.write_seq
+
+    def read(self):
+        """ Next unacknowledged record and its position, or None when everything was read. """
+        while self.has_unread():
+            seq = self.read_seq
+            if seq not in self.segment_sizes:
+                self._next_segment()
+                continue
+            if self.reader is None:
+                self.reader = open(self._segment_path(seq), 'rb')
+                self.reader.seek(self.read_offset)
+                self.read_acks = self._load_acks(seq)
+            if seq == self.write_seq:
+                self.writer.flush()
+
+            offset = self.read_offset
+            header = self.reader.read(RECORD_HEADER.size)
+            record = None
+            if len(header) == RECORD_HEADER.size:
+                length, crc = RECORD_HEADER.unpack(header)
+                record = self.reader.read(length)
+                if len(record) != length or zlib.crc32(record) != crc:
+                    log.warning("Spool segment %s is truncated at offset %s, skipping the rest of it" % (seq, offset))
+                    record = None
+
+            if record is None:
+                if seq == self.write_seq:
+                    # Everything written so far was read
+                    self.reader.seek(offset)
+                    return None
+                self._next_segment()
+                continue
+
+            self.read_offset = offset + RECORD_HEADER.size + length
+            if offset in self.read_acks:
+                continue
+            self.unacked[seq] = self.unacked.get(seq, 0) + 1
+            return record, (seq, offset)
+        return None
+
+    def _next_segment(self):
+        seq = self.read_seq
+        self._close_reader()
+        self.read_seq += 1
+        self.read_offset = 0
+        if seq in self.segment_sizes and not self.unacked.get(seq):
+            self._remove_segment(seq)
+
+    def _load_acks(self, seq):
+        try:
+            with open(self._ack_path(seq), 'rb') as f:
+                data = f.read()
+        except IOError:
+            return set()
+        return set(ACK.unpack_from(data, i)[0] for i in xrange(0, len(data) - ACK.size + 1, ACK.size))
+
+    def ack(self, position):
+        """ Forget the record at `position`, returned by `append` or `read`. """
+        seq, offset = position
+        if seq not in self.segment_sizes:
+            # Already dropped
+            return
+        with open(self._ack_path(seq), 'ab') as f:
+            f.write(ACK.pack(offset))
+            if self.fsync == FSYNC_ALWAYS:
+                f.flush()
+                os.fsync(f.fileno())
+        unacked = self.unacked.get(seq, 0) - 1
+        self.unacked[seq] = unacked
+        if unacked <= 0 and seq < self.read_seq:
+            self._remove_segment(seq)
+
+    def close(self):
+        self._close_reader()
+        if self.writer is not None:
+            self._sync(self.writer, force=True)
+            self.writer.close()
+            self.writer = None